@@ -0,0 +1,153 @@
+"""
+Command dispatch microbenchmark
+
+Measures the per-command cost of the websocket command path: routing and parsing
+alone, and a full dispatch of piece moves through the game queues, including the
+state change and publishing it, one command at a time and in batches. Each batch
+holds a player's move and a request for the game state, as clients send after
+reconnecting.
+
+    ELO_CALCULATOR_SECRET_KEY=x ELO_CALCULATOR_ADMIN_PASSWORD=x python -m bench.dispatch
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from server.constants import CommandType, Role
+from server.core.dependencies import get_game_manager, get_websocket_manager
+from server.core.game import GameManager
+from server.core.websocket_manager import WebSocketManager
+from server.models.orm.game import Phase, initialize_board
+from server.routers.command import client
+from server.utils import board_util
+
+
+def non_winning_moves(count: int, seed: int = 0) -> list[tuple[int, int, int]]:
+    """
+    A sequence of moves, alternating white and black, that does not finish the game.
+    """
+    rng = random.Random(seed)
+    cells = [(x, y, z) for x in range(5) for y in range(5) for z in range(5)]
+    rng.shuffle(cells)
+    board = initialize_board()
+    moves = []
+    for x, y, z in cells:
+        player = 1 + len(moves) % 2
+        board[x][y][z] = player
+        if board_util.has_four_in_line(board, player):
+            board[x][y][z] = 0
+            continue
+        moves.append((x, y, z))
+        if len(moves) == count:
+            break
+    return moves
+
+
+def play_command(game_id, user_id, turn: int, pos: tuple[int, int, int]) -> dict:
+    """
+    The move for a turn, sent by `user_id`, who must hold the seat of that turn's color.
+    """
+    return dict(
+        type=CommandType.play_white_piece if turn % 2 == 0 else CommandType.play_black_piece,
+        body=dict(
+            timestamp=datetime.utcnow().isoformat(),
+            event_id=uuid4().hex,
+            game_id=str(game_id),
+            user_id=str(user_id),
+            current_turn=turn,
+            pos_x=pos[0],
+            pos_y=pos[1],
+            pos_z=pos[2],
+        ),
+    )
+
+
+def state_command(game_id, user_id) -> dict:
+    return dict(
+        type=CommandType.get_game_state,
+        body=dict(
+            timestamp=datetime.utcnow().isoformat(),
+            event_id=uuid4().hex,
+            game_id=str(game_id),
+            user_id=str(user_id),
+        ),
+    )
+
+
+async def run(games: int, moves: int):
+    game_manager = GameManager()
+    websocket_manager = WebSocketManager(game_manager, client.router)
+    dependencies = websocket_manager.resolve_command_dependencies({
+        get_game_manager: lambda: game_manager,
+        get_websocket_manager: lambda: websocket_manager,
+    })
+    sequence = non_winning_moves(moves)
+
+    # every game is played by the same two users, white and black
+    white_id, black_id = uuid4(), uuid4()
+
+    def mover(turn: int) -> UUID:
+        return white_id if turn % 2 == 0 else black_id
+
+    def running_games() -> list[UUID]:
+        game_ids = []
+        for _ in range(games):
+            game = game_manager.create_game(white_id, opponent_id=black_id)
+            with game_manager.game_context(game.uuid) as g:
+                g.phase = Phase.RUNNING
+            game_ids.append(game.uuid)
+        return game_ids
+
+    game_ids = running_games()
+    commands = [
+        (game_id, mover(turn), play_command(game_id, mover(turn), turn, pos))
+        for turn, pos in enumerate(sequence)
+        for game_id in game_ids
+    ]
+
+    start = time.perf_counter()
+    for _, _, data in commands:
+        client.router.route(data, Role.PLAYER)
+    route_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    failed = 0
+    for game_id, user_id, data in commands:
+        ack = await websocket_manager.dispatch(data, game_id, user_id, dependencies)
+        failed += '"success": false' in ack
+    dispatch_elapsed = time.perf_counter() - start
+
+    # the same moves again, each sent in a batch with a state request
+    game_ids = running_games()
+    batches = [
+        (game_id, mover(turn), [play_command(game_id, mover(turn), turn, pos), state_command(game_id, mover(turn))])
+        for turn, pos in enumerate(sequence)
+        for game_id in game_ids
+    ]
+    start = time.perf_counter()
+    for game_id, user_id, batch in batches:
+        ack = await websocket_manager.dispatch_batch(batch, game_id, user_id, dependencies)
+        failed += ack.count('"success": false')
+    batch_elapsed = time.perf_counter() - start
+
+    count = len(commands)
+    batched = sum(len(batch) for _, _, batch in batches)
+    print(f"{count + batched} commands over {games} games, {failed} failed")
+    print(f"route + parse: {route_elapsed / count * 1e6:8.1f} us/command  {count / route_elapsed:10.0f} commands/s")
+    print(f"dispatch:      {dispatch_elapsed / count * 1e6:8.1f} us/command  {count / dispatch_elapsed:10.0f} commands/s")
+    print(f"batched:       {batch_elapsed / batched * 1e6:8.1f} us/command  {batched / batch_elapsed:10.0f} commands/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--moves", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.games, args.moves))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Broadcast fan-out microbenchmark
+
+Measures how long one broadcast takes to hand a game's new state to every
+subscriber of the game, with websockets that take frames right away.
+
+    ELO_CALCULATOR_SECRET_KEY=x ELO_CALCULATOR_ADMIN_PASSWORD=x python -m bench.fanout
+"""
+import argparse
+import asyncio
+from uuid import uuid4
+
+from server.core.game import GameManager
+from server.core.websocket_manager import WebSocketManager
+from server.models.orm.game import Phase
+
+from bench.dispatch import non_winning_moves
+
+
+class NullWebSocket:
+
+    async def send_text(self, text: str):
+        pass
+
+    async def close(self, code: int = 1000, reason: str | None = None):
+        pass
+
+
+async def run(subscribers: int, moves: int):
+    game_manager = GameManager()
+    # spectators are sent every change, so each move is one full broadcast
+    websocket_manager = WebSocketManager(game_manager, spectator_hz=0)
+    game = game_manager.create_game(uuid4(), opponent_id=uuid4())
+    with game_manager.game_context(game.uuid) as g:
+        g.phase = Phase.RUNNING
+    for _ in range(subscribers):
+        websocket_manager.subscribe(NullWebSocket(), game.uuid)
+
+    for turn, (x, y, z) in enumerate(non_winning_moves(moves)):
+        with game_manager.game_context(game.uuid) as g:
+            g.play_white(x, y, z) if turn % 2 == 0 else g.play_black(x, y, z)
+        # the broadcast, then the sends it started
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    latency = websocket_manager.fanout_latency.summary()
+    print(f"{latency['count']} broadcasts to {subscribers} subscribers")
+    print(f"mean {latency['mean']:.2f} ms, p99 <= {latency['p99']} ms, max {latency['max']:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--moves", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.subscribers, args.moves))
+
+
+if __name__ == "__main__":
+    main()
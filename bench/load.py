@@ -0,0 +1,294 @@
+"""
+Websocket load harness
+
+Runs the app in-process on a local uvicorn server and drives it the way real clients
+do: hundreds of games, each with a host and an opponent playing moves against each
+other and a crowd of spectators watching, every client on its own websocket.
+
+Reports the latency from a player sending a move to each client receiving the state
+with that move, for players and spectators separately, along with the messages per
+second the server sent and the resident memory of the process. Clients run in the
+same process and on the same event loop as the server, so memory includes theirs and
+latencies are pessimistic at high client counts. Compare runs with the same options.
+
+    ELO_CALCULATOR_SECRET_KEY=x ELO_CALCULATOR_ADMIN_PASSWORD=x python -m bench.load
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import time
+from datetime import datetime
+from uuid import UUID, uuid4
+
+import httpx
+import uvicorn
+import websockets
+
+from server.constants import CommandType, MessageType
+
+from bench.dispatch import non_winning_moves
+
+# seconds a client waits for an acknowledge or a state change before giving up
+MOVE_TIMEOUT = 10.0
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def percentiles(samples: list[float]) -> str:
+    if not samples:
+        return "no samples"
+    samples = sorted(samples)
+
+    def at(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1e3
+
+    return f"p50 {at(0.5):7.2f} ms  p95 {at(0.95):7.2f} ms  p99 {at(0.99):7.2f} ms  max {samples[-1] * 1e3:7.2f} ms"
+
+
+def command(command_type: CommandType, game_id: UUID, user_id: UUID, **fields) -> str:
+    body = dict(
+        timestamp=datetime.utcnow().isoformat(),
+        event_id=uuid4().hex,
+        game_id=str(game_id),
+        user_id=str(user_id),
+    )
+    body.update(fields)
+    return json.dumps(dict(type=command_type, body=body))
+
+
+class Stats:
+
+    # seconds from a move being sent to a client getting the state with it
+    player_latency: list[float]
+    spectator_latency: list[float]
+    messages: int
+    failed_games: int
+
+    def __init__(self):
+        self.player_latency = list()
+        self.spectator_latency = list()
+        self.messages = 0
+        self.failed_games = 0
+
+
+class Game:
+
+    __slots__ = ("game_id", "white", "black", "spectators", "sent_at")
+
+    game_id: UUID
+    white: "Client"
+    black: "Client"
+    spectators: list["Client"]
+    # map of turn number to when the move for that turn was sent
+    sent_at: dict[int, float]
+
+    def __init__(self, game_id: UUID):
+        self.game_id = game_id
+        self.spectators = list()
+        self.sent_at = dict()
+
+
+class Client:
+
+    __slots__ = ("user_id", "token", "game", "is_player", "stats", "ws", "turn", "turn_changed", "acks", "_reader")
+
+    user_id: UUID
+    token: str
+    game: Game
+    is_player: bool
+    stats: Stats
+    ws: websockets.ClientConnection | None
+    # latest turn number seen
+    turn: int
+    turn_changed: asyncio.Event
+    # bodies of the acknowledges for commands sent by this client
+    acks: asyncio.Queue
+    _reader: asyncio.Task | None
+
+    def __init__(self, user_id: UUID, token: str, game: Game, is_player: bool, stats: Stats):
+        self.user_id = user_id
+        self.token = token
+        self.game = game
+        self.is_player = is_player
+        self.stats = stats
+        self.ws = None
+        self.turn = 0
+        self.turn_changed = asyncio.Event()
+        self.acks = asyncio.Queue()
+        self._reader = None
+
+    async def connect(self, base_url: str):
+        url = f"{base_url}/api/game/{self.game.game_id}/ws?token={self.token}"
+        self.ws = await websockets.connect(url, max_queue=None, ping_interval=None)
+        self._reader = asyncio.create_task(self.read())
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+    async def request(self, text: str) -> dict:
+        """
+        Send a command and wait for its acknowledge.
+        """
+        await self.ws.send(text)
+        return await asyncio.wait_for(self.acks.get(), MOVE_TIMEOUT)
+
+    async def read(self):
+        async for raw in self.ws:
+            now = time.perf_counter()
+            self.stats.messages += 1
+            message = json.loads(raw)
+            message_type = message.get("type")
+            if message_type == MessageType.ping:
+                await self.ws.send(json.dumps(dict(type=CommandType.pong)))
+                continue
+            if message_type == MessageType.acknowledge:
+                self.acks.put_nowait(message["body"])
+                continue
+            if message_type not in (MessageType.game_state, MessageType.game_state_delta):
+                continue
+            body = message["body"]
+            turn = body.get("fields", body).get("turn_number")
+            if turn is None or turn <= self.turn:
+                continue
+            self.turn = turn
+            sent_at = self.game.sent_at.get(turn - 1)
+            if sent_at is not None:
+                latencies = self.stats.player_latency if self.is_player else self.stats.spectator_latency
+                latencies.append(now - sent_at)
+            self.turn_changed.set()
+
+    async def wait_for_turn(self, turn: int):
+        while self.turn < turn:
+            self.turn_changed.clear()
+            await asyncio.wait_for(self.turn_changed.wait(), MOVE_TIMEOUT)
+
+
+async def login(http: httpx.AsyncClient, name: str) -> tuple[UUID, str]:
+    resp = await http.post("/api/login", json={"name": name})
+    resp.raise_for_status()
+    data = resp.json()
+    return UUID(data["session"]["user_id"]), data["token"]
+
+
+async def setup_game(http: httpx.AsyncClient, base_url: str, spectators: int, stats: Stats) -> Game:
+    host_id, host_token = await login(http, "host")
+    resp = await http.post("/api/game", json=dict(), headers={"Authorization": f"Bearer {host_token}"})
+    resp.raise_for_status()
+    game = Game(UUID(resp.json()["game_id"]))
+    game.white = Client(host_id, host_token, game, True, stats)
+    game.black = Client(*await login(http, "opponent"), game, True, stats)
+    for idx in range(spectators):
+        game.spectators.append(Client(*await login(http, f"spectator-{idx}"), game, False, stats))
+    for client in (game.white, game.black, *game.spectators):
+        await client.connect(base_url)
+    # the opponent joins as a spectator and takes the open seat
+    for client, command_type in ((game.black, CommandType.become_player), (game.white, CommandType.start_game)):
+        ack = await client.request(command(command_type, game.game_id, client.user_id))
+        if not ack["success"]:
+            raise RuntimeError(f"Could not set up game: {ack['error']}")
+    return game
+
+
+async def play(game: Game, moves: list[tuple[int, int, int]], think: float, rng: random.Random, stats: Stats):
+    try:
+        for turn, (x, y, z) in enumerate(moves):
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think)
+            player, command_type = (
+                (game.white, CommandType.play_white_piece) if turn % 2 == 0
+                else (game.black, CommandType.play_black_piece)
+            )
+            game.sent_at[turn] = time.perf_counter()
+            ack = await player.request(command(
+                command_type, game.game_id, player.user_id, current_turn=turn, pos_x=x, pos_y=y, pos_z=z
+            ))
+            if not ack["success"]:
+                raise RuntimeError(ack["error"])
+            await player.wait_for_turn(turn + 1)
+    except (asyncio.TimeoutError, RuntimeError):
+        stats.failed_games += 1
+
+
+async def run(games: int, spectators: int, moves: int, think: float, concurrency: int, seed: int):
+    from server.core.app import create_app
+    from server.core.database import init_db
+
+    init_db()
+    config = uvicorn.Config(create_app(), host="127.0.0.1", port=0, log_level="warning", ws_max_queue=1024)
+    server = uvicorn.Server(config)
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    host, port = server.servers[0].sockets[0].getsockname()[:2]
+    base_url = f"ws://{host}:{port}"
+    rss_before = rss_mb()
+
+    stats = Stats()
+    rng = random.Random(seed)
+    sequence = non_winning_moves(moves, seed)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def setup(http: httpx.AsyncClient) -> Game:
+        async with limit:
+            return await setup_game(http, base_url, spectators, stats)
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=f"http://{host}:{port}") as http:
+        game_list = await asyncio.gather(*(setup(http) for _ in range(games)))
+    connected = time.perf_counter() - start
+    clients = [client for game in game_list for client in (game.white, game.black, *game.spectators)]
+    print(f"{len(clients)} clients over {games} games connected in {connected:.1f}s")
+
+    stats.messages = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(play(game, sequence, think, rng, stats) for game in game_list))
+    elapsed = time.perf_counter() - start
+    # let the last spectator ticks land
+    await asyncio.sleep(0.5)
+    rss_loaded = rss_mb()
+
+    await asyncio.gather(*(client.close() for client in clients))
+    server.should_exit = True
+    await serve
+
+    played = games * len(sequence) - stats.failed_games
+    print(f"{played} moves in {elapsed:.1f}s, {played / elapsed:.0f} moves/s, {stats.failed_games} games failed")
+    print(f"messages received: {stats.messages / elapsed:.0f}/s")
+    print(f"players:    {percentiles(stats.player_latency)}")
+    print(f"spectators: {percentiles(stats.spectator_latency)}")
+    print(f"rss: {rss_before:.0f} MB idle, {rss_loaded:.0f} MB loaded, {peak_rss_mb():.0f} MB peak")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--games", type=int, default=300)
+    parser.add_argument("--spectators", type=int, default=10, help="spectators per game")
+    parser.add_argument("--moves", type=int, default=30, help="moves per game")
+    parser.add_argument("--think", type=float, default=0.2, help="mean seconds between moves")
+    parser.add_argument("--concurrency", type=int, default=50, help="games set up at once")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    # keeps the harness off the primary database and the game log
+    os.environ.setdefault("TESTING", "1")
+    # two sockets per client, one on each end
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    asyncio.run(run(args.games, args.spectators, args.moves, args.think, args.concurrency, args.seed))
+
+
+if __name__ == "__main__":
+    main()
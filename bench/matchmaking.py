@@ -0,0 +1,68 @@
+"""
+Matchmaking benchmark
+
+Queues thousands of players with normally distributed ratings, then measures how long
+one matchmaking pass takes to pair them once their windows have widened, and how
+long players take to join the queue. A pass over 5k players should stay under two
+seconds.
+
+    ELO_CALCULATOR_SECRET_KEY=x ELO_CALCULATOR_ADMIN_PASSWORD=x python -m bench.matchmaking
+"""
+import argparse
+import random
+import time
+from uuid import UUID, uuid4
+
+from server.core.game import GameManager
+from server.core.game_code import GameCodeAllocator
+from server.core.matchmaking import Matchmaker
+
+TARGET_SECONDS = 2.0
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(players: int, seed: int) -> tuple[float, float, int, int]:
+    clock = FakeClock()
+    ratings: dict[UUID, float] = dict()
+    game_manager = GameManager(code_allocator=GameCodeAllocator())
+    # windows start closed, so players wait to be paired by the pass
+    matchmaker = Matchmaker(game_manager, ratings.__getitem__, initial_window=0.0, clock=clock)
+    rng = random.Random(seed)
+    user_ids = [uuid4() for _ in range(players)]
+    for user_id in user_ids:
+        ratings[user_id] = rng.gauss(1200, 300)
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        matchmaker.join(user_id)
+    joined = time.perf_counter() - start
+
+    # long enough for every window to be at its widest
+    clock.now = 60.0
+    start = time.perf_counter()
+    created = matchmaker.match()
+    matched = time.perf_counter() - start
+    return joined, matched, created, len(matchmaker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    joined, matched, created, waiting = run(args.players, args.seed)
+    verdict = "ok" if matched < TARGET_SECONDS else "over target"
+    print(f"join:  {args.players} players in {joined:.3f}s, {joined / args.players * 1e6:.1f} us each")
+    print(f"match: {created} games in {matched:.3f}s, {waiting} left waiting  {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Game log recovery benchmark
+
+Writes a game log holding many live games, each part way through, then measures how
+long a GameManager takes to recover them on startup, both from the log as written
+and from the compacted log. Recovery of 10k games should stay under a second.
+
+    ELO_CALCULATOR_SECRET_KEY=x ELO_CALCULATOR_ADMIN_PASSWORD=x python -m bench.recovery
+"""
+import argparse
+import os
+import tempfile
+import time
+from uuid import uuid4
+
+from server.core.game import GameManager
+from server.core.game_code import GameCodeAllocator
+from server.core.game_log import GameLog
+
+from bench.dispatch import non_winning_moves
+
+TARGET_SECONDS = 1.0
+
+
+def write_log(path: str, games: int, moves: int):
+    game_log = GameLog(path)
+    game_manager = GameManager(game_log, code_allocator=GameCodeAllocator())
+    sequence = non_winning_moves(moves)
+    for _ in range(games):
+        game = game_manager.create_game(uuid4(), opponent_id=uuid4())
+        with game_manager.game_context(game.uuid) as g:
+            g.start()
+        for turn, (x, y, z) in enumerate(sequence):
+            with game_manager.game_context(game.uuid) as g:
+                g.play_white(x, y, z) if turn % 2 == 0 else g.play_black(x, y, z)
+    game_log.close()
+
+
+def recover(path: str) -> tuple[int, float]:
+    start = time.perf_counter()
+    game_log = GameLog(path)
+    game_manager = GameManager(game_log, code_allocator=GameCodeAllocator())
+    elapsed = time.perf_counter() - start
+    game_log.close()
+    # the test game is not one of ours
+    return len(game_manager.get_all_game_ids()) - 1, elapsed
+
+
+def compact(path: str):
+    game_log = GameLog(path)
+    game_log.compact(game_log.load())
+    game_log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--moves", type=int, default=20, help="moves per game")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "games.log")
+        write_log(path, args.games, args.moves)
+        size = os.path.getsize(path) / 2 ** 20
+        # recovery leaves compaction to the running server, so the log as written is
+        # what a restart after a crash reads
+        for label in ("log as written", "compacted log"):
+            recovered, elapsed = recover(path)
+            verdict = "ok" if elapsed < TARGET_SECONDS else "over target"
+            print(f"{label:15s} {recovered} games in {elapsed:.3f}s ({size:.1f} MB)  {verdict}")
+            compact(path)
+            size = os.path.getsize(path) / 2 ** 20
+
+
+if __name__ == "__main__":
+    main()
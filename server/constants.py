@@ -1,4 +1,4 @@
-from enum import auto
+from enum import Enum, auto
 from uuid import UUID
 from strenum import StrEnum
 
@@ -20,8 +20,64 @@ class CommandType(StrEnum):
     kick_player = auto()
     close_game = auto()
     switch_places = auto()
+    # connection, answers a ping and is not routed to a handler
+    pong = auto()
 
 
 class MessageType(StrEnum):
     acknowledge = auto()
     game_state = auto()
+    game_state_delta = auto()
+    # heartbeat, clients answer with a pong
+    ping = auto()
+    # results of a batch of commands, one per command
+    acknowledge_batch = auto()
+
+
+# integer codes for command and message types in the msgpack subprotocol. these are
+# part of the wire format, so codes must never be renumbered or reused.
+COMMAND_TYPE_CODES: dict[CommandType, int] = {
+    CommandType.get_game_state: 0,
+    CommandType.become_player: 1,
+    CommandType.play_white_piece: 2,
+    CommandType.play_black_piece: 3,
+    CommandType.leave: 4,
+    CommandType.forfeit: 5,
+    CommandType.start_game: 6,
+    CommandType.kick_player: 7,
+    CommandType.close_game: 8,
+    CommandType.switch_places: 9,
+    CommandType.pong: 10,
+}
+
+MESSAGE_TYPE_CODES: dict[MessageType, int] = {
+    MessageType.acknowledge: 0,
+    MessageType.game_state: 1,
+    MessageType.game_state_delta: 2,
+    MessageType.ping: 3,
+    MessageType.acknowledge_batch: 4,
+}
+
+
+class Subprotocol(StrEnum):
+    """
+    WebSocket subprotocols a game client can negotiate during the handshake.
+    Clients that do not request one get `json`.
+    """
+    # game state board as nested json arrays
+    json = "elo-json"
+    # game state board and move history packed into base64 strings
+    compact = "elo-compact"
+    # commands and frames as MessagePack binary messages, see `msgpack_util`
+    msgpack = "elo-msgpack"
+
+
+class Role(Enum):
+    """
+    (very) Basic RBAC
+    """
+    FORBIDDEN = 0  # forbidden
+    SPECTATOR = 1
+    PLAYER = 2
+    HOST = 3
+    ADMIN = 4
@@ -1,20 +1,93 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """
+    Background workers run for the lifetime of the server.
+    """
+    from server.core.dependencies import (
+        CACHE,
+        catch_up_ratings,
+        get_game_archiver,
+        get_game_manager,
+        get_load_monitor,
+        get_matchmaker,
+        get_rating_sync,
+        get_result_sink,
+        get_session_store,
+        get_shard_router,
+        get_websocket_manager,
+    )
+    # registers this worker's address so other workers can redirect to it
+    get_shard_router()
+    # ratings loaded at boot may come from a snapshot, and are served while they are
+    # checked against the database
+    catch_up = None
+    if "ratings" in CACHE:
+        catch_up = asyncio.create_task(asyncio.to_thread(catch_up_ratings))
+    archiver = get_game_archiver()
+    archiver.start()
+    matchmaker = get_matchmaker()
+    matchmaker.start()
+    result_sink = get_result_sink()
+    result_sink.start()
+    session_store = get_session_store()
+    if session_store is not None:
+        session_store.start()
+    # other workers record matches and players too, and the ratings snapshot is
+    # written in the background
+    rating_sync = get_rating_sync()
+    if rating_sync is not None:
+        rating_sync.start()
+    websocket_manager = get_websocket_manager(get_game_manager())
+    websocket_manager.start()
+    load_monitor = get_load_monitor()
+    load_monitor.start()
+    try:
+        yield
+    finally:
+        if catch_up is not None:
+            catch_up.cancel()
+        load_monitor.stop()
+        if rating_sync is not None:
+            rating_sync.stop()
+        websocket_manager.stop()
+        matchmaker.stop()
+        archiver.stop()
+        result_sink.stop()
+        # record the results of games that finished since the last flush
+        while await result_sink.flush():
+            pass
+        if session_store is not None:
+            session_store.stop()
+            await session_store.flush()
+        if rating_sync is not None:
+            # includes the results recorded above
+            await rating_sync.save_snapshot()
+
+
 def create_app() -> FastAPI:
     from server.routers.api import (
         auth,
         game,
         match,
+        matchmaking,
+        metrics,
         player,
         summary,
         user_session,
     )
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
     app.include_router(auth.router, prefix="/api")
     app.include_router(game.router, prefix="/api")
     app.include_router(match.router, prefix="/api")
+    app.include_router(matchmaking.router, prefix="/api")
+    app.include_router(metrics.router, prefix="/api")
     app.include_router(player.router, prefix="/api")
     app.include_router(summary.router, prefix="/api")
     app.include_router(user_session.router, prefix="/api")
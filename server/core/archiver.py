@@ -0,0 +1,111 @@
+"""
+Finished game archival
+
+Games stay in the GameManager after they end so that clients can see the final
+position. After a grace period the archiver writes a summary of each of them to the
+database in batches and evicts them, which releases their code and tears down their
+subscriptions. This keeps memory proportional to the number of active games.
+"""
+import asyncio
+import logging
+from typing import Callable
+
+from sqlalchemy.orm.session import Session
+
+from server.core.game import GameManager
+from server.models.orm.archived_game import ArchivedGame
+from server.models.orm.game import GameState
+from server.utils import board_util
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_GRACE_PERIOD = 300.0
+ARCHIVE_INTERVAL = 30.0
+ARCHIVE_BATCH_SIZE = 500
+
+
+def to_archived_game(game: GameState) -> ArchivedGame:
+    return ArchivedGame(
+        uuid=game.uuid,
+        code=game.code,
+        created_at=game.created_at,
+        finished_at=game.finished_at,
+        phase=int(game.phase),
+        end_of_game_trigger=int(game.end_of_game_trigger.value) if game.end_of_game_trigger is not None else None,
+        winner=game.winner,
+        host_player_id=game.host_player_id,
+        white_player_id=game.white_player_id,
+        black_player_id=game.black_player_id,
+        turn_number=game.turn_number,
+        move_history=board_util.pack_moves(game.move_history),
+    )
+
+
+class GameArchiver:
+
+    _game_manager: GameManager
+    _sessionmaker: Callable[[], Session]
+    _grace_period: float
+    _interval: float
+    _batch_size: int
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        game_manager: GameManager,
+        sessionmaker: Callable[[], Session],
+        grace_period: float = ARCHIVE_GRACE_PERIOD,
+        interval: float = ARCHIVE_INTERVAL,
+        batch_size: int = ARCHIVE_BATCH_SIZE,
+    ):
+        self._game_manager = game_manager
+        self._sessionmaker = sessionmaker
+        self._grace_period = grace_period
+        self._interval = interval
+        self._batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                while await self.archive_expired() == self._batch_size:
+                    # a full batch means there may be more waiting
+                    continue
+            except Exception:
+                logger.exception("Failed to archive finished games, will retry")
+
+    def _write_batch(self, rows: list[ArchivedGame]) -> None:
+        db = self._sessionmaker()
+        try:
+            # merge so that a batch that was written but not evicted before a
+            # crash can be written again
+            for row in rows:
+                db.merge(row)
+            db.commit()
+        finally:
+            db.close()
+
+    async def archive_expired(self) -> int:
+        """
+        Archive and evict one batch of expired games. Returns the number of games
+        archived. Games are only evicted once their batch has been committed.
+        """
+        games = self._game_manager.get_expired_games(self._grace_period, limit=self._batch_size)
+        if not games:
+            return 0
+        rows = [to_archived_game(game) for game in games]
+        # the database write is blocking, keep it off the event loop
+        await asyncio.to_thread(self._write_batch, rows)
+        for game in games:
+            self._game_manager.evict_game(game.uuid)
+        logger.info(f"Archived {len(games)} finished games")
+        return len(games)
@@ -1,12 +1,117 @@
+import inspect
+import json
 from functools import wraps
 from typing import Any, Callable
+from uuid import UUID
 
-from server.constants import CommandType
+from fastapi import params
+from pydantic import ValidationError
+
+from server.constants import CommandType, MessageType, Role, Subprotocol
 from server.models.dto.command import Command
+from server.utils import msgpack_util
 
 
 CommandCallback = Callable[[Command, Any], None]
 
+# commands a client may send in one batch
+MAX_BATCH_SIZE = 64
+
+
+class CommandError(Exception):
+    """
+    A command that was rejected before its handler ran.
+    """
+
+
+def _acknowledge_body(event_id: UUID | None, error: str | None, subprotocol: Subprotocol) -> dict[str, Any]:
+    if subprotocol != Subprotocol.msgpack and event_id is not None:
+        event_id = event_id.hex
+    return {"event_id": event_id, "success": error is None, "error": error}
+
+
+def acknowledge_frame(
+    event_id: UUID | None,
+    error: str | None = None,
+    subprotocol: Subprotocol = Subprotocol.json,
+) -> str | bytes:
+    body = _acknowledge_body(event_id, error, subprotocol)
+    if subprotocol == Subprotocol.msgpack:
+        return msgpack_util.frame(MessageType.acknowledge, body)
+    return f'{{"type": "{MessageType.acknowledge}", "body": {json.dumps(body)}}}'
+
+
+def acknowledge_batch_frame(
+    results: list[tuple[UUID | None, str | None]],
+    subprotocol: Subprotocol = Subprotocol.json,
+) -> str | bytes:
+    """
+    One acknowledge for a batch of commands, with the `(event_id, error)` result of
+    each command in the order they were sent.
+    """
+    body = {"results": [_acknowledge_body(event_id, error, subprotocol) for event_id, error in results]}
+    if subprotocol == Subprotocol.msgpack:
+        return msgpack_util.frame(MessageType.acknowledge_batch, body)
+    return f'{{"type": "{MessageType.acknowledge_batch}", "body": {json.dumps(body)}}}'
+
+
+class CommandRoute:
+    """
+    Everything needed to run a command, worked out once when the handler is
+    registered: the model to parse the command with, the dependencies to pass to
+    the handler, and the role a user needs to send it.
+    """
+
+    __slots__ = ("command_type", "handler", "model", "dependencies", "role")
+
+    command_type: CommandType
+    handler: CommandCallback
+    model: type[Command]
+    # handler parameter name to the dependency that provides it
+    dependencies: dict[str, Callable[..., Any]]
+    role: Role
+
+    def __init__(self, command_type: CommandType, handler: CommandCallback, role: Role):
+        self.command_type = command_type
+        self.handler = handler
+        self.role = role
+        self.model = None
+        self.dependencies = dict()
+        for name, param in inspect.signature(handler).parameters.items():
+            if isinstance(param.default, params.Depends):
+                self.dependencies[name] = param.default.dependency
+            elif inspect.isclass(param.annotation) and issubclass(param.annotation, Command):
+                self.model = param.annotation
+        if self.model is None:
+            raise TypeError(f"Handler for {command_type} does not take a Command")
+
+    def parse(self, data: dict[str, Any]) -> Command:
+        return self.model.parse_obj(data)
+
+
+def resolve_dependency(
+    dependency: Callable[..., Any],
+    overrides: dict[Callable[..., Any], Callable[..., Any]],
+    resolved: dict[Callable[..., Any], Any],
+) -> Any:
+    """
+    Call a FastAPI style dependency outside of a request, along with the
+    dependencies it declares itself. Overrides are applied like FastAPI does.
+    Only plain functions are supported, not generators or coroutines.
+    """
+    if dependency in resolved:
+        return resolved[dependency]
+    func = overrides.get(dependency, dependency)
+    kwargs = dict()
+    for name, param in inspect.signature(func).parameters.items():
+        if isinstance(param.default, params.Depends):
+            kwargs[name] = resolve_dependency(param.default.dependency, overrides, resolved)
+    value = func(**kwargs)
+    if inspect.isgenerator(value) or inspect.isawaitable(value):
+        raise TypeError(f"Command dependency {dependency} must return its value directly")
+    resolved[dependency] = value
+    return value
+
 
 class CommandRouter:
     """
@@ -14,22 +119,64 @@ class CommandRouter:
 
     Commands typically respond with an acknowledge of success, but this
     does not generally carry any data. The response object is intended
-    to ACK so the client can proceed to the next request.
+    to ACK so the client can proceed to the next request. Clients that do not
+    want to wait for each ACK can send several commands as one batch, which is
+    answered by a single ACK with the result of each command.
+
+    Unlike FastAPI, dependencies are not resolved per command. They are resolved
+    once per connection with `resolve_dependencies`, and the values are passed to
+    every command run on that connection.
     """
 
     # routes are keyed on command key (str enum)
-    routes: dict[CommandType, CommandCallback]
+    routes: dict[CommandType, CommandRoute]
 
     def __init__(self):
         self.routes = dict()
 
-    def add_command(self, command_type: CommandType, callback: CommandCallback):
+    def add_command(self, command_type: CommandType, callback: CommandCallback, role: Role = Role.SPECTATOR):
         if command_type in self.routes:
             raise ValueError(f"Already have a command handler for type {command_type}")
-        self.routes[command_type] = callback
+        self.routes[command_type] = CommandRoute(command_type, callback, role)
 
-    def command(self, command_type: CommandType):
+    def command(self, command_type: CommandType, role: Role = Role.SPECTATOR):
+        """
+        Register a handler for a command type. Users need at least `role` in the
+        game to send the command.
+        """
         def decorator(func: CommandCallback) -> Command:
-            self.add_command(command_type, func)
+            self.add_command(command_type, func, role)
             return func
         return decorator
+
+    def include_router(self, router: "CommandRouter"):
+        for command_type, route in router.routes.items():
+            self.add_command(command_type, route.handler, route.role)
+
+    def resolve_dependencies(
+        self,
+        overrides: dict[Callable[..., Any], Callable[..., Any]] | None = None
+    ) -> dict[Callable[..., Any], Any]:
+        resolved = dict()
+        for route in self.routes.values():
+            for dependency in route.dependencies.values():
+                resolve_dependency(dependency, overrides or {}, resolved)
+        return resolved
+
+    def route(self, data: dict[str, Any], role: Role) -> tuple[CommandRoute, Command]:
+        """
+        Find the route for a raw command and parse it. Raises CommandError if the
+        command is unknown, malformed or not allowed for `role`.
+        """
+        route = self.routes.get(data.get("type")) if isinstance(data, dict) else None
+        if route is None:
+            raise CommandError("Unknown command type")
+        if role.value < route.role.value:
+            raise CommandError(f"Command {route.command_type} is not allowed for {role.name}")
+        try:
+            command = route.parse(data)
+        except ValidationError as exc:
+            raise CommandError(f"Malformed {route.command_type} command: {exc}")
+        if command.body is None:
+            raise CommandError(f"Command {route.command_type} is missing a body")
+        return route, command
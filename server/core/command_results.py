@@ -0,0 +1,114 @@
+"""
+Results of recently run commands
+
+Clients retry commands they did not see an acknowledge for, which on a flaky
+connection may be commands that already ran. Each command carries an `event_id`,
+and the result of every command that reached its handler is kept for a while under
+that id, so a retry is acknowledged with the original result instead of running the
+command a second time.
+
+Results are kept per game, in least recently used order, up to a fixed number per
+game and for a fixed time.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+from uuid import UUID
+
+# results kept per game
+MAX_RESULTS = 256
+# seconds a result is kept for
+RESULT_TTL = 300.0
+
+# (user id, event id)
+ResultKey = tuple[UUID, UUID]
+
+
+def event_id_of(data: Any) -> UUID | None:
+    """
+    The event id of a raw command, before it is routed and parsed. None if the
+    command does not carry a well formed one.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("body"), dict):
+        return None
+    event_id = data["body"].get("event_id")
+    try:
+        if isinstance(event_id, str):
+            return UUID(event_id)
+        if isinstance(event_id, bytes):
+            # msgpack clients send the raw bytes
+            return UUID(bytes=event_id)
+    except ValueError:
+        pass
+    return None
+
+
+class CommandResult:
+
+    __slots__ = ("error", "expires_at")
+
+    # None for commands that succeeded
+    error: str | None
+    expires_at: float
+
+    def __init__(self, error: str | None, expires_at: float):
+        self.error = error
+        self.expires_at = expires_at
+
+
+class CommandResultCache:
+
+    _max_results: int
+    _ttl: float
+    _clock: Callable[[], float]
+    # map of game id to the results for that game, least recently used first
+    _games: dict[UUID, OrderedDict[ResultKey, CommandResult]]
+    # commands answered from the cache rather than run again
+    duplicates: int
+
+    def __init__(
+        self,
+        max_results: int = MAX_RESULTS,
+        ttl: float = RESULT_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._max_results = max_results
+        self._ttl = ttl
+        self._clock = clock
+        self._games = dict()
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return sum(len(results) for results in self._games.values())
+
+    def get(self, game_id: UUID, user_id: UUID, event_id: UUID) -> CommandResult | None:
+        results = self._games.get(game_id)
+        if results is None:
+            return None
+        key = (user_id, event_id)
+        result = results.get(key)
+        if result is None:
+            return None
+        if result.expires_at <= self._clock():
+            del results[key]
+            return None
+        results.move_to_end(key)
+        self.duplicates += 1
+        return result
+
+    def put(self, game_id: UUID, user_id: UUID, event_id: UUID, error: str | None = None):
+        now = self._clock()
+        results = self._games.setdefault(game_id, OrderedDict())
+        results[(user_id, event_id)] = CommandResult(error, now + self._ttl)
+        results.move_to_end((user_id, event_id))
+        while len(results) > self._max_results:
+            results.popitem(last=False)
+        # results are mostly in the order they expire, so expired ones collect at the front
+        while results:
+            key, oldest = next(iter(results.items()))
+            if oldest.expires_at > now:
+                break
+            del results[key]
+
+    def drop_game(self, game_id: UUID):
+        self._games.pop(game_id, None)
@@ -21,6 +21,7 @@ def init_db():
     global SessionLocal
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+    from server.models.orm.archived_game import ArchivedGame
     from server.models.orm.match import Match
     from server.models.orm.player import Player
     Base.metadata.create_all(engine)
@@ -1,29 +1,58 @@
+import logging
+import math
+import os
 from typing import Any
 from uuid import UUID
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm.session import Session
 
+from server.core import env
+from server.core.archiver import GameArchiver
+from server.core.command_results import CommandResultCache
 from server.core.database import get_sessionlocal
 from server.core.game import GameManager
+from server.core.game_log import GameLog
+from server.core.matchmaking import Matchmaker
+from server.core.rate_limit import LoadMonitor, RateLimiter
+from server.core.rating_sync import RatingSync
+from server.core.result_sink import ResultSink
+from server.core.session_store import SessionStore
+from server.core.shard import ShardCoordinator, ShardRouter, worker_id_for_index
+from server.core.token_cache import DecodedToken, TokenCache
 from server.core.user_session import UserSessionManager
 from server.core.websocket_manager import WebSocketManager
 from server.models.orm.game import GameState
 from server.utils import jwt_util
+from server.utils import path_util
 from server.utils import tabulation_util
 
+logger = logging.getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def validate_token(token: str = Depends(oauth2_scheme)) -> dict[str, Any]:
+_token_cache = None
+
+def get_token_cache() -> TokenCache:
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TokenCache(env.TOKEN_CACHE_SIZE)
+    return _token_cache
+
+
+def authenticate(
+    token: str = Depends(oauth2_scheme),
+    token_cache: TokenCache = Depends(get_token_cache),
+) -> DecodedToken:
     """
-    Basic validation for tokens
+    Decode a bearer token, going through the token cache so that a token is only
+    verified the first time it is presented.
     """
     try:
-        return jwt_util.decode_token(token)
-    except:
+        return token_cache.decode(token)
+    except Exception:
         raise HTTPException(
             status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
@@ -31,6 +60,13 @@ def validate_token(token: str = Depends(oauth2_scheme)) -> dict[str, Any]:
         )
 
 
+def validate_token(decoded: DecodedToken = Depends(authenticate)) -> dict[str, Any]:
+    """
+    Basic validation for tokens
+    """
+    return decoded.claims
+
+
 def get_database():
     db = get_sessionlocal()()
     try:
@@ -55,16 +91,141 @@ def update_cache(db: Session = Depends(get_database)):
         tabulation_util.update_cache(CACHE, db)
 
 
+def catch_up_ratings():
+    """
+    Bring ratings loaded from a snapshot up to date with the database.
+    """
+    db = get_sessionlocal()()
+    try:
+        tabulation_util.catch_up(CACHE, db)
+    except Exception:
+        logger.exception("Failed to bring the ratings up to date")
+    finally:
+        db.close()
+
+
 GAMES: dict[UUID, GameState] = {}
 
 
-def session_auth(token_data: dict[str, Any] = Depends(validate_token)) -> UUID:
+def session_auth(decoded: DecodedToken = Depends(authenticate)) -> UUID:
     """
     Validate a session token. If the session token is valid, we proceed
     by returning the user id referred to in the session token. If the
     session token is not valid, we reject the request.
     """
-    return UUID(token_data["user_id"])
+    if decoded.user_id is None:
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            detail="Not a session token",
+            headers={'WWW-Authenticate': 'Bearer'}
+        )
+    return decoded.user_id
+
+
+def admin_auth(decoded: DecodedToken = Depends(authenticate)) -> dict[str, Any]:
+    """
+    Validate a token issued to the admin through /api/token. Session tokens are
+    handed to anyone who logs in, so they are rejected.
+    """
+    if decoded.claims.get("sub") != env.AUTH_USERNAME:
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            detail="Not an admin token",
+            headers={'WWW-Authenticate': 'Bearer'}
+        )
+    return decoded.claims
+
+
+_rate_limiter = None
+
+def get_rate_limiter() -> RateLimiter | None:
+    """
+    Returns None unless rate limiting is enabled.
+    """
+    global _rate_limiter
+    if _rate_limiter is None and env.RATE_LIMIT_ENABLED and not os.getenv("TESTING"):
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+
+_load_monitor = None
+
+def get_load_monitor() -> LoadMonitor:
+    global _load_monitor
+    if _load_monitor is None:
+        _load_monitor = LoadMonitor(get_game_manager())
+    return _load_monitor
+
+
+class RateLimit:
+    """
+    Dependency that spends one token from the caller's budget for a route group,
+    answering 429 once it runs out, and sheds the request with a 503 while the
+    server is overloaded. Callers are told apart by their address. Route groups that
+    require a session also tell apart the users behind an address, by the user of
+    their access token. Anyone can get a new token, so routes that do not require one
+    ignore it, or a caller could start over with a full budget after each login.
+    """
+
+    route: str
+    per_user: bool
+
+    def __init__(self, route: str, per_user: bool = False):
+        self.route = route
+        self.per_user = per_user
+
+    async def __call__(
+        self,
+        request: Request,
+        rate_limiter: RateLimiter | None = Depends(get_rate_limiter),
+        load_monitor: LoadMonitor = Depends(get_load_monitor),
+        token_cache: TokenCache = Depends(get_token_cache),
+    ):
+        if rate_limiter is None:
+            return
+        if load_monitor.overloaded:
+            load_monitor.shed += 1
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is overloaded",
+                headers={"Retry-After": "1"},
+            )
+        retry_after = rate_limiter.acquire(self.route, self._client_key(request, token_cache, self.per_user))
+        if retry_after:
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    @staticmethod
+    def _client_key(request: Request, token_cache: TokenCache, per_user: bool) -> str:
+        key = f"addr:{request.client.host if request.client else ''}"
+        if not per_user:
+            return key
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                decoded = token_cache.decode(token)
+            except Exception:
+                pass
+            else:
+                if decoded.user_id is not None:
+                    return f"{key}:{decoded.user_id.hex}"
+        return key
+
+
+_session_store = None
+
+def get_session_store() -> SessionStore | None:
+    """
+    Returns None unless the session store is enabled.
+    """
+    global _session_store
+    if _session_store is None and env.SESSION_STORE_ENABLED and not os.getenv("TESTING"):
+        path_util.ensure_paths()
+        _session_store = SessionStore(path_util.SESSION_STORE)
+    return _session_store
 
 
 _user_session_manager = None
@@ -72,16 +233,48 @@ _user_session_manager = None
 def get_user_session_manager() -> UserSessionManager:
     global _user_session_manager
     if _user_session_manager is None:
-        _user_session_manager = UserSessionManager()
+        _user_session_manager = UserSessionManager(max_sessions=env.MAX_USER_SESSIONS, store=get_session_store())
     return _user_session_manager
 
 
+_shard_router = None
+
+def get_shard_router() -> ShardRouter | None:
+    """
+    Returns None unless the server runs as more than one worker process.
+    """
+    global _shard_router
+    if _shard_router is None and env.SHARD_COUNT > 1:
+        path_util.ensure_paths()
+        coordinator = ShardCoordinator(path_util.SHARD_COORDINATOR)
+        worker_id = worker_id_for_index(env.SHARD_INDEX)
+        coordinator.register_worker(worker_id, f"http://{env.SHARD_HOST}:{env.PORT + env.SHARD_INDEX}")
+        _shard_router = ShardRouter(
+            worker_id,
+            [worker_id_for_index(idx) for idx in range(env.SHARD_COUNT)],
+            coordinator,
+        )
+    return _shard_router
+
+
 _game_manager = None
 
 def get_game_manager() -> GameManager:
     global _game_manager
     if _game_manager is None:
-        _game_manager = GameManager()
+        shard = get_shard_router()
+        # games are not persisted across test runs
+        game_log = None
+        if env.GAME_LOG_ENABLED and not os.getenv("TESTING"):
+            path_util.ensure_paths()
+            path = path_util.shard_game_log(env.SHARD_INDEX) if shard is not None else path_util.GAME_LOG
+            game_log = GameLog(path, fsync=env.GAME_LOG_FSYNC)
+        _game_manager = GameManager(
+            game_log,
+            shard=shard,
+            max_queue_depth=env.GAME_QUEUE_MAX_DEPTH,
+            idle_timeout=env.GAME_IDLE_TIMEOUT_SECONDS,
+        )
     return _game_manager
 
 
@@ -90,5 +283,89 @@ _websocket_manager = None
 def get_websocket_manager(game_manager: GameManager = Depends(get_game_manager)) -> WebSocketManager:
     global _websocket_manager
     if _websocket_manager is None:
-        _websocket_manager = WebSocketManager(game_manager)
+        # command handlers depend on this module, so they are imported late
+        from server.routers.command import client
+        _websocket_manager = WebSocketManager(
+            game_manager,
+            client.router,
+            command_results=CommandResultCache(env.COMMAND_RESULTS_PER_GAME, env.COMMAND_RESULTS_TTL_SECONDS),
+            send_timeout=env.WEBSOCKET_SEND_TIMEOUT_SECONDS,
+            spectator_hz=env.SPECTATOR_UPDATE_HZ,
+            heartbeat_interval=env.WEBSOCKET_HEARTBEAT_SECONDS,
+            idle_timeout=env.WEBSOCKET_IDLE_TIMEOUT_SECONDS,
+        )
     return _websocket_manager
+
+
+_game_archiver = None
+
+def get_game_archiver() -> GameArchiver:
+    global _game_archiver
+    if _game_archiver is None:
+        _game_archiver = GameArchiver(
+            get_game_manager(),
+            get_sessionlocal(),
+            grace_period=env.ARCHIVE_GRACE_SECONDS,
+            interval=env.ARCHIVE_INTERVAL_SECONDS,
+        )
+    return _game_archiver
+
+
+def get_user_player_name(user_id: UUID) -> str | None:
+    """
+    Users play as the player with the name they logged in with.
+    """
+    session = get_user_session_manager().get_session_for_user_id(user_id)
+    return session.name if session is not None else None
+
+
+def get_user_rating(user_id: UUID) -> float:
+    name = get_user_player_name(user_id)
+    elo = CACHE.get("elo", {})
+    if name is None or name not in elo:
+        return float(env.STARTING_ELO)
+    return elo[name]
+
+
+_matchmaker = None
+
+def get_matchmaker() -> Matchmaker:
+    global _matchmaker
+    if _matchmaker is None:
+        _matchmaker = Matchmaker(get_game_manager(), get_user_rating)
+    return _matchmaker
+
+
+_result_sink = None
+
+def get_result_sink() -> ResultSink:
+    global _result_sink
+    if _result_sink is None:
+        _result_sink = ResultSink(get_game_manager(), get_sessionlocal(), CACHE, get_user_player_name)
+    return _result_sink
+
+
+_rating_sync = None
+
+def get_rating_sync() -> RatingSync | None:
+    """
+    Returns None unless the server runs as more than one worker process, or writes
+    ratings snapshots.
+    """
+    global _rating_sync
+    if _rating_sync is None:
+        shared = get_shard_router() is not None
+        # ratings are not persisted across test runs
+        snapshot_path = None
+        if env.RATINGS_SNAPSHOT_ENABLED and not os.getenv("TESTING"):
+            path_util.ensure_paths()
+            snapshot_path = path_util.RATINGS_SNAPSHOT
+        if shared or snapshot_path is not None:
+            _rating_sync = RatingSync(
+                get_sessionlocal(),
+                CACHE,
+                interval=env.RATINGS_SYNC_INTERVAL_SECONDS,
+                shared=shared,
+                snapshot_path=snapshot_path,
+            )
+    return _rating_sync
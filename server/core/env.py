@@ -19,3 +19,41 @@ STARTING_ELO = getenv("ELO_CALCULATOR_STARTING_ELO", default=1200)
 ELO_K_VALUE_CEILING = getenv("ELO_CALCULATOR_K_PARAMETER_CEILING", default=512)
 ELO_K_VALUE_FLOOR = getenv("ELO_CALCULATOR_K_PARAMETER_FLOOR", default=16)
 ELO_K_VALUE_DECAY = getenv("ELO_CALCULATOR_K_VALUE_DECAY", default=2)
+GAME_LOG_ENABLED = getenv("ELO_CALCULATOR_GAME_LOG_ENABLED", default="1") == "1"
+GAME_LOG_FSYNC = getenv("ELO_CALCULATOR_GAME_LOG_FSYNC", default="0") == "1"
+ARCHIVE_GRACE_SECONDS = float(getenv("ELO_CALCULATOR_ARCHIVE_GRACE_SECONDS", default=300))
+ARCHIVE_INTERVAL_SECONDS = float(getenv("ELO_CALCULATOR_ARCHIVE_INTERVAL_SECONDS", default=30))
+PORT = int(getenv("ELO_CALCULATOR_PORT", default=8000))
+# number of game server worker processes. with more than one, each worker listens
+# on PORT + its index and owns a shard of the games.
+SHARD_COUNT = int(getenv("ELO_CALCULATOR_SHARDS", default=1))
+SHARD_INDEX = int(getenv("ELO_CALCULATOR_SHARD_INDEX", default=0))
+# host name other workers use to build redirects to this worker
+SHARD_HOST = getenv("ELO_CALCULATOR_SHARD_HOST", default="localhost")
+# commands a single game may have waiting before new ones are rejected
+GAME_QUEUE_MAX_DEPTH = int(getenv("ELO_CALCULATOR_GAME_QUEUE_MAX_DEPTH", default=64))
+# games that do not change for this long are ended
+GAME_IDLE_TIMEOUT_SECONDS = float(getenv("ELO_CALCULATOR_GAME_IDLE_TIMEOUT_SECONDS", default=30 * 60))
+# websocket clients that do not take a state update within this long are disconnected
+WEBSOCKET_SEND_TIMEOUT_SECONDS = float(getenv("ELO_CALCULATOR_WEBSOCKET_SEND_TIMEOUT_SECONDS", default=5))
+# state updates per second sent to the spectators of a game. players always get every update.
+SPECTATOR_UPDATE_HZ = float(getenv("ELO_CALCULATOR_SPECTATOR_UPDATE_HZ", default=4))
+# websocket clients quiet for this long are pinged, and closed once quiet for the idle timeout
+WEBSOCKET_HEARTBEAT_SECONDS = float(getenv("ELO_CALCULATOR_WEBSOCKET_HEARTBEAT_SECONDS", default=20))
+WEBSOCKET_IDLE_TIMEOUT_SECONDS = float(getenv("ELO_CALCULATOR_WEBSOCKET_IDLE_TIMEOUT_SECONDS", default=60))
+# results of recent commands kept per game, so client retries are not run twice
+COMMAND_RESULTS_PER_GAME = int(getenv("ELO_CALCULATOR_COMMAND_RESULTS_PER_GAME", default=256))
+COMMAND_RESULTS_TTL_SECONDS = float(getenv("ELO_CALCULATOR_COMMAND_RESULTS_TTL_SECONDS", default=300))
+# decoded access tokens kept in memory, so each is only verified once
+TOKEN_CACHE_SIZE = int(getenv("ELO_CALCULATOR_TOKEN_CACHE_SIZE", default=10000))
+# user sessions kept in memory, the least recently used are dropped past this
+MAX_USER_SESSIONS = int(getenv("ELO_CALCULATOR_MAX_USER_SESSIONS", default=100000))
+# keep user sessions in a local SQLite file as well, so they survive restarts
+SESSION_STORE_ENABLED = getenv("ELO_CALCULATOR_SESSION_STORE_ENABLED", default="0") == "1"
+# per client request budgets for the http api, and answering 503 while overloaded
+RATE_LIMIT_ENABLED = getenv("ELO_CALCULATOR_RATE_LIMIT_ENABLED", default="1") == "1"
+# write the ratings to a snapshot in the background as they change, and start from it on boot
+RATINGS_SNAPSHOT_ENABLED = getenv("ELO_CALCULATOR_RATINGS_SNAPSHOT_ENABLED", default="1") == "1"
+# how often the ratings snapshot is rewritten if the ratings changed, and with more
+# than one worker, how often each picks up ratings recorded by the others
+RATINGS_SYNC_INTERVAL_SECONDS = float(getenv("ELO_CALCULATOR_RATINGS_SYNC_INTERVAL_SECONDS", default=1))
@@ -1,16 +1,78 @@
 import asyncio
+import gc
+import json
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 from contextlib import contextmanager
-from typing import Callable, Iterator
-from uuid import UUID
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterator
+from uuid import UUID, uuid4
+
+from pydantic.json import pydantic_encoder
 
 from server import constants
-from server.models.orm.game import GameState
+from server.constants import Subprotocol
+from server.core.game_code import CODE_ALLOCATOR, GameCodeAllocator
+from server.core.game_index import DEFAULT_PAGE_SIZE, GameIndex
+from server.core.game_log import GameLog
+from server.core.game_queue import MAX_QUEUE_DEPTH, GameQueue, GameQueueFull, Handler
+from server.core.metrics import Histogram
+from server.core.shard import ShardRouter
+from server.core.timer_wheel import Timer, TimerWheel
+from server.models.orm.game import GameState, JournalEntry, Phase, TimeControl
+from server.utils import msgpack_util
 
 logger = logging.getLogger(__name__)
 
-SENTINEL_TIMEOUT = 60.0
+# lobbies whose host does not connect within this many seconds are closed
+HOST_CONNECT_TIMEOUT = 60.0
+# games that do not change for this many seconds are ended
+IDLE_TIMEOUT = 30 * 60.0
+# number of recent deltas retained per game. subscribers that fall further
+# behind than this are sent a full snapshot instead.
+DELTA_HISTORY = 64
+
+
+def game_state_frame(state_json: str) -> str:
+    return f'{{"type": "{constants.MessageType.game_state}", "body": {state_json}}}'
+
+
+def game_state_delta_frame(delta_json: str) -> str:
+    return f'{{"type": "{constants.MessageType.game_state_delta}", "body": {delta_json}}}'
+
+
+# a websocket frame, text for the json based subprotocols and binary for msgpack
+Frame = str | bytes
+
+
+class DeltaFrame:
+    """
+    A published delta. It is encoded the first time a subscriber needs it, once for
+    the json based subprotocols and once for msgpack.
+    """
+
+    __slots__ = ("seq", "delta", "_json", "_msgpack")
+
+    seq: int
+    delta: dict[str, Any]
+    _json: str | None
+    _msgpack: bytes | None
+
+    def __init__(self, seq: int, delta: dict[str, Any]):
+        self.seq = seq
+        self.delta = delta
+        self._json = None
+        self._msgpack = None
+
+    def frame(self, subprotocol: Subprotocol) -> Frame:
+        if subprotocol == Subprotocol.msgpack:
+            if self._msgpack is None:
+                self._msgpack = msgpack_util.frame(constants.MessageType.game_state_delta, self.delta)
+            return self._msgpack
+        if self._json is None:
+            self._json = game_state_delta_frame(json.dumps(self.delta, default=pydantic_encoder))
+        return self._json
 
 
 class GameManager:
@@ -19,59 +81,360 @@ class GameManager:
     _games: dict[UUID, GameState]
     # a list of subscriber callbacks
     _game_subs: list[Callable[[GameState], None]]
-    # cached json blobs for game states. intended for network transport
-    _game_cache: dict[UUID, str]
+    # cached snapshot frames for game states as (seq, frame), one per subprotocol.
+    # intended for network transport. these are built lazily the first time a
+    # subscriber needs a version, so moves without a snapshot reader do not pay
+    # for serializing the whole game.
+    _game_cache: dict[tuple[UUID, Subprotocol], tuple[int, Frame]]
+    # recent deltas for each game, oldest first
+    _game_deltas: dict[UUID, deque[DeltaFrame]]
     # map of game code to game
     _game_codes: dict[UUID, GameState]
-    # a map of game id to connection sentinel for host connection validation.
-    # a connection sentinel is an asyncio event that gets set by the websocket
-    # handler when the host of a game connects to the game.
-    _sentinels: dict[UUID, asyncio.Event]
+    # secondary indexes for listing games
+    _index: GameIndex
+    # allocator that game codes are drawn from and released back to
+    _code_allocator: GameCodeAllocator
+    # one wheel holds the timers of every game, so pending timeouts cost no tasks
+    _timers: TimerWheel
+    # closes a new lobby unless its host connects. cancelled by `host_connected`.
+    _host_timers: dict[UUID, Timer]
+    # ends a game nobody has touched for a while. pushed back on every change.
+    _idle_timers: dict[UUID, Timer]
+    # ends a game on time when the player to move runs out of time
+    _clock_timers: dict[UUID, Timer]
+    # wall time at which the timer wheel's clock read zero. game clocks take the
+    # time from the wheel through `now`, so moves and clock timers agree on it
+    # even when the wall clock is adjusted.
+    _epoch: datetime
+    _idle_timeout: float
+    # append-only log of game versions. if not provided, games are not persisted.
+    _game_log: GameLog | None
+    # compaction of the game log running in the background
+    _compaction: asyncio.Task | None
+    # callbacks to run when a game is evicted, with the id of the evicted game
+    _evict_subs: list[Callable[[UUID], None]]
+    # monotonic time at which each game entered a terminal phase
+    _terminal_since: dict[UUID, float]
+    # set when running as one of several workers. this manager then only holds
+    # the games whose ids hash to this worker.
+    _shard: ShardRouter | None
+    # per-game command queues, created on the first command for a game
+    _queues: dict[UUID, GameQueue]
+    _max_queue_depth: int
+    # submit-to-completion latency of every queued command, in milliseconds
+    _command_latency: Histogram
+    # commands rejected because their game's queue was full
+    _commands_shed: int
 
-    def __init__(self):
+    def __init__(
+        self,
+        game_log: GameLog | None = None,
+        code_allocator: GameCodeAllocator = CODE_ALLOCATOR,
+        shard: ShardRouter | None = None,
+        max_queue_depth: int = MAX_QUEUE_DEPTH,
+        timers: TimerWheel | None = None,
+        idle_timeout: float = IDLE_TIMEOUT,
+    ):
         """
         NOTE: because FastAPI uses asyncio i don't believe we need to lock this class. A dictionary
         update is not awaitable and so there's no danger to multiple coroutines making update calls
         at similar times.
+
+        If a game log is provided, games in the log are recovered before anything else.
+
+        If a shard router is provided, new games get ids owned by this worker and game
+        codes are claimed through the shard coordinator so they are unique across
+        workers.
         """
         self._games = dict()
         self._game_subs = list()
         self._game_cache = dict()
+        self._game_deltas = defaultdict(lambda: deque(maxlen=DELTA_HISTORY))
         self._game_codes = dict()
-        self._sentinels = dict()
+        self._index = GameIndex()
+        self._code_allocator = code_allocator
+        self._timers = timers if timers is not None else TimerWheel()
+        self._epoch = datetime.utcnow() - timedelta(seconds=self._timers.now())
+        self._host_timers = dict()
+        self._idle_timers = dict()
+        self._clock_timers = dict()
+        self._idle_timeout = idle_timeout
+        self._game_log = game_log
+        self._compaction = None
+        self._evict_subs = list()
+        self._terminal_since = dict()
+        self._shard = shard
+        self._queues = dict()
+        self._max_queue_depth = max_queue_depth
+        self._command_latency = Histogram()
+        self._commands_shed = 0
+
+        if self._game_log is not None:
+            self.recover()
+
+        if constants.TEST_GAME_ID not in self._games:
+            test_game = GameState()
+            test_game.uuid = constants.TEST_GAME_ID
+            self.set_game(test_game)
+
+    def recover(self) -> None:
+        """
+        Rebuild games from the game log. If the log holds more than one snapshot per
+        game, it is compacted in the background after the first change to a game, so
+        the next recovery only has to read one snapshot per game.
+
+        Host connection timeouts, idle timeouts and clocks start over, so a lobby
+        whose host does not reconnect after a restart is closed like a new one.
+        """
+        # like loading, indexing the games and arming their timers allocates a lot of
+        # long lived objects that full collections would only walk over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            games = self._recover_games()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if self._shard is not None:
+            self._shard.coordinator.release_worker_codes(self._shard.worker_id, {g.code for g in games})
+        logger.info(f"Recovered {len(games)} games from the game log")
 
-        test_game = GameState()
-        test_game.uuid = constants.TEST_GAME_ID
-        self.set_game(test_game)
+    def _recover_games(self) -> list[GameState]:
+        games = self._game_log.load()
+        now = time.monotonic()
+        for game in games:
+            self._games[game.uuid] = game
+            self._game_codes[game.code] = game
+            self._code_allocator.reserve(game.code)
+            self._index.update(game)
+            if game.is_terminal:
+                self._terminal_since[game.uuid] = now
+                continue
+            self._schedule_game_timers(game)
+            if game.phase == Phase.INITIALIZED and game.uuid != constants.TEST_GAME_ID:
+                self._host_timers[game.uuid] = self._timers.schedule(HOST_CONNECT_TIMEOUT, self.cancel_game, game.uuid)
+        return games
 
-    def create_game(self, host_player_id: UUID) -> GameState:
+    def create_game(
+        self,
+        host_player_id: UUID,
+        time_control: TimeControl | None = None,
+        opponent_id: UUID | None = None,
+    ) -> GameState:
+        """
+        If an opponent is given, they take the other seat, for example when the game
+        was set up by matchmaking.
+        """
         # by default set them to white
-        game = GameState(host_player_id=host_player_id, white_player_id=host_player_id)
-        self._games[game.uuid] = game
-        self._game_cache[game.uuid] = game.network_json()
-        self._game_codes[game.code] = game
+        game_id = self._shard.new_game_id() if self._shard is not None else uuid4()
+        game = GameState(
+            uuid=game_id,
+            code=self._code_allocator.allocate(),
+            host_player_id=host_player_id,
+            white_player_id=host_player_id,
+            black_player_id=opponent_id,
+            time_control=time_control,
+        )
+        if self._shard is not None:
+            self._claim_shared_code(game)
+        self.set_game(game)
         # if game creator does not connect to the game within 1 minute, we should
         # cancel the game and issue a termination request
-        self._sentinels[game.uuid] = asyncio.Event()
-        asyncio.create_task(self.cancel_game(game.uuid))
+        self._host_timers[game.uuid] = self._timers.schedule(HOST_CONNECT_TIMEOUT, self.cancel_game, game.uuid)
         return game
 
+    def _claim_shared_code(self, game: GameState) -> None:
+        coordinator = self._shard.coordinator
+        while not coordinator.claim_code(game.code, game.uuid, self._shard.worker_id):
+            # another worker holds this code
+            code = self._code_allocator.allocate()
+            self._code_allocator.release(game.code)
+            game.code = code
+
+    def now(self) -> datetime:
+        """
+        Time to run game clocks on, from the same clock as the game timers.
+        """
+        return self._epoch + timedelta(seconds=self._timers.now())
+
+    def host_connected(self, game_id: UUID) -> None:
+        timer = self._host_timers.pop(game_id, None)
+        if timer is not None:
+            timer.cancel()
+
     async def cancel_game(self, game_id: UUID):
         """
         If a game is created but the host does not connect over WebSocket
         """
+        self._host_timers.pop(game_id, None)
+
+        # rotate the game into an unfinished state
+        def close():
+            game = self.get_game_by_id(game_id)
+            if game is None or game.is_terminal:
+                return
+            with self.game_context(game_id) as game:
+                game.close()
+        await self._submit_timeout(game_id, close)
+
+    async def expire_game(self, game_id: UUID):
+        """
+        If nothing has happened in a game for longer than the idle timeout
+        """
+        self._idle_timers.pop(game_id, None)
+
+        def expire():
+            game = self.get_game_by_id(game_id)
+            if game is None or game.is_terminal:
+                return
+            with self.game_context(game_id) as game:
+                game.expire()
+        await self._submit_timeout(game_id, expire)
+
+    async def flag_game(self, game_id: UUID):
+        """
+        If the player to move may have run out of time
+        """
+        self._clock_timers.pop(game_id, None)
+
+        def flag():
+            game = self.get_game_by_id(game_id)
+            if game is None or game.phase != Phase.RUNNING:
+                return
+            now = self.now()
+            # the clock may have been pushed back by a move that was queued ahead of us
+            remaining = game.seconds_until_flag(now)
+            if remaining is not None and remaining > 0:
+                self._clock_timers[game_id] = self._timers.schedule(remaining, self.flag_game, game_id)
+                return
+            with self.game_context(game_id) as game:
+                game.check_flag(now)
+        await self._submit_timeout(game_id, flag)
+
+    async def _submit_timeout(self, game_id: UUID, handler: Handler):
         try:
-            await asyncio.wait_for(self._sentinels[game_id].wait(), timeout=SENTINEL_TIMEOUT)
+            await self.submit(game_id, handler)
+        except Exception:
+            logger.exception(f"Failed to apply timeout to game {game_id}")
+
+    def _cancel_game_timers(self, game_id: UUID) -> None:
+        for timers in (self._host_timers, self._idle_timers, self._clock_timers):
+            timer = timers.pop(game_id, None)
+            if timer is not None:
+                timer.cancel()
+
+    def _schedule_game_timers(self, game: GameState) -> None:
+        """
+        Push back the idle timeout of a game and restart its clock timer. Timers of
+        games that are over are dropped.
+        """
+        game_id = game.uuid
+        if game.is_terminal:
+            self._cancel_game_timers(game_id)
             return
-        except asyncio.TimeoutError:
-            pass
+        for timers in (self._idle_timers, self._clock_timers):
+            timer = timers.pop(game_id, None)
+            if timer is not None:
+                timer.cancel()
+        if game_id != constants.TEST_GAME_ID:
+            self._idle_timers[game_id] = self._timers.schedule(self._idle_timeout, self.expire_game, game_id)
+        remaining = game.seconds_until_flag(self.now())
+        if remaining is not None:
+            self._clock_timers[game_id] = self._timers.schedule(remaining, self.flag_game, game_id)
 
-        # if our sentinel timed out, rotate the game into an unfinished state
-        with self.game_context(game_id) as game:
-            game.close()
+    async def submit(self, game_id: UUID, handler: Handler) -> Any:
+        """
+        Run a command for a game on that game's queue and return its result.
+
+        Commands for one game run one at a time in submission order, so `handler` may
+        be a coroutine function that awaits between game contexts without another
+        command changing the game in the meantime. It must not await inside a game
+        context: readers outside the queue would see its partial changes. Raises
+        GameQueueFull without running the handler if the game has too many pending
+        commands.
+        """
+        queue = self._queues.get(game_id)
+        if queue is None:
+            if game_id not in self._games:
+                raise ValueError("Missing game with specified id")
+            queue = GameQueue(game_id, self._command_latency, max_depth=self._max_queue_depth)
+            queue.start()
+            self._queues[game_id] = queue
+        try:
+            future = queue.submit(handler)
+        except GameQueueFull:
+            self._commands_shed += 1
+            raise
+        return await future
+
+    def queue_depth(self) -> int:
+        """
+        Commands waiting across every game queue.
+        """
+        return sum(queue.depth for queue in self._queues.values())
+
+    def queue_metrics(self) -> dict[str, Any]:
+        depths = [queue.depth for queue in self._queues.values()]
+        return dict(
+            queues=len(depths),
+            depth_total=sum(depths),
+            depth_max=max(depths, default=0),
+            max_depth=self._max_queue_depth,
+            shed=self._commands_shed,
+            latency_ms=self._command_latency.summary(),
+        )
+
+    def evict_game(self, game_id: UUID) -> GameState | None:
+        """
+        Drop a game and everything held for it, and release its code. Games should be
+        archived before they are evicted.
+        """
+        game = self._games.pop(game_id, None)
+        if game is None:
+            return None
+        for subprotocol in Subprotocol:
+            self._game_cache.pop((game_id, subprotocol), None)
+        self._game_deltas.pop(game_id, None)
+        self._terminal_since.pop(game_id, None)
+        self._index.remove(game_id)
+        queue = self._queues.pop(game_id, None)
+        if queue is not None:
+            queue.stop()
+        if self._game_codes.get(game.code) is game:
+            del self._game_codes[game.code]
+            self._code_allocator.release(game.code)
+            if self._shard is not None:
+                self._shard.coordinator.release_code(game.code, game_id)
+        self._cancel_game_timers(game_id)
+        if self._game_log is not None:
+            self._game_log.record_evict(game_id)
+        for cb in self._evict_subs:
+            cb(game_id)
+        return game
+
+    def get_expired_games(self, grace_period: float, limit: int | None = None) -> list[GameState]:
+        """
+        Games that have been in a terminal phase for at least `grace_period` seconds,
+        oldest first.
+        """
+        cutoff = time.monotonic() - grace_period
+        expired = []
+        # insertion order is the order in which games became terminal
+        for game_id, since in self._terminal_since.items():
+            if since > cutoff or (limit is not None and len(expired) >= limit):
+                break
+            expired.append(self._games[game_id])
+        return expired
 
     def set_game(self, game: GameState) -> None:
+        """
+        Add or replace a game. Games without a code are given one.
+        """
+        if game.code is None:
+            game.code = self._code_allocator.allocate()
         self._games[game.uuid] = game
+        self._game_codes[game.code] = game
+        self._update_game(game)
 
     def get_game_by_id(self, game_id: UUID) -> GameState | None:
         return self._games.get(game_id)
@@ -79,12 +442,84 @@ class GameManager:
     def get_game_by_code(self, game_code: str) -> GameState | None:
         return self._game_codes.get(game_code)
 
+    def get_game_id_by_code(self, game_code: str) -> UUID | None:
+        """
+        Unlike `get_game_by_code`, this also resolves codes of games held by
+        other workers.
+        """
+        game = self._game_codes.get(game_code)
+        if game is not None:
+            return game.uuid
+        if self._shard is not None:
+            return self._shard.coordinator.lookup_code(game_code)
+        return None
+
+    @property
+    def shard(self) -> ShardRouter | None:
+        return self._shard
+
     def get_all_game_ids(self) -> list[UUID]:
         return list(self._games.keys())
 
-    @property
-    def game_cache(self) -> dict[UUID, str]:
-        return self._game_cache
+    def list_games(
+        self,
+        phase: Phase | None = None,
+        open_slot: bool | None = None,
+        host_player_id: UUID | None = None,
+        player_id: UUID | None = None,
+        cursor: int | None = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+    ) -> tuple[list[GameState], int | None]:
+        """
+        Page through games matching the filters, newest first. Pass the returned
+        cursor to get the next page. When sharded, only this worker's games are listed.
+        """
+        return self._index.query(phase, open_slot, host_player_id, player_id, cursor, limit)
+
+    def code_pool_metrics(self) -> dict[str, float]:
+        return self._code_allocator.metrics()
+
+    def snapshot_frame(self, game_id: UUID, subprotocol: Subprotocol = Subprotocol.json) -> Frame:
+        game = self._games[game_id]
+        key = (game_id, subprotocol)
+        cached = self._game_cache.get(key)
+        if cached is None or cached[0] != game.seq:
+            if subprotocol == Subprotocol.msgpack:
+                frame = msgpack_util.frame(constants.MessageType.game_state, game.compact_dict(binary=True))
+            elif subprotocol == Subprotocol.compact:
+                frame = game_state_frame(game.network_compact_json())
+            else:
+                frame = game_state_frame(game.network_json())
+            cached = (game.seq, frame)
+            self._game_cache[key] = cached
+        return cached[1]
+
+    def frames_since(
+        self,
+        game_id: UUID,
+        seq: int | None,
+        subprotocol: Subprotocol = Subprotocol.json
+    ) -> list[Frame]:
+        """
+        Return the frames a client holding state version `seq` needs to catch up
+        to the latest version of the game.
+
+        This is the retained deltas when they cover the gap, otherwise a single
+        full snapshot. A `seq` of None always gets a snapshot. Deltas are already
+        small, so the json based subprotocols share them and only their snapshots
+        differ.
+        """
+        game = self._games.get(game_id)
+        if game is None:
+            return []
+        if seq == game.seq:
+            return []
+        deltas = self._game_deltas.get(game_id)
+        if seq is None or seq > game.seq or not deltas or deltas[0].seq > seq + 1:
+            return [self.snapshot_frame(game_id, subprotocol)]
+        # deltas are contiguous, so the first one we need is at a known offset
+        start = seq + 1 - deltas[0].seq
+        return [delta.frame(subprotocol) for delta in list(deltas)[start:]]
 
     def register_subscriber(self, callback: Callable[[GameState], None]):
         """
@@ -104,33 +539,90 @@ class GameManager:
             return
         self._game_subs.remove(callback)
 
-    def _update_game(self, game: GameState):
-        self._game_cache[game.uuid] = game.network_json()
+    def register_evict_subscriber(self, callback: Callable[[UUID], None]):
+        """
+        Evict subscribers are called with the id of each game that is evicted.
+        """
+        self._evict_subs.append(callback)
+
+    def _update_game(
+        self,
+        game: GameState,
+        journal: list[JournalEntry] | None = None,
+        event_id: UUID | None = None,
+    ):
+        """
+        Publish a new version of the game. If the journal of the change is not
+        provided, no delta can be derived and subscribers will resync from the
+        snapshot.
+
+        Only the delta is built here. Snapshot frames are built the first time a
+        subscriber needs the version, so a move costs the same however long the
+        game is.
+
+        The version is written to the game log before it is sent to anyone.
+        """
+        game.seq += 1
+        # derived once for both the log and the subscribers
+        delta = game.network_delta(journal) if journal is not None else None
+        if self._game_log is not None:
+            self._game_log.record(game, journal, event_id, delta)
+            if self._game_log.needs_compaction and self._compaction is None:
+                self._compact_log()
+        if game.is_terminal and game.uuid not in self._terminal_since:
+            self._terminal_since[game.uuid] = time.monotonic()
+        self._index.update(game)
+        self._schedule_game_timers(game)
+        deltas = self._game_deltas[game.uuid]
+        if delta is None:
+            deltas.clear()
+        else:
+            deltas.append(DeltaFrame(game.seq, delta))
         for cb in self._game_subs:
             cb(game)
 
-    @contextmanager
-    def game_context(self, game_id: UUID) -> Iterator[GameState]:
+    def _compact_log(self) -> None:
+        """
+        Compact the game log on a worker thread, so the change that crossed the
+        threshold does not hold up every other game. Without a running event loop the
+        log is compacted right away instead.
         """
-        WARN: do not put any awaitable in the game context. The concurrency safety
-        of this function is generally guaranteed by the assumption that this
-        coroutine will run from start to finish in a single iteration.
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._game_log.compact(self._games.values())
+            return
+        self._compaction = loop.create_task(self._game_log.compact_in_background())
+        self._compaction.add_done_callback(self._compaction_done)
+
+    def _compaction_done(self, task: asyncio.Task) -> None:
+        self._compaction = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to compact the game log", exc_info=task.exception())
 
-        TODO: when switching to redis for game storage (which is needed for supporting
-        a multiprocess game server), this logic will need to be revised to include a
-        multiprocessing locking mechanism.
+    @contextmanager
+    def game_context(self, game_id: UUID, event_id: UUID | None = None) -> Iterator[GameState]:
+        """
+        WARN: do not put any awaitable in the game context, including in handlers run
+        through `submit`. Its concurrency safety depends on the coroutine running from
+        start to finish in a single iteration, as readers such as state requests and
+        spectators do not go through the game's queue and would see partial changes.
 
-        See: https://redis.io/docs/manual/patterns/distributed-locks/
+        If the change is made on behalf of a client command, pass its `event_id` so
+        it is recorded with the change in the game log.
         """
         game = self.get_game_by_id(game_id)
         if game is None:
             raise ValueError("Missing game with specified id")
 
-        # NOTE: we enforce ACID by retaining a copy of the original object.
-        # We need to use a deep copy because the game state contains a 3D list.
-        orig = game.copy(deep=True)
+        # NOTE: we enforce atomicity with a mutation journal on the game state.
+        # Only the fields, cells and moves touched by the command are recorded,
+        # so the cost of a transaction does not grow with the length of the game.
+        game.begin()
         try:
             yield game
-            self._update_game(game)
         except BaseException:
-            game = orig           
+            game.rollback()
+            raise
+        journal = game.commit()
+        self._update_game(game, journal, event_id)
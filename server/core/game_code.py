@@ -0,0 +1,139 @@
+"""
+Game code allocation
+
+Game codes are short strings players type in to join a lobby. Codes are handed out
+lazily by walking a random permutation of the whole code space, so nothing has to be
+generated up front and no code is handed out twice until the space runs out. Codes
+of archived games are released back to the allocator and reused once all fresh codes
+are gone.
+
+A code is all it takes to join a lobby, so seeing some codes must not tell anyone
+which codes come next. The permutation is a Feistel network keyed with a secret
+drawn at startup, over the smallest even number of bits that covers the code space.
+Results outside the code space are fed through the network again until they land
+inside it, which keeps it a permutation of the code space.
+"""
+import hashlib
+import secrets
+from collections import deque
+
+ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ"
+CODE_LENGTH = 4
+FEISTEL_ROUNDS = 4
+
+
+class GameCodeAllocator:
+
+    _alphabet: str
+    _length: int
+    # number of distinct codes
+    _capacity: int
+    # the permutation works on values of twice this many bits, split in two halves
+    _half_bits: int
+    _half_mask: int
+    # secret key of the permutation's round function
+    _key: bytes
+    # next index of the permutation to hand out
+    _cursor: int
+    # released codes waiting to be reused, oldest first
+    _recycled: deque[str]
+    # codes currently held by games
+    _live: set[str]
+    # total number of codes that have been released
+    _released: int
+
+    def __init__(
+        self,
+        alphabet: str = ALPHABET,
+        length: int = CODE_LENGTH,
+        key: bytes | None = None,
+    ):
+        """
+        Allocators with the same key hand out codes in the same order. By default the
+        key is random.
+        """
+        self._alphabet = alphabet
+        self._length = length
+        self._capacity = len(alphabet) ** length
+        self._half_bits = max(1, ((self._capacity - 1).bit_length() + 1) // 2)
+        self._half_mask = (1 << self._half_bits) - 1
+        self._key = key if key is not None else secrets.token_bytes(16)
+        self._cursor = 0
+        self._recycled = deque()
+        self._live = set()
+        self._released = 0
+
+    def _round(self, round_number: int, half: int) -> int:
+        data = bytes((round_number,)) + half.to_bytes(8, "little")
+        digest = hashlib.blake2b(data, digest_size=8, key=self._key).digest()
+        return int.from_bytes(digest, "little") & self._half_mask
+
+    def _permute(self, index: int) -> int:
+        value = index
+        while True:
+            left, right = value >> self._half_bits, value & self._half_mask
+            for round_number in range(FEISTEL_ROUNDS):
+                left, right = right, left ^ self._round(round_number, right)
+            value = (left << self._half_bits) | right
+            if value < self._capacity:
+                return value
+
+    def _code_at(self, index: int) -> str:
+        value = self._permute(index)
+        base = len(self._alphabet)
+        chars = []
+        for _ in range(self._length):
+            value, digit = divmod(value, base)
+            chars.append(self._alphabet[digit])
+        return "".join(chars)
+
+    def allocate(self) -> str:
+        """
+        Hand out a code that no live game holds. Fresh codes are used before
+        recycled ones so that a code is not reused soon after its game ended.
+        """
+        while self._cursor < self._capacity:
+            code = self._code_at(self._cursor)
+            self._cursor += 1
+            # codes reserved by recovered games may turn up in the permutation
+            if code not in self._live:
+                self._live.add(code)
+                return code
+        while self._recycled:
+            code = self._recycled.popleft()
+            if code not in self._live:
+                self._live.add(code)
+                return code
+        raise RuntimeError("No game codes available")
+
+    def reserve(self, code: str) -> None:
+        """
+        Mark a code that was handed out elsewhere, for example by a previous
+        process, as held.
+        """
+        self._live.add(code)
+
+    def release(self, code: str) -> None:
+        if code not in self._live:
+            return
+        self._live.remove(code)
+        self._recycled.append(code)
+        self._released += 1
+
+    def is_live(self, code: str) -> bool:
+        return code in self._live
+
+    def metrics(self) -> dict[str, float]:
+        fresh = self._capacity - self._cursor
+        return dict(
+            capacity=self._capacity,
+            live=len(self._live),
+            fresh_remaining=fresh,
+            recycled_available=len(self._recycled),
+            released_total=self._released,
+            # fraction of the code space held by live games
+            pressure=len(self._live) / self._capacity,
+        )
+
+
+CODE_ALLOCATOR = GameCodeAllocator()
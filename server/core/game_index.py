@@ -0,0 +1,170 @@
+"""
+Secondary indexes over live games
+
+Each game is numbered in the order it was first indexed. Every index keeps the numbers
+of its games in a sorted list, so a listing can start at a cursor with a bisect and
+walk newest first without looking at games outside the index.
+"""
+import bisect
+from typing import Hashable
+from uuid import UUID
+
+from server.models.orm.game import GameState, Phase
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _add(index: dict[Hashable, list[int]], key: Hashable, order: int) -> None:
+    orders = index.get(key)
+    if orders is None:
+        index[key] = [order]
+    elif not orders or orders[-1] < order:
+        orders.append(order)
+    else:
+        bisect.insort(orders, order)
+
+
+def _remove(index: dict[Hashable, list[int]], key: Hashable, order: int) -> None:
+    orders = index[key]
+    del orders[bisect.bisect_left(orders, order)]
+    # empty entries are dropped so that hosts and players who have left do not
+    # hold memory
+    if not orders:
+        del index[key]
+
+
+class GameIndex:
+
+    _next_order: int
+    # creation order number of each game
+    _orders: dict[UUID, int]
+    _games: dict[int, GameState]
+    # the index keys each game is filed under, as (phase, open slot, host, players)
+    _keys: dict[UUID, tuple[Phase, bool, UUID | None, frozenset[UUID]]]
+    # every game, keyed on None
+    _all: dict[None, list[int]]
+    _by_phase: dict[Phase, list[int]]
+    # lobbies with a free player slot, keyed on True
+    _open: dict[bool, list[int]]
+    _by_host: dict[UUID, list[int]]
+    _by_player: dict[UUID, list[int]]
+
+    def __init__(self):
+        self._next_order = 0
+        self._orders = dict()
+        self._games = dict()
+        self._keys = dict()
+        self._all = dict()
+        self._by_phase = dict()
+        self._open = dict()
+        self._by_host = dict()
+        self._by_player = dict()
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    @staticmethod
+    def _index_keys(game: GameState) -> tuple[Phase, bool, UUID | None, frozenset[UUID]]:
+        players = frozenset(p for p in (game.white_player_id, game.black_player_id) if p is not None)
+        return game.phase, game.has_open_slot, game.host_player_id, players
+
+    def update(self, game: GameState) -> None:
+        """
+        File a game under its current keys. Only the indexes whose key changed are
+        touched. The game may be a new object for a game already indexed, which then
+        takes the place of the old one.
+        """
+        order = self._orders.get(game.uuid)
+        if order is None:
+            order = self._next_order
+            self._next_order += 1
+            self._orders[game.uuid] = order
+            _add(self._all, None, order)
+            old = (None, False, None, frozenset())
+        else:
+            old = self._keys[game.uuid]
+        self._games[order] = game
+        new = self._index_keys(game)
+        if new == old:
+            return
+        self._keys[game.uuid] = new
+        self._move(order, old, new)
+
+    def remove(self, game_id: UUID) -> None:
+        order = self._orders.pop(game_id, None)
+        if order is None:
+            return
+        del self._games[order]
+        _remove(self._all, None, order)
+        self._move(order, self._keys.pop(game_id), (None, False, None, frozenset()))
+
+    def _move(self, order: int, old: tuple, new: tuple) -> None:
+        old_phase, old_open, old_host, old_players = old
+        phase, is_open, host, players = new
+        if phase != old_phase:
+            if old_phase is not None:
+                _remove(self._by_phase, old_phase, order)
+            if phase is not None:
+                _add(self._by_phase, phase, order)
+        if is_open != old_open:
+            if old_open:
+                _remove(self._open, True, order)
+            else:
+                _add(self._open, True, order)
+        if host != old_host:
+            if old_host is not None:
+                _remove(self._by_host, old_host, order)
+            if host is not None:
+                _add(self._by_host, host, order)
+        for player in old_players - players:
+            _remove(self._by_player, player, order)
+        for player in players - old_players:
+            _add(self._by_player, player, order)
+
+    def query(
+        self,
+        phase: Phase | None = None,
+        open_slot: bool | None = None,
+        host_player_id: UUID | None = None,
+        player_id: UUID | None = None,
+        cursor: int | None = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+    ) -> tuple[list[GameState], int | None]:
+        """
+        Games matching every given filter, newest first, starting after `cursor`.
+        Returns the page and the cursor for the next page, which is None on the last
+        page.
+
+        The walk is driven by the smallest index that applies, the other filters
+        are checked on each game it visits.
+        """
+        candidates = [self._all.get(None, [])]
+        if phase is not None:
+            candidates.append(self._by_phase.get(phase, []))
+        if open_slot:
+            candidates.append(self._open.get(True, []))
+        if host_player_id is not None:
+            candidates.append(self._by_host.get(host_player_id, []))
+        if player_id is not None:
+            candidates.append(self._by_player.get(player_id, []))
+        orders = min(candidates, key=len)
+
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        idx = bisect.bisect_left(orders, cursor) if cursor is not None else len(orders)
+        page = []
+        while idx > 0:
+            idx -= 1
+            game = self._games[orders[idx]]
+            if phase is not None and game.phase != phase:
+                continue
+            if open_slot is not None and game.has_open_slot != open_slot:
+                continue
+            if host_player_id is not None and game.host_player_id != host_player_id:
+                continue
+            if player_id is not None and player_id not in (game.white_player_id, game.black_player_id):
+                continue
+            page.append(game)
+            if len(page) == limit:
+                return page, (orders[idx] if idx > 0 else None)
+        return page, None
@@ -0,0 +1,281 @@
+"""
+Append-only game log
+
+Live games are only held in memory by the GameManager. To survive a process restart,
+every published version of a game is appended to a local log file as a json line:
+
+    {"op": "snapshot", "game_id": ..., "seq": ..., "state": {...}}  # see GameState.compact_dict
+    {"op": "delta", "game_id": ..., "seq": ..., "event_id": ..., "fields": {...}, "cells": [...], "moves": [...]}
+    {"op": "evict", "game_id": ...}
+
+A snapshot is written when a game is created and then every `snapshot_interval`
+versions, so the tail that has to be replayed for any one game stays short. When
+the log grows past `compact_after` records it is rewritten to hold a single snapshot
+per live game. While the server runs this happens on a worker thread, which replays
+the log as it stood when compaction started, so games keep being recorded meanwhile.
+
+Recovery first scans the log for the latest snapshot of each game, going by the
+start of each line rather than decoding it, then decodes only that snapshot and the
+deltas after it, and builds each GameState once at the end. Boards are only unpacked
+for games that have deltas to apply. A log that holds more than one snapshot per game
+is compacted in the background after the first change to a game, so startup does not
+wait on rewriting it.
+"""
+import asyncio
+import base64
+import gc
+import json
+import logging
+import os
+from typing import Any, Iterable
+from uuid import UUID
+
+from pydantic.json import pydantic_encoder
+
+from server.models.orm.game import JOURNAL_MOVE, GameState, JournalEntry
+from server.utils import board_util
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = 32
+COMPACT_AFTER = 100_000
+# how records written by `_write` start, up to the game id
+_SNAPSHOT_START = b'{"op": "snapshot", "game_id": "'
+_DELTA_START = b'{"op": "delta", "game_id": "'
+_GAME_ID_LENGTH = 36
+
+
+class GameLog:
+
+    _path: str
+    _fsync: bool
+    _snapshot_interval: int
+    _compact_after: int
+    # number of records appended since the log was last compacted
+    _records: int
+    # a compaction is running on a worker thread
+    _compacting: bool
+
+    def __init__(
+        self,
+        path: str,
+        fsync: bool = False,
+        snapshot_interval: int = SNAPSHOT_INTERVAL,
+        compact_after: int = COMPACT_AFTER,
+    ):
+        """
+        By default each record is flushed to the OS but not fsync'd, which is enough
+        to survive the server process crashing. Set `fsync` to also survive the host
+        losing power, at the cost of a disk sync per move.
+        """
+        self._path = path
+        self._fsync = fsync
+        self._snapshot_interval = snapshot_interval
+        self._compact_after = compact_after
+        self._records = 0
+        self._compacting = False
+        # binary, so that offsets into the log are byte offsets
+        self._file = open(self._path, "ab")
+
+    @property
+    def needs_compaction(self) -> bool:
+        return not self._compacting and self._records >= self._compact_after
+
+    def _write(self, record: dict[str, Any]) -> None:
+        self._file.write(json.dumps(record, default=pydantic_encoder).encode() + b"\n")
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+        self._records += 1
+
+    @staticmethod
+    def _snapshot_record(game: GameState) -> dict[str, Any]:
+        return dict(op="snapshot", game_id=game.uuid, seq=game.seq, state=game.compact_dict())
+
+    def record(
+        self,
+        game: GameState,
+        journal: list[JournalEntry] | None = None,
+        event_id: UUID | None = None,
+        delta: dict[str, Any] | None = None,
+    ) -> None:
+        """
+        Append the latest version of a game. If no journal is provided, or the game is
+        due a snapshot, the full state is written instead of a delta. Pass the network
+        delta of the journal if it was already built.
+        """
+        if journal is None or game.seq % self._snapshot_interval == 0:
+            self._write(self._snapshot_record(game))
+            return
+        if delta is None:
+            delta = game.network_delta(journal)
+        move_count = sum(1 for kind, _, _ in journal if kind == JOURNAL_MOVE)
+        self._write(dict(
+            op="delta",
+            game_id=game.uuid,
+            seq=game.seq,
+            event_id=event_id,
+            fields=delta["fields"],
+            cells=delta["cells"],
+            moves=game.move_history[len(game.move_history) - move_count:] if move_count else [],
+        ))
+
+    def record_evict(self, game_id: UUID) -> None:
+        """
+        Mark a game as gone so that it is not recovered.
+        """
+        self._write(dict(op="evict", game_id=game_id))
+
+    def load(self) -> list[GameState]:
+        """
+        Rebuild all games from the log. Records that cannot be applied, such as a torn
+        final line after a crash or a delta without a preceding snapshot, are skipped.
+        """
+        if not os.path.exists(self._path):
+            return []
+        # loading allocates a lot of long lived objects, which would otherwise trigger
+        # repeated full collections that find nothing to free
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load(self) -> list[GameState]:
+        states, records = self._replay()
+        # force a compaction if the log holds anything beyond one snapshot per game
+        self._records = self._compact_after if records > len(states) else 0
+        return [GameState.parse_compact(state) for state in states.values()]
+
+    def _replay(self, end: int | None = None) -> tuple[dict[str, dict[str, Any]], int]:
+        """
+        Read the log up to byte offset `end`, or all of it, into the latest state of
+        each game in the form of `GameState.compact_dict`. Boards and moves are left
+        unpacked for games that had deltas applied. Returns the states by game id
+        and the number of records read.
+        """
+        with open(self._path, "rb") as f:
+            lines = list(f)
+        if end is not None:
+            offset = 0
+            for idx, line in enumerate(lines):
+                offset += len(line)
+                if offset > end:
+                    del lines[idx:]
+                    break
+        # index of the latest snapshot of each game, so that the records before it
+        # are skipped without being decoded
+        latest: dict[bytes, int] = dict()
+        for idx, line in enumerate(lines):
+            # a torn final line must not hide the records before it
+            if line.startswith(_SNAPSHOT_START) and line.endswith(b"\n"):
+                latest[line[len(_SNAPSHOT_START):len(_SNAPSHOT_START) + _GAME_ID_LENGTH]] = idx
+        states: dict[str, dict[str, Any]] = dict()
+        for idx, line in enumerate(lines):
+            for start in (_SNAPSHOT_START, _DELTA_START):
+                if line.startswith(start) and idx < latest.get(line[len(start):len(start) + _GAME_ID_LENGTH], -1):
+                    break
+            else:
+                self._apply(states, line)
+        return states, len(lines)
+
+    @staticmethod
+    def _apply(states: dict[str, dict[str, Any]], line: bytes) -> None:
+        try:
+            record = json.loads(line)
+            game_id, op = record["game_id"], record["op"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logger.warning("Skipping unreadable game log record")
+            return
+        if op == "snapshot":
+            states[game_id] = record["state"]
+            return
+        if op == "evict":
+            states.pop(game_id, None)
+            return
+        state = states.get(game_id)
+        if state is None or record["seq"] <= state["seq"]:
+            return
+        if isinstance(state["board"], str):
+            state["board"] = board_util.unpack_board(base64.b64decode(state["board"]))
+            state["move_history"] = board_util.unpack_moves(base64.b64decode(state["move_history"]))
+        state.update(record["fields"])
+        board = state["board"]
+        for x, y, z, val in record["cells"]:
+            board[x][y][z] = val
+        state["move_history"].extend(record["moves"])
+
+    def compact(self, games: Iterable[GameState]) -> None:
+        """
+        Rewrite the log as a single snapshot per game. The new log is written to a
+        temporary file and swapped in atomically, so a crash during compaction leaves
+        the previous log intact.
+
+        This blocks until the log is rewritten. Running servers use
+        `compact_in_background` instead.
+        """
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for game in games:
+                f.write(json.dumps(self._snapshot_record(game), default=pydantic_encoder).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._swap(tmp_path, None)
+
+    async def compact_in_background(self) -> None:
+        """
+        Rewrite the log as a single snapshot per game without holding up the event
+        loop. The log as it stands now is replayed and rewritten on a worker thread,
+        then the records appended in the meantime are carried over and the new log
+        is swapped in.
+        """
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            self._file.flush()
+            end = self._file.tell()
+            tmp_path = await asyncio.to_thread(self._rewrite, end)
+            self._swap(tmp_path, end)
+        finally:
+            self._compacting = False
+
+    def _rewrite(self, end: int) -> str:
+        states, _ = self._replay(end)
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for game_id, state in states.items():
+                if not isinstance(state["board"], str):
+                    state["board"] = base64.b64encode(board_util.pack_board(state["board"])).decode()
+                    state["move_history"] = base64.b64encode(board_util.pack_moves(state["move_history"])).decode()
+                record = dict(op="snapshot", game_id=game_id, seq=state["seq"], state=state)
+                f.write(json.dumps(record).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def _swap(self, tmp_path: str, end: int | None) -> None:
+        """
+        Replace the log with a rewritten one. If `end` is given, the records appended
+        to the log after that offset are copied to the new log first.
+        """
+        self._file.flush()
+        tail = b""
+        if end is not None:
+            with open(self._path, "rb") as f:
+                f.seek(end)
+                tail = f.read()
+            with open(tmp_path, "ab") as f:
+                f.write(tail)
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self._path)
+        self._file = open(self._path, "ab")
+        self._records = tail.count(b"\n")
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,100 @@
+"""
+Per-game command queue
+
+Each game gets its own queue and a consumer task that runs the commands for that game
+one at a time. Because a game's commands never interleave, a command handler can
+await (for a database write, a bot, etc.) between reading a game and changing it
+without another command changing it in the meantime. The change itself is still made
+in a single game context with no await inside it, as readers of the game do not go
+through its queue. Different games have different consumers and proceed concurrently.
+
+Queues are bounded. When a game's backlog is full, new commands are rejected
+immediately instead of queueing up behind work the client will likely give up on.
+"""
+import asyncio
+import inspect
+import time
+from typing import Any, Awaitable, Callable
+from uuid import UUID
+
+from server.core.metrics import Histogram
+
+MAX_QUEUE_DEPTH = 64
+
+Handler = Callable[[], Any | Awaitable[Any]]
+
+
+class GameQueueFull(Exception):
+    """
+    Raised when a command is submitted to a game whose backlog is full.
+    """
+
+
+class GameQueue:
+
+    game_id: UUID
+    _queue: asyncio.Queue
+    _task: asyncio.Task | None
+    # time from submission to completion of each command, in milliseconds
+    _latency: Histogram
+
+    def __init__(self, game_id: UUID, latency: Histogram, max_depth: int = MAX_QUEUE_DEPTH):
+        self.game_id = game_id
+        self._queue = asyncio.Queue(maxsize=max_depth)
+        self._task = None
+        self._latency = latency
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # fail anything still waiting so callers do not hang
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(asyncio.CancelledError())
+
+    def submit(self, handler: Handler) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((handler, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise GameQueueFull(f"Too many pending commands for game {self.game_id}")
+        return future
+
+    async def run(self):
+        while True:
+            handler, future, submitted_at = await self._queue.get()
+            if future.cancelled():
+                continue
+            await self._execute(handler, future)
+            self._latency.observe((time.perf_counter() - submitted_at) * 1000.0)
+
+    @staticmethod
+    async def _execute(handler: Handler, future: asyncio.Future):
+        # errors are caught here rather than in `run`, so that the tracebacks handed
+        # to submitters do not hold the frame of the long-lived consumer. clearing a
+        # traceback's frames finalizes any suspended coroutine among them.
+        try:
+            result = handler()
+            if inspect.isawaitable(result):
+                result = await result
+        except asyncio.CancelledError:
+            future.cancel()
+            # only stopping the queue stops the consumer. a handler cancelled for its
+            # own reasons, such as a timeout, fails like any other.
+            if asyncio.current_task().cancelling():
+                raise
+        except BaseException as exc:
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(result)
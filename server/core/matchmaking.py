@@ -0,0 +1,223 @@
+"""
+Rating-aware matchmaking
+
+Players waiting for a game are kept in a list sorted by rating, so the closest rated
+opponent of any player is one of their two neighbours. Each player accepts opponents
+within a rating window that starts narrow and widens the longer they wait. Two
+neighbours are paired once each is within the other's window, and get a game with
+both of them already seated.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from typing import Callable
+from uuid import UUID
+
+from sortedcontainers import SortedList
+
+from server.core.game import GameManager
+from server.core.metrics import Histogram
+from server.models.dto.matchmaking import MatchmakingStatus
+
+logger = logging.getLogger(__name__)
+
+INITIAL_WINDOW = 50.0
+# rating points added to the window per second of waiting
+WINDOW_GROWTH = 10.0
+MAX_WINDOW = 400.0
+MATCH_INTERVAL = 1.0
+# upper bounds in seconds
+WAIT_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class QueuedPlayer:
+
+    __slots__ = ("user_id", "rating", "enqueued_at", "seq")
+
+    user_id: UUID
+    rating: float
+    enqueued_at: float
+    # breaks ties between equal ratings, in queue order
+    seq: int
+
+    def __init__(self, user_id: UUID, rating: float, enqueued_at: float, seq: int):
+        self.user_id = user_id
+        self.rating = rating
+        self.enqueued_at = enqueued_at
+        self.seq = seq
+
+    @property
+    def key(self) -> tuple[float, int]:
+        return (self.rating, self.seq)
+
+
+class Matchmaker:
+
+    _game_manager: GameManager
+    _rating_lookup: Callable[[UUID], float]
+    _clock: Callable[[], float]
+    _initial_window: float
+    _window_growth: float
+    _max_window: float
+    _interval: float
+    # queued players ordered by (rating, seq)
+    _ladder: SortedList
+    _by_key: dict[tuple[float, int], QueuedPlayer]
+    _by_user: dict[UUID, QueuedPlayer]
+    _seq: itertools.count
+    # games found for players, until the game is evicted
+    _matches: dict[UUID, UUID]
+    _match_users: dict[UUID, tuple[UUID, UUID]]
+    # seconds from joining the queue to getting a game
+    wait_times: Histogram
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        game_manager: GameManager,
+        rating_lookup: Callable[[UUID], float],
+        initial_window: float = INITIAL_WINDOW,
+        window_growth: float = WINDOW_GROWTH,
+        max_window: float = MAX_WINDOW,
+        interval: float = MATCH_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._game_manager = game_manager
+        self._rating_lookup = rating_lookup
+        self._clock = clock
+        self._initial_window = initial_window
+        self._window_growth = window_growth
+        self._max_window = max_window
+        self._interval = interval
+        self._ladder = SortedList()
+        self._by_key = dict()
+        self._by_user = dict()
+        self._seq = itertools.count()
+        self._matches = dict()
+        self._match_users = dict()
+        self.wait_times = Histogram(WAIT_BUCKETS)
+        self._task = None
+        self._game_manager.register_evict_subscriber(self._forget_game)
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+    def window(self, player: QueuedPlayer, now: float) -> float:
+        return min(self._max_window, self._initial_window + self._window_growth * (now - player.enqueued_at))
+
+    def join(self, user_id: UUID) -> MatchmakingStatus:
+        """
+        Queue a player, and pair them right away if a close enough opponent is
+        waiting. Joining again while queued is a no-op.
+        """
+        if user_id not in self._by_user:
+            self._forget_match(user_id)
+            player = QueuedPlayer(user_id, self._rating_lookup(user_id), self._clock(), next(self._seq))
+            self._by_user[user_id] = player
+            self._by_key[player.key] = player
+            self._ladder.add(player.key)
+            self._try_match(player, self._clock())
+        return self.status(user_id)
+
+    def leave(self, user_id: UUID) -> bool:
+        player = self._by_user.get(user_id)
+        if player is None:
+            return False
+        self._remove(player)
+        return True
+
+    def status(self, user_id: UUID) -> MatchmakingStatus:
+        player = self._by_user.get(user_id)
+        if player is None:
+            return MatchmakingStatus(queued=False, game_id=self._matches.get(user_id))
+        now = self._clock()
+        return MatchmakingStatus(
+            queued=True,
+            rating=player.rating,
+            waited_seconds=now - player.enqueued_at,
+            window=self.window(player, now),
+        )
+
+    def _remove(self, player: QueuedPlayer) -> None:
+        self._ladder.remove(player.key)
+        del self._by_key[player.key]
+        del self._by_user[player.user_id]
+
+    def _neighbours(self, player: QueuedPlayer) -> list[QueuedPlayer]:
+        idx = self._ladder.index(player.key)
+        neighbours = []
+        if idx > 0:
+            neighbours.append(self._by_key[self._ladder[idx - 1]])
+        if idx + 1 < len(self._ladder):
+            neighbours.append(self._by_key[self._ladder[idx + 1]])
+        return neighbours
+
+    def _try_match(self, player: QueuedPlayer, now: float) -> UUID | None:
+        window = self.window(player, now)
+        best = None
+        for other in self._neighbours(player):
+            gap = abs(other.rating - player.rating)
+            if gap > window or gap > self.window(other, now):
+                continue
+            if best is None or gap < abs(best.rating - player.rating):
+                best = other
+        if best is None:
+            return None
+        return self._pair(best, player, now) if best.seq < player.seq else self._pair(player, best, now)
+
+    def _pair(self, first: QueuedPlayer, second: QueuedPlayer, now: float) -> UUID:
+        # the player who waited longer hosts
+        self._remove(first)
+        self._remove(second)
+        game = self._game_manager.create_game(first.user_id, opponent_id=second.user_id)
+        for player in (first, second):
+            self.wait_times.observe(now - player.enqueued_at)
+            self._matches[player.user_id] = game.uuid
+        self._match_users[game.uuid] = (first.user_id, second.user_id)
+        logger.debug(f"Matched {first.user_id} ({first.rating}) with {second.user_id} ({second.rating})")
+        return game.uuid
+
+    def match(self) -> int:
+        """
+        Try to pair every queued player, longest waiting first. Returns the number
+        of games created.
+        """
+        now = self._clock()
+        created = 0
+        # players are kept in the order they joined
+        for player in list(self._by_user.values()):
+            if player.user_id in self._by_user and self._try_match(player, now) is not None:
+                created += 1
+        return created
+
+    def _forget_match(self, user_id: UUID) -> None:
+        game_id = self._matches.pop(user_id, None)
+        if game_id is not None:
+            users = self._match_users.get(game_id, ())
+            if not any(user in self._matches for user in users):
+                self._match_users.pop(game_id, None)
+
+    def _forget_game(self, game_id: UUID) -> None:
+        for user_id in self._match_users.pop(game_id, ()):
+            if self._matches.get(user_id) == game_id:
+                del self._matches[user_id]
+
+    def metrics(self) -> dict[str, object]:
+        return dict(queued=len(self._by_user), wait_seconds=self.wait_times.summary())
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                self.match()
+            except Exception:
+                logger.exception("Matchmaking pass failed")
@@ -0,0 +1,66 @@
+"""
+In-process metrics
+
+These are kept deliberately simple: fixed bucket histograms that are cheap to update
+on hot paths and can be summarized for the metrics endpoint.
+"""
+import bisect
+
+# upper bounds in milliseconds
+DEFAULT_BUCKETS_MS = (
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0,
+    1000.0, 2500.0, 5000.0, 10000.0, 30000.0, 60000.0,
+)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram. Quantiles are estimated as the upper bound of the bucket
+    the quantile falls in, so they are never optimistic.
+    """
+
+    _bounds: tuple[float, ...]
+    # one count per bound, plus one for values above the last bound
+    _counts: list[int]
+    count: int
+    total: float
+    max: float
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BUCKETS_MS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self._bounds[idx] if idx < len(self._bounds) else self.max
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else 0.0,
+            p50=self.quantile(0.5),
+            p95=self.quantile(0.95),
+            p99=self.quantile(0.99),
+            max=self.max,
+        )
+
+    def buckets(self) -> dict[str, int]:
+        labels = [str(bound) for bound in self._bounds] + ["inf"]
+        return dict(zip(labels, self._counts))
@@ -0,0 +1,211 @@
+"""
+Rate limiting and load shedding
+
+Each client gets a token bucket per route group, keyed by its address and, on groups
+that require a session, by the user id of its access token. A request takes one
+token, and tokens refill at the group's rate up to its burst. Clients without tokens
+are answered 429 before any work is done. Buckets are kept least recently used first up to a fixed number, so
+memory stays bounded however many clients show up. A client whose bucket was dropped
+starts again with a full one, which is what it would have had after idling anyway.
+
+Separately, a load monitor samples how late the event loop runs and how much work is
+waiting for the request thread pool and the game queues. While any of them is past its
+threshold, limited routes are answered 503 so the server can catch up.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import anyio.to_thread
+
+from server.core.game import GameManager
+
+logger = logging.getLogger(__name__)
+
+MAX_BUCKETS = 100000
+SAMPLE_INTERVAL = 0.1
+# seconds the event loop may run behind
+MAX_LOOP_LAG = 0.25
+# requests waiting for a thread to run a sync route or dependency
+MAX_THREAD_POOL_WAITING = 50
+# commands waiting across every game queue
+MAX_GAME_QUEUE_DEPTH = 5000
+
+
+class Budget:
+
+    __slots__ = ("rate", "burst")
+
+    # tokens added per second
+    rate: float
+    # most tokens a bucket holds
+    burst: float
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+
+# route groups to the budget of each client
+ROUTE_BUDGETS = {
+    # each of these writes and rebuilds the ratings
+    "match": Budget(0.5, 5),
+    "player": Budget(1, 10),
+    "summary": Budget(5, 20),
+    "game": Budget(10, 30),
+    "matchmaking": Budget(2, 10),
+    # holds login, so it is keyed by address only, and many users may share one
+    "session": Budget(5, 50),
+    "auth": Budget(0.2, 5),
+}
+DEFAULT_BUDGET = Budget(5, 20)
+
+
+class TokenBucket:
+
+    __slots__ = ("tokens", "updated_at")
+
+    tokens: float
+    updated_at: float
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+
+    _budgets: dict[str, Budget]
+    _max_buckets: int
+    _clock: Callable[[], float]
+    # map of (route group, client key) to its bucket, least recently used first
+    _buckets: OrderedDict[tuple[str, str], TokenBucket]
+    # requests turned away
+    limited: int
+
+    def __init__(
+        self,
+        budgets: dict[str, Budget] | None = None,
+        max_buckets: int = MAX_BUCKETS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._budgets = budgets if budgets is not None else ROUTE_BUDGETS
+        self._max_buckets = max_buckets
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self.limited = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, route: str, key: str) -> float:
+        """
+        Take a token from the client's bucket for a route group. Returns 0 if there
+        was one, otherwise the seconds until there will be.
+        """
+        budget = self._budgets.get(route, DEFAULT_BUDGET)
+        now = self._clock()
+        bucket = self._buckets.get((route, key))
+        if bucket is None:
+            bucket = self._buckets[(route, key)] = TokenBucket(budget.burst, now)
+            if len(self._buckets) > self._max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end((route, key))
+            bucket.tokens = min(budget.burst, bucket.tokens + (now - bucket.updated_at) * budget.rate)
+            bucket.updated_at = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        self.limited += 1
+        return (1 - bucket.tokens) / budget.rate
+
+    def metrics(self) -> dict[str, int]:
+        return dict(buckets=len(self._buckets), limited=self.limited)
+
+
+class LoadMonitor:
+
+    _game_manager: GameManager
+    _interval: float
+    _max_loop_lag: float
+    _max_thread_pool_waiting: int
+    _max_game_queue_depth: int
+    # latest samples
+    loop_lag: float
+    thread_pool_waiting: int
+    game_queue_depth: int
+    overloaded: bool
+    # requests turned away while overloaded
+    shed: int
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        game_manager: GameManager,
+        interval: float = SAMPLE_INTERVAL,
+        max_loop_lag: float = MAX_LOOP_LAG,
+        max_thread_pool_waiting: int = MAX_THREAD_POOL_WAITING,
+        max_game_queue_depth: int = MAX_GAME_QUEUE_DEPTH,
+    ):
+        self._game_manager = game_manager
+        self._interval = interval
+        self._max_loop_lag = max_loop_lag
+        self._max_thread_pool_waiting = max_thread_pool_waiting
+        self._max_game_queue_depth = max_game_queue_depth
+        self.loop_lag = 0.0
+        self.thread_pool_waiting = 0
+        self.game_queue_depth = 0
+        self.overloaded = False
+        self.shed = 0
+        self._task = None
+
+    def sample(self, loop_lag: float) -> bool:
+        """
+        Record how late the event loop ran and check the queues. Returns whether the
+        server is overloaded. Must be called on the event loop.
+        """
+        self.loop_lag = loop_lag
+        self.thread_pool_waiting = anyio.to_thread.current_default_thread_limiter().statistics().tasks_waiting
+        self.game_queue_depth = self._game_manager.queue_depth()
+        overloaded = (
+            loop_lag > self._max_loop_lag
+            or self.thread_pool_waiting > self._max_thread_pool_waiting
+            or self.game_queue_depth > self._max_game_queue_depth
+        )
+        if overloaded and not self.overloaded:
+            logger.warning(
+                f"Shedding load: loop lag {loop_lag:.3f}s, {self.thread_pool_waiting} waiting for threads, "
+                f"{self.game_queue_depth} queued game commands"
+            )
+        self.overloaded = overloaded
+        return overloaded
+
+    def metrics(self) -> dict[str, object]:
+        return dict(
+            overloaded=self.overloaded,
+            loop_lag=self.loop_lag,
+            thread_pool_waiting=self.thread_pool_waiting,
+            game_queue_depth=self.game_queue_depth,
+            shed=self.shed,
+        )
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self._interval)
+            try:
+                self.sample(max(0.0, loop.time() - started - self._interval))
+            except Exception:
+                logger.exception("Load sample failed")
@@ -0,0 +1,99 @@
+"""
+Ratings shared between worker processes
+
+Each worker process keeps its own copy of the rating state, and a match or player
+recorded through one worker only updates that worker's copy. When the server runs as
+more than one worker, each polls the database and catches its copy up with whatever
+the others recorded, so summaries and matchmaking ratings on any worker are at most
+one interval behind. Polling is cheap while nothing changed: a few counts and the
+newest match are compared with the cached state.
+
+The same loop writes the ratings snapshot that the server starts from on boot. A
+rating update only bumps the version of the cached state, and the snapshot is
+rewritten off the event loop at most once per interval when the version moved, so
+neither rating updates nor the event loop wait on the disk.
+"""
+import asyncio
+import logging
+from typing import Any
+
+from sqlalchemy.orm import sessionmaker
+
+from server.utils import tabulation_util
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = 1.0
+
+
+class RatingSync:
+
+    _sessionmaker: sessionmaker
+    _cache: dict[Any, Any]
+    _interval: float
+    _shared: bool
+    _snapshot_path: str | None
+    _snapshot_version: int | None
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        sessionmaker: sessionmaker,
+        cache: dict[Any, Any],
+        interval: float = SYNC_INTERVAL,
+        shared: bool = True,
+        snapshot_path: str | None = None,
+    ):
+        self._sessionmaker = sessionmaker
+        self._cache = cache
+        self._interval = interval
+        # other workers record ratings too
+        self._shared = shared
+        self._snapshot_path = snapshot_path
+        self._snapshot_version = None
+        self._task = None
+
+    def _catch_up(self) -> None:
+        db = self._sessionmaker()
+        try:
+            tabulation_util.catch_up(self._cache, db)
+        finally:
+            db.close()
+
+    async def sync(self) -> None:
+        """
+        Apply matches and players recorded since the cached state was last updated.
+        """
+        await asyncio.to_thread(self._catch_up)
+
+    async def save_snapshot(self) -> None:
+        """
+        Write the ratings snapshot if the cached state changed since it was last written.
+        """
+        if self._snapshot_path is None:
+            return
+        try:
+            self._snapshot_version = await asyncio.to_thread(
+                tabulation_util.save_snapshot, self._cache, self._snapshot_path, self._snapshot_version,
+            )
+        except OSError:
+            # tried again on the next interval
+            logger.exception("Failed to write the ratings snapshot")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._shared:
+                try:
+                    await self.sync()
+                except Exception:
+                    logger.exception("Failed to catch up with the recorded ratings")
+            await self.save_snapshot()
@@ -0,0 +1,177 @@
+"""
+Recording online games in the Elo ledger
+
+Games that finish with a winner are queued as results as soon as they end. A
+background task writes queued results to the match table in batches, one
+transaction per batch, and applies each batch to the cached ratings in the same
+pass. A burst of finished games then costs one commit and one summary render per
+batch rather than a commit and a full rebuild per game.
+
+Results are recorded under the names of the players' sessions, looked up when the
+game ends, while both players are most likely still logged in. Results that cannot
+be recorded yet, because a name is not known or does not belong to a player, are
+kept and retried on each interval instead of being dropped.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Callable
+from uuid import UUID
+
+from sqlalchemy.orm.session import Session
+
+from server.core.game import GameManager
+from server.models.orm.game import GameState, Phase
+from server.utils import tabulation_util
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 500
+
+# (game id, winner user id, loser user id, finished at, winner name, loser name),
+# with None for names that were not known when the game ended
+Result = tuple[UUID, UUID, UUID, datetime, str | None, str | None]
+
+
+class ResultSink:
+
+    _sessionmaker: Callable[[], Session]
+    _cache: dict[Any, Any]
+    # name of the player a user plays as, None for unknown users
+    _player_name_lookup: Callable[[UUID], str | None]
+    _interval: float
+    _batch_size: int
+    _pending: list[Result]
+    # results that could not be recorded yet, queued again on the next interval
+    _unresolved: list[Result]
+    # games whose result has been queued. entries are dropped when the game is
+    # evicted, after which it cannot change anymore.
+    _queued_games: set[UUID]
+    recorded: int
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        game_manager: GameManager,
+        sessionmaker: Callable[[], Session],
+        cache: dict[Any, Any],
+        player_name_lookup: Callable[[UUID], str | None],
+        interval: float = FLUSH_INTERVAL,
+        batch_size: int = BATCH_SIZE,
+    ):
+        self._sessionmaker = sessionmaker
+        self._cache = cache
+        self._player_name_lookup = player_name_lookup
+        self._interval = interval
+        self._batch_size = batch_size
+        self._pending = list()
+        self._unresolved = list()
+        self._queued_games = set()
+        self.recorded = 0
+        self._task = None
+        game_manager.register_subscriber(self.on_game_update)
+        game_manager.register_evict_subscriber(self._queued_games.discard)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def unresolved(self) -> int:
+        return len(self._unresolved)
+
+    def on_game_update(self, game: GameState) -> None:
+        if game.phase != Phase.FINISHED or game.winner not in (1, 2) or game.uuid in self._queued_games:
+            return
+        winner, loser = game.white_player_id, game.black_player_id
+        if game.winner == 2:
+            winner, loser = loser, winner
+        if winner is None or loser is None or winner == loser:
+            return
+        self._queued_games.add(game.uuid)
+        self._pending.append((
+            game.uuid,
+            winner,
+            loser,
+            game.finished_at or datetime.utcnow(),
+            self._player_name_lookup(winner),
+            self._player_name_lookup(loser),
+        ))
+
+    def _write_batch(self, results: list[tuple[str, str, datetime]]) -> list[tuple[str, str, datetime]]:
+        db = self._sessionmaker()
+        try:
+            return tabulation_util.apply_matches(self._cache, db, results)
+        finally:
+            db.close()
+
+    def retry_unresolved(self) -> None:
+        """
+        Queue the results that could not be recorded yet for the next flush.
+        """
+        self._pending.extend(self._unresolved)
+        self._unresolved = list()
+
+    async def flush(self) -> int:
+        """
+        Record the results queued so far, up to one batch. Returns the number of
+        results recorded.
+        """
+        batch = self._pending[:self._batch_size]
+        if not batch:
+            return 0
+        del self._pending[:len(batch)]
+        # results to record, and the queued results they came from
+        results, recording = list(), list()
+        unresolved = list()
+        for game_id, winner, loser, finished_at, winner_name, loser_name in batch:
+            winner_name = winner_name or self._player_name_lookup(winner)
+            loser_name = loser_name or self._player_name_lookup(loser)
+            result = (game_id, winner, loser, finished_at, winner_name, loser_name)
+            if winner_name is None or loser_name is None:
+                unresolved.append(result)
+            elif winner_name == loser_name:
+                logger.warning(f"Not recording game {game_id}, both of its players are named {winner_name}")
+            else:
+                results.append((winner_name, loser_name, finished_at))
+                recording.append(result)
+        recorded = 0
+        if results:
+            try:
+                unknown = set(await asyncio.to_thread(self._write_batch, results))
+            except Exception:
+                # put the batch back so it is retried on the next flush
+                self._pending[:0] = batch
+                raise
+            # whether a result is recorded only depends on its names
+            for result, queued in zip(results, recording):
+                if result in unknown:
+                    unresolved.append(queued)
+                else:
+                    recorded += 1
+        if unresolved:
+            logger.warning(f"Keeping {len(unresolved)} game results whose players are not known yet")
+            self._unresolved.extend(unresolved)
+        self.recorded += recorded
+        return len(batch)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._unresolved:
+            logger.warning(f"{len(self._unresolved)} game results were never recorded, their players are not known")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.retry_unresolved()
+            try:
+                while await self.flush() == self._batch_size:
+                    pass
+            except Exception:
+                logger.exception("Failed to record game results")
@@ -0,0 +1,180 @@
+"""
+Durable user sessions
+
+User sessions otherwise live only in memory. Access tokens are checked by their
+signature alone, so they stay valid across a restart, but the session behind a token
+is what ties the user to the player name they logged in with. Without it, a restarted
+server no longer knows whose ratings a user's games count for until the user logs in
+again. With a session store, sessions are also kept in a local SQLite file.
+
+Writes are queued and flushed in the background, one transaction per flush, so logins
+never wait on the disk. Logins queue sessions from the request thread pool while
+flushes run on the event loop, so the queue is guarded by a lock. Nothing is loaded
+at startup: a session is read from the file the first time it is looked up after a
+restart, and the session manager keeps it in memory from then on.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from server.models.orm.user_session import UserSession
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(when: datetime) -> float:
+    # naive datetimes in the server are utc
+    return (when - _EPOCH).total_seconds()
+
+
+class SessionStore:
+
+    _path: str
+    # reads happen on the event loop and writes on a worker thread, each on their own
+    # connection so that neither waits on the other
+    _read_conn: sqlite3.Connection
+    _write_conn: sqlite3.Connection
+    _interval: float
+    # guards the sessions waiting to be written and being written
+    _lock: threading.Lock
+    # sessions waiting to be written, by user. users have at most one session.
+    _pending: dict[UUID, UserSession]
+    # sessions being written by the current flush
+    _writing: dict[UUID, UserSession]
+    written: int
+    _task: asyncio.Task | None
+
+    def __init__(self, path: str, interval: float = FLUSH_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._write_conn = self._connect()
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_sessions ("
+            "user_id TEXT PRIMARY KEY, session_id TEXT NOT NULL UNIQUE, name TEXT NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+        self._read_conn = self._connect()
+        self._pending = dict()
+        self._writing = dict()
+        self.written = 0
+        self._task = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        # losing the last moments of writes on a power cut only costs those users a login
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def put(self, user_session: UserSession) -> None:
+        """
+        Queue a session to be written, replacing any previous session of the user.
+        Safe to call from any thread.
+        """
+        with self._lock:
+            self._pending[user_session.user_id] = user_session
+
+    def _load(self, column: str, key: UUID) -> UserSession | None:
+        row = self._read_conn.execute(
+            f"SELECT user_id, session_id, name, expires_at FROM user_sessions WHERE {column} = ?", (key.hex,)
+        ).fetchone()
+        if row is None:
+            return None
+        user_id, session_id, name, expires_at = row
+        return UserSession(
+            uuid=UUID(session_id),
+            user_id=UUID(user_id),
+            name=name,
+            expires_at=_EPOCH + timedelta(seconds=expires_at),
+        )
+
+    def _unwritten(self, user_id: UUID) -> UserSession | None:
+        with self._lock:
+            return self._pending.get(user_id) or self._writing.get(user_id)
+
+    def load_user(self, user_id: UUID) -> UserSession | None:
+        return self._unwritten(user_id) or self._load("user_id", user_id)
+
+    def load_session(self, session_id: UUID) -> UserSession | None:
+        with self._lock:
+            unwritten = [*self._pending.values(), *self._writing.values()]
+        for user_session in unwritten:
+            if user_session.uuid == session_id:
+                return user_session
+        user_session = self._load("session_id", session_id)
+        if user_session is not None and self._unwritten(user_session.user_id) is not None:
+            # replaced by a login that is not written yet
+            return None
+        return user_session
+
+    def _write(self, sessions: list[UserSession]) -> None:
+        now = _timestamp(datetime.utcnow())
+        conn = self._write_conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_sessions (user_id, session_id, name, expires_at) VALUES (?, ?, ?, ?)",
+                [(s.user_id.hex, s.uuid.hex, s.name, _timestamp(s.expires_at)) for s in sessions],
+            )
+            conn.execute("DELETE FROM user_sessions WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def flush(self) -> int:
+        """
+        Write every queued session. Returns the number written.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            # sessions queued from now on go to a new dict, so the batch no longer
+            # changes once it is taken
+            batch = self._writing = self._pending
+            self._pending = dict()
+            sessions = list(batch.values())
+        try:
+            await asyncio.to_thread(self._write, sessions)
+        except Exception:
+            with self._lock:
+                # put the batch back, behind sessions queued since, so it is retried
+                batch.update(self._pending)
+                self._pending = batch
+            raise
+        finally:
+            with self._lock:
+                self._writing = dict()
+        self.written += len(batch)
+        return len(batch)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write user sessions")
+
+    def close(self) -> None:
+        self._read_conn.close()
+        self._write_conn.close()
@@ -0,0 +1,184 @@
+"""
+Game sharding
+
+A single server process holds every live game in memory, so live games are limited
+to one CPU core. In sharded mode the server runs N worker processes, each owning a
+disjoint set of game ids. Ownership is decided by a consistent hash ring over the
+configured worker ids, so every worker can compute the owner of any game without
+asking anyone.
+
+Requests for a game owned by another worker are redirected to the owner. Worker
+addresses and game codes are shared through a coordinator. The coordinator here is
+a local SQLite file, which is enough for workers on one host and needs no outside
+service. Game codes are claimed in the coordinator so that they are unique across
+workers, and so that any worker can resolve a code to a game id.
+"""
+import bisect
+import hashlib
+import sqlite3
+import time
+from uuid import UUID, uuid4
+
+RING_REPLICAS = 64
+# websocket close code used to send a client to the worker that owns its game, when
+# the server cannot answer the handshake with an http redirect
+WS_CLOSE_REDIRECT = 4307
+
+
+def _hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def worker_id_for_index(index: int) -> str:
+    return f"worker-{index}"
+
+
+class HashRing:
+    """
+    Consistent hash ring. Each worker is placed on the ring `replicas` times to
+    even out the share of keys each one owns.
+    """
+
+    _points: list[int]
+    _owners: list[str]
+
+    def __init__(self, worker_ids: list[str], replicas: int = RING_REPLICAS):
+        if not worker_ids:
+            raise ValueError("Hash ring needs at least one worker")
+        points = sorted(
+            (_hash(f"{worker_id}#{replica}".encode()), worker_id)
+            for worker_id in worker_ids
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [owner for _, owner in points]
+
+    def owner(self, key: UUID) -> str:
+        idx = bisect.bisect(self._points, _hash(key.bytes))
+        if idx == len(self._points):
+            idx = 0
+        return self._owners[idx]
+
+
+class ShardCoordinator:
+    """
+    SQLite stand-in for a coordination service. Every operation is a single short
+    transaction, and SQLite serializes writers across processes.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker_id TEXT PRIMARY KEY, address TEXT NOT NULL, registered_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS game_codes ("
+            "code TEXT PRIMARY KEY, game_id TEXT NOT NULL, worker_id TEXT NOT NULL)"
+        )
+
+    def register_worker(self, worker_id: str, address: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, address, registered_at) VALUES (?, ?, ?)",
+            (worker_id, address, time.time()),
+        )
+
+    def get_worker_address(self, worker_id: str) -> str | None:
+        row = self._conn.execute("SELECT address FROM workers WHERE worker_id = ?", (worker_id,)).fetchone()
+        return row[0] if row else None
+
+    def claim_code(self, code: str, game_id: UUID, worker_id: str) -> bool:
+        """
+        Claim a game code for a game. Returns False if another game holds it.
+        """
+        try:
+            self._conn.execute(
+                "INSERT INTO game_codes (code, game_id, worker_id) VALUES (?, ?, ?)",
+                (code, game_id.hex, worker_id),
+            )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def lookup_code(self, code: str) -> UUID | None:
+        row = self._conn.execute("SELECT game_id FROM game_codes WHERE code = ?", (code,)).fetchone()
+        return UUID(row[0]) if row else None
+
+    def release_code(self, code: str, game_id: UUID) -> None:
+        self._conn.execute("DELETE FROM game_codes WHERE code = ? AND game_id = ?", (code, game_id.hex))
+
+    def release_worker_codes(self, worker_id: str, keep: set[str]) -> None:
+        """
+        Drop the codes a worker holds for games it no longer has, for example
+        after it restarts without some of its games.
+        """
+        rows = self._conn.execute("SELECT code FROM game_codes WHERE worker_id = ?", (worker_id,)).fetchall()
+        for (code,) in rows:
+            if code not in keep:
+                self._conn.execute("DELETE FROM game_codes WHERE code = ? AND worker_id = ?", (code, worker_id))
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class ShardRouter:
+    """
+    A worker's view of the shards: which games it owns and where to send requests
+    for the games it does not.
+    """
+
+    worker_id: str
+    _ring: HashRing
+    _coordinator: ShardCoordinator
+    # worker addresses do not change while the cluster is up
+    _addresses: dict[str, str]
+
+    def __init__(self, worker_id: str, worker_ids: list[str], coordinator: ShardCoordinator):
+        if worker_id not in worker_ids:
+            raise ValueError(f"Worker {worker_id} is not one of the configured workers")
+        self.worker_id = worker_id
+        self._ring = HashRing(worker_ids)
+        self._coordinator = coordinator
+        self._addresses = dict()
+
+    @property
+    def coordinator(self) -> ShardCoordinator:
+        return self._coordinator
+
+    def owner(self, game_id: UUID) -> str:
+        return self._ring.owner(game_id)
+
+    def owns(self, game_id: UUID) -> bool:
+        return self._ring.owner(game_id) == self.worker_id
+
+    def owner_address(self, game_id: UUID) -> str | None:
+        owner = self._ring.owner(game_id)
+        address = self._addresses.get(owner)
+        if address is None:
+            address = self._coordinator.get_worker_address(owner)
+            if address is not None:
+                self._addresses[owner] = address
+        return address
+
+    def owner_url(self, game_id: UUID, path: str, query: str = "", websocket: bool = False) -> str | None:
+        """
+        Rewrite a request path to point at the worker that owns the game.
+        """
+        address = self.owner_address(game_id)
+        if address is None:
+            return None
+        if websocket:
+            address = address.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+        return f"{address}{path}?{query}" if query else f"{address}{path}"
+
+    def new_game_id(self) -> UUID:
+        """
+        Generate a game id owned by this worker, so that games are always created on
+        the worker that receives the request. With N workers this takes N tries on
+        average.
+        """
+        while True:
+            game_id = uuid4()
+            if self.owns(game_id):
+                return game_id
@@ -0,0 +1,227 @@
+"""
+Hierarchical timing wheel
+
+Game timers (host connection timeouts, idle expiry, move clocks) are numerous, mostly
+cancelled before they fire, and do not need sub-tick precision. Giving each one its own
+task costs a task and an event loop timer per game. A timing wheel keeps every timer in a
+slot of a ring of buckets instead, driven by a single task that advances one tick at a
+time. Scheduling and cancelling are O(1).
+
+Level 0 has one slot per tick. Each higher level has slots that are 2**slot_bits times
+wider than the level below, and a timer is kept in the lowest level that can hold its
+deadline. When the ticks wrap around a level, the next slot of the level above is
+cascaded down, so a timer moves down at most once per level before it fires.
+"""
+import asyncio
+import inspect
+import logging
+import math
+import time
+from functools import partial
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+TICK_SECONDS = 0.05
+SLOT_BITS = 6
+LEVELS = 4
+# tolerance for float error when converting times to ticks
+_EPSILON = 1e-9
+
+
+class Timer:
+    """
+    Handle for a scheduled callback.
+    """
+
+    __slots__ = ("deadline", "callback", "args", "_wheel", "_expiry", "_bucket")
+
+    deadline: float
+    callback: Callable[..., Any]
+    args: tuple[Any, ...]
+    _wheel: "TimerWheel"
+    # tick at which the timer fires
+    _expiry: int
+    # the bucket holding the timer, None once it fired or was cancelled
+    _bucket: dict["Timer", None] | None
+
+    def __init__(
+        self,
+        wheel: "TimerWheel",
+        deadline: float,
+        expiry: int,
+        callback: Callable[..., Any],
+        args: tuple[Any, ...],
+    ):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._expiry = expiry
+        self._bucket = None
+
+    @property
+    def active(self) -> bool:
+        return self._bucket is not None
+
+    def cancel(self) -> None:
+        if self._bucket is not None:
+            del self._bucket[self]
+            self._bucket = None
+            self._wheel._count -= 1
+
+
+class TimerWheel:
+
+    _tick: float
+    _clock: Callable[[], float]
+    _origin: float
+    # last tick that was processed
+    _current: int
+    _bits: int
+    _mask: int
+    # buckets are dicts used as insertion-ordered sets, so timers in a slot fire in
+    # the order they were scheduled
+    _levels: list[list[dict[Timer, None]]]
+    # timers past the range of the top level
+    _overflow: dict[Timer, None]
+    # number of pending timers
+    _count: int
+    # tasks running the awaitables returned by callbacks. the event loop only keeps
+    # weak references to tasks, so they are held here until they finish.
+    _callbacks: set[asyncio.Task]
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        tick: float = TICK_SECONDS,
+        slot_bits: int = SLOT_BITS,
+        levels: int = LEVELS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._tick = tick
+        self._clock = clock
+        self._origin = clock()
+        self._current = 0
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._levels = [[dict() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self._overflow = dict()
+        self._count = 0
+        self._callbacks = set()
+        self._task = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def now(self) -> float:
+        """
+        Current time of the clock timers are scheduled against.
+        """
+        return self._clock()
+
+    def schedule(self, delay: float, callback: Callable[..., Any], *args: Any) -> Timer:
+        """
+        Call `callback(*args)` once `delay` seconds have passed. The callback runs on
+        the first tick at or after its deadline. If it returns an awaitable, that is
+        run as a task.
+        """
+        deadline = self._clock() + max(delay, 0.0)
+        expiry = max(math.ceil((deadline - self._origin) / self._tick - _EPSILON), self._current + 1)
+        timer = Timer(self, deadline, expiry, callback, args)
+        self._insert(timer)
+        self._count += 1
+        self._ensure_running()
+        return timer
+
+    def _insert(self, timer: Timer) -> None:
+        delta = timer._expiry - self._current
+        for level, buckets in enumerate(self._levels):
+            if delta < 1 << (self._bits * (level + 1)):
+                bucket = buckets[(timer._expiry >> (self._bits * level)) & self._mask]
+                break
+        else:
+            bucket = self._overflow
+        bucket[timer] = None
+        timer._bucket = bucket
+
+    def advance(self, now: float | None = None) -> int:
+        """
+        Process every tick up to `now` and run the timers that are due. Returns the
+        number of timers that fired.
+        """
+        if now is None:
+            now = self._clock()
+        target = math.floor((now - self._origin) / self._tick + _EPSILON)
+        if target <= self._current:
+            return 0
+        if not self._count:
+            # nothing to fire or cascade on the way
+            self._current = target
+            return 0
+        fired = 0
+        while self._current < target:
+            self._current += 1
+            self._cascade()
+            bucket = self._levels[0][self._current & self._mask]
+            while bucket:
+                timer = next(iter(bucket))
+                timer.cancel()
+                self._fire(timer)
+                fired += 1
+        return fired
+
+    def _cascade(self) -> None:
+        tick = self._current
+        top = 0
+        for level in range(1, len(self._levels)):
+            if tick & ((1 << (self._bits * level)) - 1):
+                break
+            top = level
+        if top == len(self._levels) - 1 and self._overflow:
+            self._reinsert(self._overflow)
+        # higher levels first, their timers may land in a lower slot that is about
+        # to be cascaded itself
+        for level in range(top, 0, -1):
+            self._reinsert(self._levels[level][(tick >> (self._bits * level)) & self._mask])
+
+    def _reinsert(self, bucket: dict[Timer, None]) -> None:
+        timers = list(bucket)
+        bucket.clear()
+        for timer in timers:
+            self._insert(timer)
+
+    def _fire(self, timer: Timer) -> None:
+        try:
+            result = timer.callback(*timer.args)
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(result)
+                self._callbacks.add(task)
+                task.add_done_callback(partial(self._callback_done, timer.callback))
+        except Exception:
+            logger.exception(f"Timer callback {timer.callback} failed")
+
+    def _callback_done(self, callback: Callable[..., Any], task: asyncio.Task) -> None:
+        self._callbacks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Timer callback {callback} failed", exc_info=task.exception())
+
+    def _ensure_running(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop yet. the driver starts with the first timer scheduled from one.
+            return
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._tick)
+            self.advance()
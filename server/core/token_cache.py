@@ -0,0 +1,127 @@
+"""
+Decoded access tokens
+
+Clients present the same access token on every request and every websocket connect,
+and checking its signature and parsing its claims each time adds up for clients that
+poll. Tokens are decoded once and kept, least recently used first, until they expire
+or are revoked.
+
+Revocation only reaches the worker that handled it. When the server is sharded, the
+other workers keep accepting a revoked token until it expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+from uuid import UUID
+
+from jose import JWTError
+
+from server.utils import jwt_util
+
+MAX_TOKENS = 10000
+
+
+class TokenRevoked(Exception):
+    """
+    A token that was revoked before it expired.
+    """
+
+
+class DecodedToken:
+
+    __slots__ = ("claims", "user_id", "expires_at")
+
+    # shared by every request presenting the token, so it must not be modified
+    claims: dict[str, Any]
+    # user the token was issued to, None for tokens not issued to a user
+    user_id: UUID | None
+    # unix time, None for tokens that do not expire
+    expires_at: float | None
+
+    def __init__(self, claims: dict[str, Any]):
+        self.claims = claims
+        self.user_id = UUID(claims["user_id"]) if "user_id" in claims else None
+        self.expires_at = float(claims["exp"]) if "exp" in claims else None
+
+
+class TokenCache:
+    """
+    Used from the event loop and from the request thread pool, so every access to
+    the cache holds its lock. Tokens are decoded outside of it.
+    """
+
+    _max_tokens: int
+    _clock: Callable[[], float]
+    _lock: threading.Lock
+    # map of token to its decoded form, least recently used first
+    _tokens: OrderedDict[str, DecodedToken]
+    # map of revoked token to when it expires, after which it is rejected anyway
+    _revoked: dict[str, float | None]
+    hits: int
+    misses: int
+
+    def __init__(self, max_tokens: int = MAX_TOKENS, clock: Callable[[], float] = time.time):
+        self._max_tokens = max_tokens
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()
+        self._revoked = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def decode(self, token: str) -> DecodedToken:
+        """
+        Decode and verify a token, or take it from the cache if it was seen before.
+        Raises TokenRevoked for revoked tokens, and whatever `jwt_util.decode_token`
+        raises for invalid or expired ones.
+        """
+        with self._lock:
+            if token in self._revoked:
+                raise TokenRevoked()
+            decoded = self._tokens.get(token)
+            if decoded is not None:
+                if decoded.expires_at is None or decoded.expires_at > self._clock():
+                    self._tokens.move_to_end(token)
+                    self.hits += 1
+                    return decoded
+                # decoding it again raises the expiry error
+                del self._tokens[token]
+            self.misses += 1
+        decoded = DecodedToken(jwt_util.decode_token(token))
+        with self._lock:
+            # revoked while it was being decoded
+            if token in self._revoked:
+                raise TokenRevoked()
+            self._tokens[token] = decoded
+            if len(self._tokens) > self._max_tokens:
+                self._tokens.popitem(last=False)
+        return decoded
+
+    def revoke(self, token: str):
+        """
+        Reject a token from now on, until it would have expired anyway.
+        """
+        with self._lock:
+            decoded = self._tokens.pop(token, None)
+        if decoded is None:
+            try:
+                decoded = DecodedToken(jwt_util.decode_token(token))
+            except (JWTError, ValueError):
+                # invalid and expired tokens are rejected anyway
+                return
+        with self._lock:
+            now = self._clock()
+            for revoked in [revoked for revoked, expires_at in self._revoked.items()
+                            if expires_at is not None and expires_at <= now]:
+                del self._revoked[revoked]
+            self._revoked[token] = decoded.expires_at
+            # decoded again while this one was being decoded
+            self._tokens.pop(token, None)
+
+    def metrics(self) -> dict[str, int]:
+        with self._lock:
+            return dict(cached=len(self._tokens), revoked=len(self._revoked), hits=self.hits, misses=self.misses)
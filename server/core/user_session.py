@@ -1,12 +1,19 @@
+import heapq
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Callable
 from uuid import UUID
 
+from server.core.session_store import SessionStore
 from server.models.orm.user_session import UserSession
 from server.utils import jwt_util
 
 
 SessionAndToken = tuple[UserSession, str]
 
+MAX_SESSIONS = 100000
+
 
 class UserSessionManager:
     """
@@ -19,24 +26,62 @@ class UserSessionManager:
     User sessions will also keep track of whether a user is in an active
     game or not. If a user is in an active game when they connect, that
     game will be brought up.
+
+    Sessions are dropped once they expire, or when the number of sessions
+    reaches a cap, least recently used first. With a session store, sessions
+    are also written to it, and sessions that are not in memory, for example
+    after a restart, are looked up in the store.
+
+    Logins run on the request thread pool and lookups on the event loop, so every
+    access to the sessions holds a lock. The store is read outside of it.
     """
 
     _expiry_timedelta: timedelta
+    _max_sessions: int
+    _clock: Callable[[], datetime]
+    _store: SessionStore | None
+    _lock: threading.Lock
 
-    # map of session id to a user session
-    _user_sessions: dict[UUID, UserSession]
+    # map of session id to a user session, least recently used first. users have
+    # at most one session, the one from their latest login.
+    _user_sessions: OrderedDict[UUID, UserSession]
     # need to be able to look up sessions by user
     _user_id_to_session: dict[UUID, UserSession]
+    # (expires at, session id) of every session, soonest first. entries for sessions
+    # that were replaced or evicted are skipped when they come up.
+    _expiry_heap: list[tuple[datetime, UUID]]
+    # sessions removed because they expired, were replaced by a new login, or were
+    # the least recently used when the cap was reached
+    expired: int
+    replaced: int
+    evicted: int
 
-    def __init__(self, expiry_timedelta: timedelta | None = None):
+    def __init__(
+        self,
+        expiry_timedelta: timedelta | None = None,
+        max_sessions: int = MAX_SESSIONS,
+        store: SessionStore | None = None,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ):
         # by default if we don't log in for 2 days we clear the user session
         self._expiry_timedelta = expiry_timedelta or timedelta(days=2)
-        self._user_sessions = dict()
+        self._max_sessions = max_sessions
+        self._clock = clock
+        self._store = store
+        self._lock = threading.Lock()
+        self._user_sessions = OrderedDict()
         self._user_id_to_session = dict()
+        self._expiry_heap = list()
+        self.expired = 0
+        self.replaced = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._user_sessions)
 
     def create_user_session(self, user_id: UUID, name: str) -> UserSession:
         # TODO: add name validation
-        return UserSession(user_id=user_id, name=name, expires_at=datetime.utcnow() + self._expiry_timedelta)
+        return UserSession(user_id=user_id, name=name, expires_at=self._clock() + self._expiry_timedelta)
 
     def login(self, user_id: UUID, name: str) -> SessionAndToken:
         """
@@ -44,15 +89,110 @@ class UserSessionManager:
 
         This will also generate a jwt access token for the user. The access token
         will be used to establish identity in future requests made to the service.
+        A previous session of the user is replaced.
         """
         user_session = self.create_user_session(user_id, name)
         token = jwt_util.create_access_token({"user_id": user_id.hex}, expires_at=user_session.expires_at)
-        self._user_sessions[user_session.uuid] = user_session
-        self._user_id_to_session[user_id] = user_session
+        with self._lock:
+            self._expire()
+            previous = self._user_id_to_session.get(user_id)
+            if previous is not None:
+                self._remove(previous)
+                self.replaced += 1
+            self._add(user_session)
+            # under the lock, so the store keeps the same latest session as memory
+            if self._store is not None:
+                self._store.put(user_session)
         return (user_session, token)
 
     def get_session_for_user_id(self, user_id: UUID) -> UserSession | None:
-        return self._user_id_to_session.get(user_id)
+        with self._lock:
+            user_session = self._user_id_to_session.get(user_id)
+            if user_session is not None or self._store is None:
+                return self._touch(user_session)
+        stored = self._store.load_user(user_id)
+        with self._lock:
+            return self._touch(self._load(stored))
 
     def get_session_by_id(self, session_id: UUID) -> UserSession | None:
-        return self._user_sessions.get(session_id)
+        with self._lock:
+            user_session = self._user_sessions.get(session_id)
+            if user_session is not None or self._store is None:
+                return self._touch(user_session)
+        stored = self._store.load_session(session_id)
+        with self._lock:
+            user_session = self._load(stored)
+            if user_session is not None and user_session.uuid != session_id:
+                # replaced by a login while the store was read
+                return None
+            return self._touch(user_session)
+
+    def _load(self, user_session: UserSession | None) -> UserSession | None:
+        """
+        Keep a session read from the store. A session of the same user that is
+        already in memory comes from a login in this process and wins, whether it
+        is the same session loaded by a concurrent lookup or a newer one.
+        """
+        if user_session is None or user_session.expires_at <= self._clock():
+            return None
+        current = self._user_id_to_session.get(user_session.user_id)
+        if current is not None:
+            return current
+        self._add(user_session)
+        return user_session
+
+    def _add(self, user_session: UserSession):
+        self._user_sessions[user_session.uuid] = user_session
+        self._user_id_to_session[user_session.user_id] = user_session
+        heapq.heappush(self._expiry_heap, (user_session.expires_at, user_session.uuid))
+        while len(self._user_sessions) > self._max_sessions:
+            _, oldest = self._user_sessions.popitem(last=False)
+            del self._user_id_to_session[oldest.user_id]
+            self.evicted += 1
+        if len(self._expiry_heap) > 2 * len(self._user_sessions) + 64:
+            self._compact_heap()
+
+    def _touch(self, user_session: UserSession | None) -> UserSession | None:
+        if user_session is None:
+            return None
+        if user_session.expires_at <= self._clock():
+            self._expire()
+            return None
+        self._user_sessions.move_to_end(user_session.uuid)
+        return user_session
+
+    def _remove(self, user_session: UserSession):
+        del self._user_sessions[user_session.uuid]
+        del self._user_id_to_session[user_session.user_id]
+
+    def _compact_heap(self):
+        self._expiry_heap = [(s.expires_at, s.uuid) for s in self._user_sessions.values()]
+        heapq.heapify(self._expiry_heap)
+
+    def expire(self) -> int:
+        """
+        Remove every session that has expired. Returns the number removed.
+        """
+        with self._lock:
+            return self._expire()
+
+    def _expire(self) -> int:
+        now = self._clock()
+        count = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, session_id = heapq.heappop(self._expiry_heap)
+            user_session = self._user_sessions.get(session_id)
+            if user_session is not None:
+                self._remove(user_session)
+                count += 1
+        self.expired += count
+        return count
+
+    def metrics(self) -> dict[str, int]:
+        with self._lock:
+            metrics = dict(
+                active=len(self._user_sessions), expired=self.expired, replaced=self.replaced, evicted=self.evicted
+            )
+        if self._store is not None:
+            metrics.update(unwritten=self._store.pending, written=self._store.written)
+        return metrics
@@ -4,93 +4,286 @@ WebSocket Session Manager
 This is intended for use with the game router endpoint
 """
 import asyncio
+import inspect
 import logging
-from collections import defaultdict
-from enum import Enum
-from typing import Any
+import sys
+import time
+from functools import partial
+from typing import Any, Callable, Coroutine
 from uuid import UUID, uuid4
 
 from fastapi import WebSocket
-from server.core.game import GameManager
+from server.constants import MessageType, Role, Subprotocol
+from server.core.command import (
+    MAX_BATCH_SIZE,
+    CommandError,
+    CommandRouter,
+    acknowledge_batch_frame,
+    acknowledge_frame,
+)
+from server.core.command_results import CommandResultCache, event_id_of
+from server.core.game import Frame, GameManager
+from server.core.metrics import Histogram
+from server.models.dto.command import Command
 from server.models.orm.game import GameState
+from server.utils import msgpack_util
 
 logger = logging.getLogger(__name__)
 
 
+# websockets that do not take a frame within this many seconds are dropped
+SEND_TIMEOUT = 5.0
+# give up on closing a websocket that does not take the close frame
+CLOSE_TIMEOUT = 1.0
+# broadcasts per second to the spectators of a game
+SPECTATOR_HZ = 4.0
+# subscriptions that have not sent anything for this many seconds are pinged
+HEARTBEAT_INTERVAL = 20.0
+# and closed once they have not sent anything for this many seconds
+IDLE_TIMEOUT = 60.0
+
+PING_FRAMES: dict[Subprotocol, Frame] = {
+    Subprotocol.json: f'{{"type": "{MessageType.ping}", "body": null}}',
+    Subprotocol.compact: f'{{"type": "{MessageType.ping}", "body": null}}',
+    Subprotocol.msgpack: msgpack_util.frame(MessageType.ping, None),
+}
+
+
+if sys.version_info >= (3, 12):
+    def _start_send(coro: Coroutine[Any, Any, None]) -> asyncio.Task | None:
+        """
+        Run a send as an eager task, which runs until it first has to wait. Returns
+        None if it finished without waiting, otherwise the task that finishes it.
+        Errors raised before the first wait propagate to the caller.
+
+        A websocket send only waits when the connection's buffer is full, so a
+        broadcast pays for a pending task only for the subscribers that are behind.
+        """
+        task = asyncio.eager_task_factory(asyncio.get_running_loop(), coro)
+        if not task.done():
+            return task
+        task.result()
+        return None
+else:
+    def _start_send(coro: Coroutine[Any, Any, None]) -> asyncio.Task | None:
+        """
+        Run a send as a task. Tasks only start eagerly from Python 3.12, so here
+        every send returns the task that runs it.
+        """
+        return asyncio.get_running_loop().create_task(coro)
+
+
+def _error_message(exc: Exception) -> str:
+    return str(exc) or type(exc).__name__
+
+
 class Subscription:
     """
-    This subscription class is responsible for the broadcast of the latest
-    state values to individual clients.
+    A client's subscription to the state of a game.
 
     Problem Statement: if our publishes get backed up for whatever reason, the naive
     algorithm will progressively fall further and further behind. Instead, we should
     skip publishing older stale states and instead only publish latest states.
 
-    Solution?: whenever the game state updates, we mark the subscription as stale, and
-    that we must update it. At the start of an update out request, we first mark that
-    we are attempting to update a client's game state. Afterwards we perform the publish
-    and run the publish until success or giveup. On giveup, we generally mark the sub as
-    dead and should proceed to clean it up. This means that if a large number of state
-    updates come in while our coroutine is waiting, we read the latest version instead
-    of trying to catch up to older, stale states.
+    Solution: the WebSocketManager broadcasts each new version of a game to all of
+    its subscriptions in one pass, and the frames are serialized once per version.
+    A subscription remembers the version its client holds. If it is still sending
+    when a newer version is published, it is only marked stale, and once its send
+    completes it is sent whatever brings it to the latest version at that point.
+    Clients that fall behind skip the intermediate versions instead of catching up
+    on every one of them.
     """
 
-    # this is the current game state object model
-    _game: GameState
+    _game_id: UUID
 
-    # this is used to look up the current json string cache for
-    # the object model. this is always expected to match the same
-    # as game state and is used so that multiple subscribers do not
-    # need to serialize the same dictionary.
-    _game_cache: dict[str, str]
+    # user that owns the subscription
+    _user_id: UUID | None
 
     # websocket to publish state updates on
     _websocket: WebSocket
 
-    # asyncio event to trigger stale state updates
-    _stale: asyncio.Event
+    # subprotocol negotiated for the websocket, decides the snapshot encoding
+    _subprotocol: Subprotocol
 
-    # asyncio Task that runs the subscription update
-    _task: asyncio.Task | None
+    # role of the user in the game, which decides how quickly updates are sent
+    role: Role
+
+    # clock time the client last sent anything
+    last_seen: float
+
+    # the state version last sent to the client. None means the client has no
+    # usable state and must be sent a full snapshot.
+    _last_seq: int | None
+
+    # set when a newer version was published while a send was in progress
+    _stale: bool
+
+    # the send that is in progress, if the websocket did not take it right away
+    _sending: asyncio.Task | None
 
     def __init__(
         self,
-        game: GameState,
-        game_cache: dict[str, str],
+        game_id: UUID,
         websocket: WebSocket,
+        user_id: UUID | None = None,
+        subprotocol: Subprotocol = Subprotocol.json,
+        role: Role = Role.SPECTATOR,
+        last_seen: float = 0.0,
     ):
-        self._game = game
-        self._game_cache = game_cache
+        self._game_id = game_id
+        self._user_id = user_id
         self._websocket = websocket
-        self._stale = asyncio.Event()
-        self._task = None
+        self._subprotocol = subprotocol
+        self.role = role
+        self.last_seen = last_seen
+        self._last_seq = None
+        self._stale = False
+        self._sending = None
 
-    def start(self):
-        self._task = asyncio.create_task(self.run())
+    @property
+    def user_id(self) -> UUID | None:
+        return self._user_id
+
+    @property
+    def game_id(self) -> UUID:
+        return self._game_id
+
+    @property
+    def subprotocol(self) -> Subprotocol:
+        return self._subprotocol
+
+    @property
+    def last_seq(self) -> int | None:
+        return self._last_seq
+
+    @property
+    def sending(self) -> bool:
+        return self._sending is not None
 
     def stop(self):
-        self._task.cancel()
+        if self._sending is not None:
+            self._sending.cancel()
+            self._sending = None
+
+    async def close(self, reason: str | None = None, code: int = 1001):
+        try:
+            async with asyncio.timeout(CLOSE_TIMEOUT):
+                await self._websocket.close(code=code, reason=reason)
+        except Exception:
+            # the client may have already gone away
+            logger.debug(f"Failed to close websocket for game {self._game_id}")
+
+    def mark_stale(self) -> bool:
+        """
+        Returns whether the subscription was up to date until now.
+        """
+        stale, self._stale = self._stale, True
+        return not stale
 
-    def mark_stale(self):
-        self._stale.set()
+    def take_stale(self) -> bool:
+        stale, self._stale = self._stale, False
+        return stale
 
-    async def run(self):
-        self._stale.set()
-        while True:
-            await self._stale.wait()
-            self._stale.clear()
-            await self._websocket.send_json(self._game_cache.get(self._game.uuid))
+    def resync(self):
+        """
+        Send the client a full snapshot on the next publish. Clients request
+        this when they detect a gap in the sequence numbers they receive.
+        """
+        self._last_seq = None
+        self._stale = True
+
+    async def _send_frames(self, frames: list[Frame]):
+        try:
+            for frame in frames:
+                # frames are already encoded, sending them as is avoids encoding them again
+                if isinstance(frame, bytes):
+                    await self._websocket.send_bytes(frame)
+                else:
+                    await self._websocket.send_text(frame)
+        finally:
+            self._sending = None
+
+    def send(self, frames: list[Frame], seq: int) -> asyncio.Task | None:
+        """
+        Send the frames that bring the client to version `seq`. Returns None if the
+        websocket took them right away, otherwise the task that is still sending.
+        """
+        # a failed send drops the subscription, so the version can be taken as sent
+        self._last_seq = seq
+        task = _start_send(self._send_frames(frames))
+        if task is not None:
+            self._sending = task
+        return task
+
+
+class GameSubscriptions:
+    """
+    The subscriptions to one game, by subscription id, split into two tiers. Hosts
+    and players are sent every change right away. Spectators share a tick, so a game
+    with a large audience costs at most one spectator broadcast per tick however
+    quickly it changes.
+    """
+
+    __slots__ = (
+        "players", "spectators", "seats", "players_due", "spectator_tick", "spectators_sent_at"
+    )
+
+    players: dict[UUID, Subscription]
+    spectators: dict[UUID, Subscription]
+    # (host, white, black) when the tiers were last assigned
+    seats: tuple[UUID | None, UUID | None, UUID | None] | None
+    # a broadcast to the players is scheduled for this loop iteration
+    players_due: bool
+    # pending broadcast to the spectators
+    spectator_tick: asyncio.Handle | None
+    # loop time of the last broadcast to the spectators
+    spectators_sent_at: float
+
+    def __init__(self):
+        self.players = dict()
+        self.spectators = dict()
+        self.seats = None
+        self.players_due = False
+        self.spectator_tick = None
+        self.spectators_sent_at = float("-inf")
+
+    def __len__(self) -> int:
+        return len(self.players) + len(self.spectators)
+
+    def get(self, sub_id: UUID) -> Subscription | None:
+        return self.players.get(sub_id) or self.spectators.get(sub_id)
+
+    def items(self) -> list[tuple[UUID, Subscription]]:
+        return [*self.players.items(), *self.spectators.items()]
+
+    def add(self, sub_id: UUID, sub: Subscription):
+        if sub.role.value >= Role.PLAYER.value:
+            self.players[sub_id] = sub
+        else:
+            self.spectators[sub_id] = sub
+
+    def pop(self, sub_id: UUID) -> Subscription | None:
+        sub = self.players.pop(sub_id, None)
+        return sub if sub is not None else self.spectators.pop(sub_id, None)
+
+    def stop(self):
+        if self.spectator_tick is not None:
+            self.spectator_tick.cancel()
+            self.spectator_tick = None
 
 
-class Role(Enum):
+def negotiate_subprotocol(requested: list[str]) -> Subprotocol | None:
     """
-    (very) Basic RBAC
+    Pick the first subprotocol offered by the client that we support. Returns
+    None if the client did not offer any we know, in which case the connection
+    is accepted without a subprotocol and uses the json default.
     """
-    FORBIDDEN = 0  # forbidden
-    SPECTATOR = 1
-    PLAYER = 2
-    HOST = 3
-    ADMIN = 4
+    for name in requested:
+        try:
+            return Subprotocol(name)
+        except ValueError:
+            continue
+    return None
 
 
 class WebSocketManager:
@@ -98,32 +291,71 @@ class WebSocketManager:
     _game_manager: GameManager
     # map of subscription id to subscription object
     _subscriptions: dict[UUID, Subscription]
-    # map of game id to subscriptions for that game
-    _game_to_subs: dict[UUID, list[Subscription]]
-    # a map of user id to user role
-    _user_roles: dict[UUID, Role]
+    # map of game id to the subscriptions for that game
+    _game_to_subs: dict[UUID, GameSubscriptions]
+    # handlers for the commands clients send over their game websocket
+    _command_router: CommandRouter
+    # results of recent commands by event id, to answer retries
+    _results: CommandResultCache
+    _send_timeout: float
+    # seconds between broadcasts to the spectators of a game
+    _spectator_interval: float
+    _heartbeat_interval: float
+    _idle_timeout: float
+    _clock: Callable[[], float]
+    # milliseconds for one broadcast to hand its frames to every subscription
+    fanout_latency: Histogram
+    # sends still running when a newer version of their game was ready
+    slow_sends: int
+    # subscriptions dropped for not keeping up or for failing sends
+    dropped: int
+    # subscriptions closed for being idle
+    reaped: int
+    # sends heartbeats and reaps idle subscriptions
+    _task: asyncio.Task | None
 
-    def __init__(self, game_manager: GameManager):
+    def __init__(
+        self,
+        game_manager: GameManager,
+        command_router: CommandRouter | None = None,
+        command_results: CommandResultCache | None = None,
+        send_timeout: float = SEND_TIMEOUT,
+        spectator_hz: float = SPECTATOR_HZ,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        idle_timeout: float = IDLE_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
         self._game_manager = game_manager
+        self._command_router = command_router if command_router is not None else CommandRouter()
+        self._results = command_results if command_results is not None else CommandResultCache(clock=clock)
         self._subscriptions = dict()
-        self._game_to_subs = defaultdict(list)
+        self._game_to_subs = dict()
+        self._send_timeout = send_timeout
+        # zero or less sends spectators every change, like players
+        self._spectator_interval = 1.0 / spectator_hz if spectator_hz > 0 else 0.0
+        self._heartbeat_interval = heartbeat_interval
+        self._idle_timeout = idle_timeout
+        self._clock = clock
+        self.fanout_latency = Histogram()
+        self.slow_sends = 0
+        self.dropped = 0
+        self.reaped = 0
+        self._task = None
         self._game_manager.register_subscriber(self.update_subscribers)
-        self._user_roles = dict()
+        self._game_manager.register_evict_subscriber(self.drop_game)
+
+    @property
+    def game_manager(self) -> GameManager:
+        return self._game_manager
 
     async def handshake(self, websocket: WebSocket, game_id: UUID, user_id: UUID) -> Role:
         """
         Perform the initial handshake.
         """
         role = await self._handshake_and_get_role(websocket, game_id, user_id)
-        if role != Role.FORBIDDEN:
-            self._user_roles[user_id] = role
-        return role    
-
-    def update_user_role(self, user_id: UUID, role: Role):
-        if user_id not in self._user_roles:
-            logger.warning(f"Attempted to update {user_id} to {role} but user does not currently have a role")
-            return
-        self._user_roles[user_id] = role
+        if role == Role.HOST:
+            self._game_manager.host_connected(game_id)
+        return role
 
     async def _handshake_and_get_role(self, websocket: WebSocket, game_id: UUID, user_id: UUID) -> Role:
         game = self._game_manager.get_game_by_id(game_id)
@@ -134,6 +366,10 @@ class WebSocketManager:
             await websocket.close(code=1008, reason="No game found with that uuid")
             return Role.FORBIDDEN
 
+        return self.get_role(game, user_id)
+
+    @staticmethod
+    def get_role(game: GameState, user_id: UUID) -> Role:
         if user_id == game.host_player_id:
             return Role.HOST
         if user_id == game.white_player_id or user_id == game.black_player_id:
@@ -144,38 +380,404 @@ class WebSocketManager:
 
     def update_subscribers(self, game: GameState):
         """
-        Find all subscriptions for a specific game and flag them to update.
+        Schedule broadcasts of the game to its subscriptions. Hosts and players get
+        one broadcast per loop iteration with changes, spectators at most one per
+        spectator tick.
+        """
+        subs = self._game_to_subs.get(game.uuid)
+        if not subs:
+            return
+        seats = (game.host_player_id, game.white_player_id, game.black_player_id)
+        if seats != subs.seats:
+            self._assign_tiers(game, subs)
+        loop = asyncio.get_running_loop()
+        if subs.players and not subs.players_due:
+            subs.players_due = True
+            loop.call_soon(self._broadcast_players, game.uuid)
+        if subs.spectators and subs.spectator_tick is None:
+            delay = subs.spectators_sent_at + self._spectator_interval - loop.time()
+            if delay > 0:
+                subs.spectator_tick = loop.call_later(delay, self._broadcast_spectators, game.uuid)
+            else:
+                subs.spectator_tick = loop.call_soon(self._broadcast_spectators, game.uuid)
+
+    def _assign_tiers(self, game: GameState, subs: GameSubscriptions):
+        """
+        Move subscriptions between tiers after players join, leave or switch seats.
+        """
+        subs.seats = (game.host_player_id, game.white_player_id, game.black_player_id)
+        for sub_id, sub in subs.items():
+            role = self.get_role(game, sub.user_id)
+            if role != sub.role:
+                subs.pop(sub_id)
+                sub.role = role
+                subs.add(sub_id, sub)
+
+    def subscriber_count(self, game_id: UUID) -> int:
+        subs = self._game_to_subs.get(game_id)
+        return len(subs) if subs is not None else 0
+
+    def spectator_count(self, game_id: UUID) -> int:
+        """
+        Spectators watching a game on this worker. Kept here rather than on the game,
+        so spectators coming and going do not change its state.
         """
-        subs = self._game_to_subs[game.uuid]
-        for sub in subs:
-            sub.mark_stale()
+        subs = self._game_to_subs.get(game_id)
+        return len(subs.spectators) if subs is not None else 0
+
+    def _broadcast_players(self, game_id: UUID):
+        subs = self._game_to_subs.get(game_id)
+        if subs is not None:
+            subs.players_due = False
+            self.broadcast(game_id, subs.players)
+
+    def _broadcast_spectators(self, game_id: UUID):
+        subs = self._game_to_subs.get(game_id)
+        if subs is not None:
+            subs.spectator_tick = None
+            subs.spectators_sent_at = asyncio.get_running_loop().time()
+            self.broadcast(game_id, subs.spectators)
+
+    def broadcast(self, game_id: UUID, subs: dict[UUID, Subscription]):
+        """
+        Send each subscription the frames it needs to reach the latest version of
+        the game. Each set of frames is looked up once for all subscriptions at the
+        same version, and subscriptions still busy with an earlier send catch up
+        when it completes.
+        """
+        game = self._game_manager.get_game_by_id(game_id)
+        if game is None or not subs:
+            return
+        start = time.perf_counter()
+        frames_by_version = dict()
+        for sub_id, sub in list(subs.items()):
+            if sub.sending:
+                if sub.mark_stale():
+                    self.slow_sends += 1
+                continue
+            self._deliver(sub_id, sub, game, frames_by_version)
+        self.fanout_latency.observe((time.perf_counter() - start) * 1000)
+
+    def _deliver(
+        self,
+        sub_id: UUID,
+        sub: Subscription,
+        game: GameState,
+        frames_by_version: dict[tuple[int | None, Subprotocol], list[Frame]] | None = None,
+    ):
+        key = (sub.last_seq, sub.subprotocol)
+        frames = frames_by_version.get(key) if frames_by_version is not None else None
+        if frames is None:
+            frames = self._game_manager.frames_since(game.uuid, sub.last_seq, sub.subprotocol)
+            if frames_by_version is not None:
+                frames_by_version[key] = frames
+        if frames:
+            self._send(sub_id, sub, frames, game.seq)
+
+    def _send(self, sub_id: UUID, sub: Subscription, frames: list[Frame], seq: int | None):
+        try:
+            task = sub.send(frames, seq)
+        except Exception as exc:
+            logger.debug(f"Send to {sub.user_id} failed: {exc!r}")
+            self._drop(sub_id, sub, "Send failed")
+            return
+        if task is not None:
+            timeout = asyncio.get_running_loop().call_later(self._send_timeout, task.cancel)
+            task.add_done_callback(partial(self._send_done, sub_id, sub, timeout))
+
+    def _send_done(self, sub_id: UUID, sub: Subscription, timeout: asyncio.TimerHandle, task: asyncio.Task):
+        timeout.cancel()
+        if self._subscriptions.get(sub_id) is not sub:
+            # unsubscribed while sending
+            return
+        if task.cancelled():
+            self._drop(sub_id, sub, "Client is not keeping up")
+            return
+        if task.exception() is not None:
+            logger.debug(f"Send to {sub.user_id} failed: {task.exception()!r}")
+            self._drop(sub_id, sub, "Send failed")
+            return
+        game = self._game_manager.get_game_by_id(sub.game_id)
+        if sub.take_stale() and game is not None:
+            self._deliver(sub_id, sub, game)
+
+    def _drop(self, sub_id: UUID, sub: Subscription, reason: str):
+        logger.info(f"Dropping subscription of {sub.user_id} to game {sub.game_id}: {reason}")
+        self.dropped += 1
+        # 1013 is try again later
+        self._close(sub_id, sub, reason, code=1013)
 
-    def subscribe(self, websocket: WebSocket, game_id: UUID) -> UUID:
+    def _close(self, sub_id: UUID, sub: Subscription, reason: str, code: int):
+        self.unsubscribe(sub_id, sub.game_id)
+        asyncio.create_task(sub.close(reason=reason, code=code))
+
+    def resync(self, game_id: UUID, user_id: UUID):
+        """
+        Send a full snapshot to all of a user's subscriptions for a game.
+        """
+        game = self._game_manager.get_game_by_id(game_id)
+        subs = self._game_to_subs.get(game_id)
+        for sub_id, sub in subs.items() if subs is not None else []:
+            if sub.user_id == user_id:
+                sub.resync()
+                if not sub.sending and game is not None:
+                    sub.take_stale()
+                    self._deliver(sub_id, sub, game)
+
+    def subscribe(
+        self,
+        websocket: WebSocket,
+        game_id: UUID,
+        user_id: UUID | None = None,
+        subprotocol: Subprotocol = Subprotocol.json,
+        role: Role = Role.SPECTATOR,
+    ) -> UUID:
         sub_id = uuid4()
         game = self._game_manager.get_game_by_id(game_id)
         if game is None:
             raise ValueError("Missing game by id")
 
         sub = Subscription(
-            game=game,
-            game_cache=self._game_manager.game_cache,
-            websocket=websocket
+            game_id=game_id,
+            websocket=websocket,
+            user_id=user_id,
+            subprotocol=subprotocol,
+            role=role,
+            last_seen=self._clock(),
         )
-        sub.start()
         self._subscriptions[sub_id] = sub
-        self._game_to_subs[game_id].append(sub)
+        game_subs = self._game_to_subs.setdefault(game_id, GameSubscriptions())
+        game_subs.add(sub_id, sub)
+        # new subscribers start with a snapshot
+        self._deliver(sub_id, sub, game)
         return sub_id
 
     def unsubscribe(self, sub_id: UUID, game_id: UUID):
         sub = self._subscriptions.pop(sub_id, None)
         if sub is None:
-            logger.warning(f"Could not find subscription with uuid {sub_id}")
+            # subscriptions dropped for not keeping up are unsubscribed again on disconnect
+            logger.debug(f"Could not find subscription with uuid {sub_id}")
             return
         sub.stop()
-        game_subs = self._game_to_subs[game_id]
-        if sub not in game_subs:
+        game_subs = self._game_to_subs.get(game_id)
+        if game_subs is None or game_subs.pop(sub_id) is None:
             logger.warning(f"Could not find subscription with uuid {sub_id} in game subs for {game_id}")
+            return
+        if not game_subs:
+            game_subs.stop()
+            del self._game_to_subs[game_id]
+
+    def touch(self, sub_id: UUID):
+        """
+        Record that the client of a subscription sent something, which shows the
+        connection is alive.
+        """
+        sub = self._subscriptions.get(sub_id)
+        if sub is not None:
+            sub.last_seen = self._clock()
+
+    def heartbeat(self) -> int:
+        """
+        Ping subscriptions whose client has been quiet for a heartbeat interval, and
+        close the ones quiet for longer than the idle timeout. A half-open connection
+        never answers, so it is closed after the timeout instead of holding its
+        subscription forever. Returns the number of subscriptions closed.
+        """
+        now = self._clock()
+        reaped = 0
+        for sub_id, sub in list(self._subscriptions.items()):
+            quiet = now - sub.last_seen
+            if quiet >= self._idle_timeout:
+                reaped += 1
+                logger.info(f"Closing idle subscription of {sub.user_id} to game {sub.game_id}")
+                self._close(sub_id, sub, "Connection idle", code=1001)
+            elif quiet >= self._heartbeat_interval and not sub.sending:
+                self._send(sub_id, sub, [PING_FRAMES[sub.subprotocol]], sub.last_seq)
+        self.reaped += reaped
+        return reaped
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._heartbeat_interval / 2)
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Websocket heartbeat failed")
+
+    def metrics(self) -> dict[str, Any]:
+        return dict(
+            subscriptions=len(self._subscriptions),
+            spectators=sum(len(subs.spectators) for subs in self._game_to_subs.values()),
+            games=len(self._game_to_subs),
+            fanout_ms=self.fanout_latency.summary(),
+            slow_sends=self.slow_sends,
+            dropped=self.dropped,
+            reaped=self.reaped,
+            command_results=len(self._results),
+            duplicate_commands=self._results.duplicates,
+        )
+
+    def drop_game(self, game_id: UUID):
+        """
+        Stop and disconnect all subscriptions for a game that has been evicted.
+        """
+        self._results.drop_game(game_id)
+        subs = self._game_to_subs.pop(game_id, None)
+        if subs is None:
+            return
+        subs.stop()
+        for sub_id, sub in subs.items():
+            self._subscriptions.pop(sub_id, None)
+            sub.stop()
+            asyncio.create_task(sub.close(reason="Game has been archived"))
+
+    def resolve_command_dependencies(
+        self,
+        overrides: dict[Any, Any] | None = None
+    ) -> dict[Any, Any]:
+        """
+        Resolve the dependencies of every command handler. This is done once per
+        connection and the result passed to each `dispatch` on the connection.
+        """
+        return self._command_router.resolve_dependencies(overrides)
+
+    async def dispatch(
+        self,
+        data: dict[str, Any],
+        game_id: UUID,
+        user_id: UUID,
+        dependencies: dict[Any, Any],
+        subprotocol: Subprotocol = Subprotocol.json,
+    ) -> Frame:
+        """
+        Run a command sent on a game websocket and return the acknowledge frame for it,
+        encoded for the connection's subprotocol.
 
-    async def dispatch(self, data: dict[str, Any], role: Role):
-        # TODO: implement
-        print(f"Dispatch with {data} - role={role}")
+        Commands may only act on the connection's game and on behalf of the
+        connected user. The user's role is taken from the current state of the game,
+        so it follows promotions and kicks made after the handshake. Handlers run on
+        the game's command queue.
+
+        A command whose event id was already run for the user is not run again, and
+        is acknowledged with the original result.
+        """
+        event_id = event_id_of(data)
+        if event_id is not None:
+            result = self._results.get(game_id, user_id, event_id)
+            if result is not None:
+                return acknowledge_frame(event_id, result.error, subprotocol)
+        key = event_id
+        try:
+            command, handler = self._prepare(data, game_id, user_id, dependencies)
+            event_id = command.body.event_id
+            self._check_sender(command, game_id, user_id)
+
+            async def run_once() -> str | None:
+                # a retry may have been queued before the original ran
+                result = self._results.get(game_id, user_id, key) if key is not None else None
+                if result is not None:
+                    return result.error
+                return await self._run_handler(handler, game_id, user_id, key)
+
+            error = await self._game_manager.submit(game_id, run_once)
+        except Exception as exc:
+            logger.debug(f"Command from {user_id} failed: {exc!r}")
+            return acknowledge_frame(event_id, _error_message(exc), subprotocol)
+        return acknowledge_frame(event_id, error, subprotocol)
+
+    async def dispatch_batch(
+        self,
+        batch: list[Any],
+        game_id: UUID,
+        user_id: UUID,
+        dependencies: dict[Any, Any],
+        subprotocol: Subprotocol = Subprotocol.json,
+    ) -> Frame:
+        """
+        Run several commands in order, in one turn of the game's queue, and return a
+        single acknowledge frame with the result of each.
+
+        A failed command does not stop the ones after it. Each command is routed
+        when its turn comes, so it sees the roles left by the commands before it.
+        """
+        if len(batch) > MAX_BATCH_SIZE:
+            return acknowledge_frame(None, f"Batches may hold at most {MAX_BATCH_SIZE} commands", subprotocol)
+
+        async def run_batch() -> list[tuple[UUID | None, str | None]]:
+            results = []
+            for data in batch:
+                event_id = key = event_id_of(data)
+                result = self._results.get(game_id, user_id, key) if key is not None else None
+                if result is not None:
+                    results.append((event_id, result.error))
+                    continue
+                try:
+                    command, handler = self._prepare(data, game_id, user_id, dependencies)
+                    event_id = command.body.event_id
+                    self._check_sender(command, game_id, user_id)
+                except Exception as exc:
+                    logger.debug(f"Command from {user_id} failed: {exc!r}")
+                    results.append((event_id, _error_message(exc)))
+                    continue
+                results.append((event_id, await self._run_handler(handler, game_id, user_id, key)))
+            return results
+
+        try:
+            results = await self._game_manager.submit(game_id, run_batch)
+        except Exception as exc:
+            return acknowledge_frame(None, _error_message(exc), subprotocol)
+        return acknowledge_batch_frame(results, subprotocol)
+
+    async def _run_handler(
+        self,
+        handler: Callable[[], Any],
+        game_id: UUID,
+        user_id: UUID,
+        event_id: UUID | None,
+    ) -> str | None:
+        """
+        Run a bound command handler and return its error, if any. The result is kept
+        under the event id the client sent, so a retry gets the same answer.
+        """
+        error = None
+        try:
+            result = handler()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as exc:
+            logger.debug(f"Command from {user_id} failed: {exc!r}")
+            error = _error_message(exc)
+        if event_id is not None:
+            self._results.put(game_id, user_id, event_id, error)
+        return error
+
+    def _prepare(
+        self,
+        data: Any,
+        game_id: UUID,
+        user_id: UUID,
+        dependencies: dict[Any, Any],
+    ) -> tuple[Command, Callable[[], Any]]:
+        """
+        Route a command, going by the user's role in the current state of the game,
+        and bind its handler to the command and the connection's dependencies.
+        """
+        game = self._game_manager.get_game_by_id(game_id)
+        if game is None:
+            raise CommandError("Game no longer exists")
+        route, command = self._command_router.route(data, self.get_role(game, user_id))
+        kwargs = {name: dependencies[dependency] for name, dependency in route.dependencies.items()}
+        return command, partial(route.handler, command, **kwargs)
+
+    @staticmethod
+    def _check_sender(command: Command, game_id: UUID, user_id: UUID):
+        if command.body.game_id != game_id or command.body.user_id != user_id:
+            raise CommandError("Commands may only be sent for your own user and game")
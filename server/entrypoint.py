@@ -1,23 +1,50 @@
+import multiprocessing
+import os
+
 import uvicorn
 
+from server.core import env
 from server.core.app import create_app
 from server.core.database import get_sessionlocal, init_db
 from server.core.dependencies import CACHE
-from server.utils import tabulation_util
+from server.utils import path_util, tabulation_util
 from server.utils.path_util import ensure_paths
 
 
-def main():
+def serve(port: int):
     ensure_paths()
     app = create_app()
     init_db()
 
-    # initialize our cache
-    db = get_sessionlocal()()
-    tabulation_util.update_cache(CACHE, db)
-    db.close()
+    # initialize our cache. a snapshot is brought up to date once the server is up.
+    if not (env.RATINGS_SNAPSHOT_ENABLED and tabulation_util.load_snapshot(CACHE, path_util.RATINGS_SNAPSHOT)):
+        db = get_sessionlocal()()
+        tabulation_util.update_cache(CACHE, db)
+        db.close()
+
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="debug")
+
+
+def serve_shard():
+    serve(env.PORT + env.SHARD_INDEX)
+
+
+def main():
+    if env.SHARD_COUNT <= 1:
+        serve(env.PORT)
+        return
 
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="debug")
+    # each worker is a fresh interpreter so that it reads its own shard index
+    # from the environment when the env module is imported
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    for index in range(env.SHARD_COUNT):
+        os.environ["ELO_CALCULATOR_SHARD_INDEX"] = str(index)
+        worker = ctx.Process(target=serve_shard, name=f"elo-calculator-shard-{index}")
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
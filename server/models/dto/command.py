@@ -3,13 +3,14 @@ from typing import Generic, TypeVar
 from uuid import UUID, uuid4
 
 from pydantic import BaseModel, Field
+from pydantic.generics import GenericModel
 
 from server.constants import CommandType
 
 T = TypeVar('T', bound='Body')
 
 
-class Command(BaseModel, Generic[T]):
+class Command(GenericModel, Generic[T]):
     """
     Base command model.
 
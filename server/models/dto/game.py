@@ -1,11 +1,16 @@
+from datetime import datetime
 from uuid import UUID
 from pydantic import BaseModel, Field
 
+from server.models.orm.game import GameState, Phase, TimeControl
+
 
 class CreateGameRequest(BaseModel):
     # if this is provided, this game will be accessible through
     # a login code.
     game_code: str | None = None
+    # play on a clock. without this the game is untimed.
+    time_control: TimeControl | None = None
 
 
 class CreateGameResponse(BaseModel):
@@ -17,6 +22,43 @@ class ListGamesResponse(BaseModel):
     game_ids: list[UUID] = Field(default_factory=list)
 
 
+class LobbySummary(BaseModel):
+    """
+    What a lobby browser needs to show a game, without the board.
+    """
+    game_id: UUID
+    code: str
+    phase: Phase
+    created_at: datetime
+    host_player_id: UUID | None
+    white_player_id: UUID | None
+    black_player_id: UUID | None
+    open_slot: bool
+    spectator_count: int
+    time_control: TimeControl | None
+
+    @classmethod
+    def from_game(cls, game: GameState, spectator_count: int) -> "LobbySummary":
+        return cls(
+            game_id=game.uuid,
+            code=game.code,
+            phase=game.phase,
+            created_at=game.created_at,
+            host_player_id=game.host_player_id,
+            white_player_id=game.white_player_id,
+            black_player_id=game.black_player_id,
+            open_slot=game.has_open_slot,
+            spectator_count=spectator_count,
+            time_control=game.time_control,
+        )
+
+
+class ListLobbiesResponse(BaseModel):
+    lobbies: list[LobbySummary] = Field(default_factory=list)
+    # pass back to get the next page. None on the last page.
+    next_cursor: int | None = None
+
+
 class GetGameByCodeRequest(BaseModel):
     game_code: str
 
@@ -0,0 +1,13 @@
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class MatchmakingStatus(BaseModel):
+    queued: bool
+    # these are set while queued
+    rating: float | None = None
+    waited_seconds: float | None = None
+    window: float | None = None
+    # set once a game has been found
+    game_id: UUID | None = None
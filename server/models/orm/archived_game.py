@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from server.core.guid import GUID
+from server.models.orm.base import BaseModel
+
+
+class ArchivedGame(BaseModel):
+    """
+    Summary of an online game that has left the GameManager. The uuid is the
+    uuid of the game.
+    """
+    __tablename__ = "archived_games"
+
+    code = sa.Column(sa.String, nullable=False)
+    created_at = sa.Column(sa.DateTime, nullable=False)
+    finished_at = sa.Column(sa.DateTime, nullable=True)
+    archived_at = sa.Column(sa.DateTime, default=datetime.utcnow, nullable=False)
+    phase = sa.Column(sa.Integer, nullable=False)
+    end_of_game_trigger = sa.Column(sa.Integer, nullable=True)
+    winner = sa.Column(sa.Integer, nullable=False)
+    host_player_id = sa.Column(GUID(), nullable=True, index=True)
+    white_player_id = sa.Column(GUID(), nullable=True, index=True)
+    black_player_id = sa.Column(GUID(), nullable=True, index=True)
+    turn_number = sa.Column(sa.Integer, nullable=False)
+    # packed with board_util.pack_moves
+    move_history = sa.Column(sa.LargeBinary, nullable=False)
@@ -1,9 +1,12 @@
+import base64
+import json
 import logging
-import random
 from datetime import datetime
 from enum import Enum
+from typing import Any
 from uuid import UUID, uuid4
-from pydantic import BaseModel, Field, root_validator
+from pydantic import BaseModel, Field, PrivateAttr, root_validator
+from pydantic.json import pydantic_encoder
 
 from server.utils import board_util
 
@@ -17,28 +20,49 @@ class Phase(int, Enum):
     ERROR = 4
 
 
+# games in these phases will not change anymore and can be archived
+TERMINAL_PHASES = frozenset((Phase.FINISHED, Phase.ERROR))
+
+
 class EndOfGameTrigger(str, Enum):
     ERROR = 0
     BOARD_POSITION = 1
     FORFEIT = 2
     LOBBY_CLOSE = 3
+    TIMEOUT = 4
+    IDLE = 5
+
+
+class TimeControl(BaseModel):
+    """
+    Chess-style clock settings, in seconds.
+
+    Each player starts with `initial` on their clock. At the start of each of their
+    turns the clock waits `delay` before it starts running, and after each of their
+    moves `increment` is added to it. A player whose clock runs out loses on time.
+    """
+    initial: float = Field(gt=0)
+    increment: float = Field(default=0.0, ge=0)
+    delay: float = Field(default=0.0, ge=0)
 
 
 def initialize_board(size: int = 5):
     return [[[0 for _ in range(size)] for _ in range(size)] for _ in range(size)]
 
 
-def gen_random_code(length: int = 4, alpha = "ABCDEFGHJKLMNPQRSTUVWXYZ"):
-    return "".join(alpha[random.randrange(0, len(alpha))] for _ in range(length))
+# A journal entry records how to undo a single mutation. Entries are one of
+#   (JOURNAL_FIELD, field_name, previous_value)
+#   (JOURNAL_CELL, (x, y, z), previous_value)
+#   (JOURNAL_MOVE, None, None)  -- a move was appended to move_history
+JOURNAL_FIELD = 0
+JOURNAL_CELL = 1
+JOURNAL_MOVE = 2
 
+JournalEntry = tuple[int, Any, Any]
 
-# we pre-generate some to ensure that we never run into collisions.
-# codes are put back into the available pool after games finish and get
-# recorded by the cleanup worker.
-RANDOM_CODES = set(gen_random_code() for _ in range(10000))
-
-def get_random_code():
-    return RANDOM_CODES.pop()
+# fields of GameState that have to be converted back from json by `parse_compact`
+_UUID_FIELDS = ("uuid", "host_player_id", "white_player_id", "black_player_id")
+_DATETIME_FIELDS = ("created_at", "modified_at", "finished_at", "turn_started_at")
 
 
 class GameState(BaseModel):
@@ -53,7 +77,8 @@ class GameState(BaseModel):
     finished_at: datetime | None = None
 
     uuid: UUID = Field(default_factory=uuid4)
-    code: str = Field(default_factory=get_random_code)
+    # assigned by the game manager from its code allocator when the game is added
+    code: str | None = None
 
     # The board is a 3D array of integers.
     # 0 indicates an unoccupied space.
@@ -76,16 +101,31 @@ class GameState(BaseModel):
     end_of_game_trigger: EndOfGameTrigger | None = None
     winner: int = 0
 
+    # Clock settings, if the game is played on a clock. The remaining time on each
+    # clock is as of `turn_started_at`, the start of the current turn.
+    time_control: TimeControl | None = None
+    white_clock: float | None = None
+    black_clock: float | None = None
+    turn_started_at: datetime | None = None
+
     # When clients make play move requests they will need to provide the
     # turn number. In doing this, they will ensure that we do not apply the
     # same move multiple times.
     turn_number: int = 0
 
+    # State version. This is bumped by the game manager every time a change
+    # is published, so clients can tell whether they missed an update.
+    seq: int = 0
+
     # move history is typically not broadcast over network unless specifically
     # requested by client.
     # move history tuple is (player, x, y, z)
     move_history: list[tuple[int, int, int, int]] = Field(default_factory=list)
 
+    # mutation journal for the currently open transaction. None when no
+    # transaction is open, in which case mutations are not recorded.
+    _journal: list[JournalEntry] | None = PrivateAttr(default=None)
+
     @root_validator(pre=True)
     def update_modified_at(cls, values):
         # Check if it's an update (not the initial creation)
@@ -93,6 +133,78 @@ class GameState(BaseModel):
             values['modified_at'] = datetime.utcnow()
         return values
 
+    def __setattr__(self, name: str, value: Any):
+        journal = self._journal
+        if journal is not None and name in self.__fields__:
+            journal.append((JOURNAL_FIELD, name, getattr(self, name)))
+        super().__setattr__(name, value)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._journal is not None
+
+    def begin(self) -> None:
+        """
+        Open a transaction. Every mutation made until `commit` or `rollback` is
+        recorded in the journal so that it can be reverted.
+        """
+        if self._journal is not None:
+            raise RuntimeError(f"Game {self.uuid} already has an open transaction")
+        self._journal = []
+
+    def commit(self) -> list[JournalEntry]:
+        """
+        Close the current transaction and keep its changes. Returns the journal
+        entries so callers can tell which parts of the state were touched.
+        """
+        journal = self._journal
+        if journal is None:
+            raise RuntimeError(f"Game {self.uuid} has no open transaction")
+        self._journal = None
+        if journal:
+            self.modified_at = datetime.utcnow()
+        return journal
+
+    def rollback(self) -> None:
+        """
+        Close the current transaction and revert its changes, newest first.
+        """
+        journal = self._journal
+        if journal is None:
+            raise RuntimeError(f"Game {self.uuid} has no open transaction")
+        # stop recording before restoring so the restores are not journaled
+        self._journal = None
+        for kind, key, previous in reversed(journal):
+            if kind == JOURNAL_FIELD:
+                super().__setattr__(key, previous)
+            elif kind == JOURNAL_CELL:
+                x, y, z = key
+                self.board[x][y][z] = previous
+            elif kind == JOURNAL_MOVE:
+                self.move_history.pop()
+
+    def _set_cell(self, x: int, y: int, z: int, value: int) -> None:
+        # the board is mutated in place so it has to be journaled by hand
+        if self._journal is not None:
+            self._journal.append((JOURNAL_CELL, (x, y, z), self.board[x][y][z]))
+        self.board[x][y][z] = value
+
+    def _append_move(self, move: tuple[int, int, int, int]) -> None:
+        if self._journal is not None:
+            self._journal.append((JOURNAL_MOVE, None, None))
+        self.move_history.append(move)
+
+    @property
+    def is_terminal(self) -> bool:
+        return self.phase in TERMINAL_PHASES
+
+    @property
+    def has_open_slot(self) -> bool:
+        """
+        Whether a spectator could join the lobby as a player.
+        """
+        return self.phase == Phase.INITIALIZED and (self.white_player_id is None) != (self.black_player_id is None)
+
     @property
     def whose_turn(self):
         if self.phase == Phase.RUNNING and self.turn_number % 2 == 0:
@@ -104,16 +216,138 @@ class GameState(BaseModel):
     def network_json(self):
         return self.json(exclude=set(["move_history"]))
 
-    def _play_piece(self, player: int, x: int, y: int, z: int):
+    def compact_dict(self, binary: bool = False) -> dict[str, Any]:
+        """
+        All fields, with the board packed at 2 bits per cell and the move history
+        packed at one byte per move, both base64 encoded. With `binary` they are
+        left as bytes, for encodings that have a bytes type.
+        """
+        data = self.dict(exclude=set(["board", "move_history"]))
+        data["board"] = board_util.pack_board(self.board)
+        data["move_history"] = board_util.pack_moves(self.move_history)
+        if not binary:
+            data["board"] = base64.b64encode(data["board"]).decode()
+            data["move_history"] = base64.b64encode(data["move_history"]).decode()
+        return data
+
+    @classmethod
+    def parse_compact(cls, data: dict[str, Any]) -> "GameState":
+        """
+        Inverse of `compact_dict`, after a round trip through json. The board and move
+        history may also be given already unpacked.
+
+        This is only meant for states the server wrote itself, such as those in the
+        game log. Fields are converted back to their types by hand instead of being
+        validated, since validation is most of the cost of parsing a game.
+        """
+        values = {name: data[name] for name in cls.__fields__ if name in data}
+        for name in _UUID_FIELDS:
+            if isinstance(values.get(name), str):
+                values[name] = UUID(values[name])
+        for name in _DATETIME_FIELDS:
+            if isinstance(values.get(name), str):
+                values[name] = datetime.fromisoformat(values[name])
+        values["phase"] = Phase(values["phase"])
+        if values.get("end_of_game_trigger") is not None:
+            values["end_of_game_trigger"] = EndOfGameTrigger(values["end_of_game_trigger"])
+        if values.get("time_control") is not None:
+            values["time_control"] = TimeControl.parse_obj(values["time_control"])
+        board = values["board"]
+        moves = values["move_history"]
+        values["board"] = board_util.unpack_board(base64.b64decode(board)) if isinstance(board, str) else board
+        values["move_history"] = (
+            board_util.unpack_moves(base64.b64decode(moves)) if isinstance(moves, str) else [tuple(m) for m in moves]
+        )
+        return cls.construct(**values)
+
+    def network_compact_json(self):
+        """
+        Same as `network_json` but in the packed form of `compact_dict`. Unlike
+        `network_json` this includes the move history, which is cheap once packed.
+        """
+        return json.dumps(self.compact_dict(), default=pydantic_encoder)
+
+    def network_delta(self, journal: list[JournalEntry]) -> dict[str, Any]:
+        """
+        Build the network delta for a committed transaction: the current value of
+        every field and board cell named in the journal. Like `network_json`, the
+        move history is left out.
+        """
+        fields = {"seq", "modified_at"}
+        cells = dict()
+        for kind, key, _ in journal:
+            if kind == JOURNAL_FIELD:
+                fields.add(key)
+            elif kind == JOURNAL_CELL:
+                cells[key] = None
+        fields.discard("move_history")
+        return dict(
+            seq=self.seq,
+            fields=self.dict(include=fields),
+            cells=[(x, y, z, self.board[x][y][z]) for x, y, z in cells],
+        )
+
+    def network_delta_json(self, journal: list[JournalEntry]) -> str:
+        return json.dumps(self.network_delta(journal), default=pydantic_encoder)
+
+    def _clock_field(self, player: int) -> str:
+        return "white_clock" if player == 1 else "black_clock"
+
+    def time_remaining(self, player: int, now: datetime | None = None) -> float | None:
+        """
+        Time left on a player's clock, counting the current turn if it is theirs.
+        """
+        if self.time_control is None:
+            return None
+        remaining = getattr(self, self._clock_field(player))
+        if player == self.whose_turn and self.turn_started_at is not None:
+            elapsed = ((now or datetime.utcnow()) - self.turn_started_at).total_seconds()
+            remaining -= max(0.0, elapsed - self.time_control.delay)
+        return remaining
+
+    def seconds_until_flag(self, now: datetime | None = None) -> float | None:
+        """
+        Time until the player to move runs out of time, including the move delay if
+        it has not passed yet. None if the game is not running on a clock.
+        """
+        player = self.whose_turn
+        if self.time_control is None or player == 0:
+            return None
+        now = now or datetime.utcnow()
+        elapsed = (now - self.turn_started_at).total_seconds()
+        return max(0.0, self.time_control.delay - elapsed) + max(0.0, self.time_remaining(player, now))
+
+    def check_flag(self, now: datetime | None = None) -> bool:
+        """
+        End the game if the player to move has run out of time.
+        """
+        player = self.whose_turn
+        if self.time_control is None or player == 0:
+            return False
+        if self.time_remaining(player, now) > 0:
+            return False
+        setattr(self, self._clock_field(player), 0.0)
+        self.end_of_game(3 - player, EndOfGameTrigger.TIMEOUT)
+        return True
+
+    def _play_piece(self, player: int, x: int, y: int, z: int, now: datetime | None = None):
         self._only_in_game("Play Piece")
         if self.board[x][y][z] != 0:
             raise ValueError("Position already occupied")
+        if self.time_control is not None:
+            now = now or datetime.utcnow()
+            # the move is rejected, the caller should `check_flag` to end the game
+            if self.time_remaining(player, now) <= 0:
+                raise ValueError("Flagged on time")
+            remaining = self.time_remaining(player, now) + self.time_control.increment
+            setattr(self, self._clock_field(player), remaining)
+            self.turn_started_at = now
         self.turn_number += 1
-        self.move_history.append((player, x, y, z))
-        self.board[x][y][z] = 1
+        self._append_move((player, x, y, z))
+        self._set_cell(x, y, z, player)
 
         if board_util.has_four_in_line(self.board, player):
-            self.end_of_game(EndOfGameTrigger.BOARD_POSITION)
+            self.end_of_game(player, EndOfGameTrigger.BOARD_POSITION)
 
     def _only_on_init(self, name: str):
         if self.phase != Phase.INITIALIZED:
@@ -134,11 +368,11 @@ class GameState(BaseModel):
         elif self.black_player_id == remove_player_id:
             self.black_player_id = None
 
-    def play_white(self, x: int, y: int, z: int):
-        self._play_piece(1, x, y, z)
+    def play_white(self, x: int, y: int, z: int, now: datetime | None = None):
+        self._play_piece(1, x, y, z, now)
 
-    def play_black(self, x: int, y: int, z: int):
-        self._play_piece(2, x, y, z)
+    def play_black(self, x: int, y: int, z: int, now: datetime | None = None):
+        self._play_piece(2, x, y, z, now)
 
     def try_promote_player(self, user_id: UUID):
         """
@@ -157,18 +391,20 @@ class GameState(BaseModel):
 
         if self.white_player_id is not None:
             self.black_player_id = user_id
-        elif self.white_player_id is not None:
+        else:
             self.white_player_id = user_id
 
-        raise RuntimeError("Something went very wrong")
-
     def _user_is_game_player(self, user_id: UUID) -> bool:
         return user_id in (self.white_player_id, self.black_player_id)
 
-    def start(self) -> None:
+    def start(self, now: datetime | None = None) -> None:
         self._only_on_init("Start")
         logger.debug(f"Game with id {self.uuid} has started")
         self.phase = Phase.RUNNING
+        if self.time_control is not None:
+            self.white_clock = self.time_control.initial
+            self.black_clock = self.time_control.initial
+            self.turn_started_at = now or datetime.utcnow()
 
     def player_leave_game(self, user_id: UUID):
         """
@@ -184,6 +420,7 @@ class GameState(BaseModel):
 
     def end_of_game(self, winner: int, trigger: EndOfGameTrigger):
         self.end_of_game_trigger = trigger
+        self.finished_at = datetime.utcnow()
         match trigger:
             case EndOfGameTrigger.ERROR:
                 self.phase = Phase.ERROR
@@ -195,10 +432,21 @@ class GameState(BaseModel):
                 self.phase = Phase.FINISHED
             case EndOfGameTrigger.LOBBY_CLOSE:
                 self.phase = Phase.FINISHED
+            case EndOfGameTrigger.TIMEOUT:
+                self.winner = winner
+                self.phase = Phase.FINISHED
+            case EndOfGameTrigger.IDLE:
+                self.phase = Phase.FINISHED
 
     def close(self):
         self.end_of_game(0, EndOfGameTrigger.LOBBY_CLOSE)
 
+    def expire(self):
+        """
+        End a game that nobody has touched for too long, without a winner.
+        """
+        self.end_of_game(0, EndOfGameTrigger.IDLE)
+
     def player_forfeit_game(self, user_id: UUID):
         """
         Active player forfeits game. If this is successful we trigger an end-of-game event.
@@ -4,10 +4,10 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 
 from server.core import env
-from server.core.dependencies import validate_token
+from server.core.dependencies import RateLimit, validate_token
 from server.utils import jwt_util
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(RateLimit("auth"))])
 
 
 def authenticate_user(username: str, password: str):
@@ -1,24 +1,38 @@
-import asyncio
 import logging
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, WebSocket
+from fastapi import APIRouter, Depends, Request, WebSocket, status
 from fastapi.exceptions import HTTPException
+from fastapi.responses import RedirectResponse
 from starlette.websockets import WebSocketDisconnect
 
-from server.core.dependencies import get_websocket_manager, get_game_manager, session_auth, validate_token
+from server.constants import CommandType, Subprotocol
+from server.core.dependencies import (
+    authenticate,
+    get_game_manager,
+    get_token_cache,
+    get_websocket_manager,
+    RateLimit,
+    session_auth,
+)
 from server.core.game import GameManager
-from server.core.websocket_manager import Role, WebSocketManager
+from server.core.shard import WS_CLOSE_REDIRECT
+from server.core.websocket_manager import Role, WebSocketManager, negotiate_subprotocol
 from server.models.dto.game import (
     CreateGameRequest,
     CreateGameResponse,
     ListGamesResponse,
+    ListLobbiesResponse,
+    LobbySummary,
     GetGameByCodeRequest,
     GetGameByCodeResponse,
 )
-from server.models.orm.game import GameState
+from server.core.game_index import DEFAULT_PAGE_SIZE
+from server.models.orm.game import GameState, Phase
+from server.utils import msgpack_util
 
 router = APIRouter()
+rate_limit = RateLimit("game", per_user=True)
 
 logger = logging.getLogger(__name__)
 
@@ -30,40 +44,87 @@ async def websocket_test(websocket: WebSocket):
         await websocket.send_text(f"Message text was: {data}")
 
 
-@router.get("/game", response_model=ListGamesResponse)
+@router.get("/game", response_model=ListGamesResponse, dependencies=[Depends(rate_limit)])
 async def get_games(_: UUID = Depends(session_auth), game_manager: GameManager = Depends(get_game_manager)):
     return ListGamesResponse(game_ids=game_manager.get_all_game_ids())
 
 
-@router.post("/game", response_model=CreateGameResponse)
+@router.get("/game/list", response_model=ListLobbiesResponse, dependencies=[Depends(rate_limit)])
+async def list_games(
+    phase: Phase | None = None,
+    open_slot: bool | None = None,
+    host_player_id: UUID | None = None,
+    player_id: UUID | None = None,
+    cursor: int | None = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    _: UUID = Depends(session_auth),
+    game_manager: GameManager = Depends(get_game_manager),
+    websocket_manager: WebSocketManager = Depends(get_websocket_manager),
+):
+    """
+    Summaries of the games matching every given filter, newest first. Results are
+    paged, pass `next_cursor` from a response as `cursor` to get the next page.
+    """
+    games, next_cursor = game_manager.list_games(phase, open_slot, host_player_id, player_id, cursor, limit)
+    return ListLobbiesResponse(
+        lobbies=[LobbySummary.from_game(game, websocket_manager.spectator_count(game.uuid)) for game in games],
+        next_cursor=next_cursor,
+    )
+
+
+@router.post("/game", response_model=CreateGameResponse, dependencies=[Depends(rate_limit)])
 async def create_game(
-    _: CreateGameRequest,
+    request: CreateGameRequest,
     player_id: UUID = Depends(session_auth),
     game_manager: GameManager = Depends(get_game_manager)
 ):
-    game = game_manager.create_game(player_id)
+    game = game_manager.create_game(player_id, time_control=request.time_control)
     return CreateGameResponse(code=200, game_id=game.uuid)
 
 
-@router.get("/game/code", response_model=GetGameByCodeResponse)
+@router.get("/game/code", response_model=GetGameByCodeResponse, dependencies=[Depends(rate_limit)])
 async def get_game_code(
     code: str,
     _: UUID = Depends(session_auth),
     game_manager: GameManager = Depends(get_game_manager)
 ):
-    game = game_manager.get_game_by_code(code)
-    if game is None:
+    game_id = game_manager.get_game_id_by_code(code)
+    if game_id is None:
         raise ValueError(f"No game found with code {code}")
-    return GetGameByCodeResponse(game_id=game.uuid)
+    return GetGameByCodeResponse(game_id=game_id)
+
+
+def get_owner_url(
+    game_manager: GameManager,
+    game_id: UUID,
+    path: str,
+    query: str,
+    websocket: bool = False
+) -> str | None:
+    """
+    When running sharded, returns the url of the same request on the worker that owns
+    the game, if that is not this worker.
+    """
+    shard = game_manager.shard
+    if shard is None or shard.owns(game_id):
+        return None
+    url = shard.owner_url(game_id, path, query, websocket=websocket)
+    if url is None:
+        logger.error(f"No address registered for the owner of game {game_id}")
+    return url
 
 
-@router.get("/game/{uuid}", response_model=GameState)
+@router.get("/game/{uuid}", response_model=GameState, dependencies=[Depends(rate_limit)])
 async def get_game(
     uuid: str,
+    request: Request,
     _: UUID = Depends(session_auth),
     game_manager: GameManager = Depends(get_game_manager)
 ):
     game_id = UUID(uuid)
+    owner_url = get_owner_url(game_manager, game_id, request.url.path, request.url.query)
+    if owner_url is not None:
+        return RedirectResponse(owner_url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
     game = game_manager.get_game_by_id(game_id)
     if game is None:
         raise ValueError("Game with provided id does not exist")
@@ -93,11 +154,44 @@ async def websocket_game(
     If the user id does not match any of the ids, they will only receive
     game state updates.
 
-    Commands are asynchronous and do not come with any explicit response feedback.
+    Each command is answered with an acknowledge message carrying the command's
+    event id and whether it succeeded. A message may also be an array of commands,
+    which run in order in one turn of the game and are answered together with one
+    `acknowledge_batch` message holding the result of each. State changes are sent
+    separately, to every subscriber of the game. Hosts and players get every change
+    as it happens. Spectators get the latest state a few times a second.
+
+    Clients that have not sent anything for a while are sent a `ping` message and
+    should answer with a `pong`. Connections that stay quiet are closed.
+
+    Clients may request a subprotocol in the handshake to change how game state is
+    encoded. `elo-compact` packs the board and move history into base64 strings,
+    which is much smaller for clients on poor connections. `elo-msgpack` carries
+    commands and every server message as MessagePack binary messages, with integer
+    codes for command and message types and UUIDs as raw bytes, for clients that
+    send many commands such as bots. See `msgpack_util` for the format. Without a
+    subprotocol the board is sent as nested json arrays.
+
+    When running sharded, clients connecting to a worker that does not own the game
+    are redirected to the owner. If the server supports it, this is an http 307 in
+    response to the handshake. Otherwise the websocket is accepted and closed with
+    code 4307 and the owner's url as the reason.
     """
     game_id = UUID(uuid)
+    owner_url = get_owner_url(
+        websocket_manager.game_manager, game_id, websocket.url.path, websocket.url.query, websocket=True
+    )
+    if owner_url is not None:
+        if "websocket.http.response" in websocket.scope.get("extensions", {}):
+            await websocket.send_denial_response(
+                RedirectResponse(owner_url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+            )
+        else:
+            await websocket.accept()
+            await websocket.close(code=WS_CLOSE_REDIRECT, reason=owner_url)
+        return
     try:
-        user_id = session_auth(validate_token(token))
+        user_id = session_auth(authenticate(token, get_token_cache()))
     except HTTPException:
         logger.error("Invalid token")
         await websocket.close(code=1008, reason="Invalid token")
@@ -107,23 +201,40 @@ async def websocket_game(
     if role == Role.FORBIDDEN:
         logger.warning(f"Failed to establish role for connected player {user_id} and game {game_id}")
         await websocket.close(code=1008)
+        return
 
-    await websocket.accept()
+    negotiated = negotiate_subprotocol(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=negotiated)
+    subprotocol = negotiated or Subprotocol.json
 
     # after handshake success, register subscription
-    sub_id = websocket_manager.subscribe(websocket, game_id)
+    sub_id = websocket_manager.subscribe(websocket, game_id, user_id, subprotocol, role)
+    dependencies = websocket_manager.resolve_command_dependencies(websocket.app.dependency_overrides)
     # start listening for commands
     try:
         while True:
             try:
-                data = await websocket.receive_json()
-                await websocket_manager.dispatch(data, role)
+                if subprotocol == Subprotocol.msgpack:
+                    data = msgpack_util.parse_command(await websocket.receive_bytes())
+                else:
+                    data = await websocket.receive_json()
             except WebSocketDisconnect:
                 logger.debug(f"WebSocket disconnect for user {str(user_id)}")
                 break
-            except Exception as exc:
-                print(f"{type(exc)} - {repr(exc)}")
-                await asyncio.sleep(1.0)
-                logger.warning(f"Failed to read message from remote???")
+            except (ValueError, KeyError):
+                # KeyError is a binary message where text was expected, or the reverse
+                logger.warning(f"Received a message that is not {subprotocol} from {user_id}")
+                continue
+            websocket_manager.touch(sub_id)
+            if isinstance(data, dict) and data.get("type") == CommandType.pong:
+                continue
+            if isinstance(data, list):
+                ack = await websocket_manager.dispatch_batch(data, game_id, user_id, dependencies, subprotocol)
+            else:
+                ack = await websocket_manager.dispatch(data, game_id, user_id, dependencies, subprotocol)
+            if isinstance(ack, bytes):
+                await websocket.send_bytes(ack)
+            else:
+                await websocket.send_text(ack)
     finally:
         websocket_manager.unsubscribe(sub_id, game_id)
@@ -1,13 +1,13 @@
 from sqlalchemy.orm.session import Session
 from fastapi import APIRouter, Depends
 
-from server.core.dependencies import update_cache, get_database
+from server.core.dependencies import get_database, RateLimit, update_cache
 from server.models.dto.match import MatchResult as MatchResultDto
 from server.models.dto.response import Response
 from server.models.orm.match import Match
 from server.models.orm.player import Player
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(RateLimit("match"))])
 
 
 @router.post("/match", response_model=Response)
@@ -0,0 +1,38 @@
+from uuid import UUID
+
+from fastapi import APIRouter, Depends
+
+from server.core.dependencies import get_matchmaker, RateLimit, session_auth
+from server.core.matchmaking import Matchmaker
+from server.models.dto.matchmaking import MatchmakingStatus
+
+router = APIRouter(dependencies=[Depends(RateLimit("matchmaking", per_user=True))])
+
+
+@router.post("/matchmaking", response_model=MatchmakingStatus)
+async def join_matchmaking(
+    user_id: UUID = Depends(session_auth),
+    matchmaker: Matchmaker = Depends(get_matchmaker),
+):
+    """
+    Queue for a rated game. Clients poll `GET /matchmaking` until a game id is
+    returned, then connect to the game like any other.
+    """
+    return matchmaker.join(user_id)
+
+
+@router.get("/matchmaking", response_model=MatchmakingStatus)
+async def get_matchmaking_status(
+    user_id: UUID = Depends(session_auth),
+    matchmaker: Matchmaker = Depends(get_matchmaker),
+):
+    return matchmaker.status(user_id)
+
+
+@router.delete("/matchmaking", response_model=MatchmakingStatus)
+async def leave_matchmaking(
+    user_id: UUID = Depends(session_auth),
+    matchmaker: Matchmaker = Depends(get_matchmaker),
+):
+    matchmaker.leave(user_id)
+    return matchmaker.status(user_id)
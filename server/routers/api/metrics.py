@@ -0,0 +1,49 @@
+from typing import Any
+
+from fastapi import APIRouter, Depends
+
+from server.core.dependencies import (
+    admin_auth,
+    get_game_manager,
+    get_load_monitor,
+    get_matchmaker,
+    get_rate_limiter,
+    get_result_sink,
+    get_token_cache,
+    get_user_session_manager,
+    get_websocket_manager,
+)
+from server.core.game import GameManager
+from server.core.matchmaking import Matchmaker
+from server.core.rate_limit import LoadMonitor, RateLimiter
+from server.core.result_sink import ResultSink
+from server.core.token_cache import TokenCache
+from server.core.user_session import UserSessionManager
+from server.core.websocket_manager import WebSocketManager
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+def get_metrics(
+    _: dict[str, Any] = Depends(admin_auth),
+    game_manager: GameManager = Depends(get_game_manager),
+    matchmaker: Matchmaker = Depends(get_matchmaker),
+    result_sink: ResultSink = Depends(get_result_sink),
+    websocket_manager: WebSocketManager = Depends(get_websocket_manager),
+    token_cache: TokenCache = Depends(get_token_cache),
+    user_session_manager: UserSessionManager = Depends(get_user_session_manager),
+    rate_limiter: RateLimiter | None = Depends(get_rate_limiter),
+    load_monitor: LoadMonitor = Depends(get_load_monitor),
+) -> dict[str, Any]:
+    return dict(
+        game_codes=game_manager.code_pool_metrics(),
+        game_queues=game_manager.queue_metrics(),
+        load=load_monitor.metrics(),
+        matchmaking=matchmaker.metrics(),
+        rate_limits=rate_limiter.metrics() if rate_limiter is not None else None,
+        results=dict(pending=result_sink.pending, unresolved=result_sink.unresolved, recorded=result_sink.recorded),
+        sessions=user_session_manager.metrics(),
+        tokens=token_cache.metrics(),
+        websockets=websocket_manager.metrics(),
+    )
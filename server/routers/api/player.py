@@ -1,13 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm.session import Session
 
-from server.core.dependencies import get_database, get_cache
+from server.core.dependencies import get_cache, get_database, RateLimit
 from server.models.dto.player import AddPlayer, ListPlayersResponse, Player as PlayerDto
 from server.models.dto.response import Response
 from server.models.orm.player import Player
 from server.utils import tabulation_util
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(RateLimit("player"))])
 
 
 @router.post("/add_player", response_model=Response)
@@ -2,10 +2,10 @@ from typing import Any
 
 from fastapi import APIRouter, Depends
 
-from server.core.dependencies import get_cache
+from server.core.dependencies import get_cache, RateLimit
 from server.models.dto.summary import SummaryResponseDto
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(RateLimit("summary"))])
 
 
 @router.get("/summary", response_model=SummaryResponseDto)
@@ -2,11 +2,18 @@ from uuid import uuid4, UUID
 
 from fastapi import APIRouter, Depends
 
-from server.core.dependencies import get_user_session_manager, session_auth
+from server.core.dependencies import (
+    get_token_cache,
+    get_user_session_manager,
+    oauth2_scheme,
+    RateLimit,
+    session_auth,
+)
+from server.core.token_cache import TokenCache
 from server.core.user_session import UserSessionManager
 from server.models.dto.user_session import LoginRequest, LoginResponse, ValidSessionResponse
 
-router = APIRouter()
+router = APIRouter(dependencies=[Depends(RateLimit("session"))])
 
 
 @router.get("/session", response_model=ValidSessionResponse)
@@ -21,6 +28,20 @@ def api_valid_session(_ = Depends(session_auth)):
     return ValidSessionResponse(success=True)
 
 
+@router.delete("/session", response_model=ValidSessionResponse)
+def api_logout(
+    token: str = Depends(oauth2_scheme),
+    _ = Depends(session_auth),
+    token_cache: TokenCache = Depends(get_token_cache),
+):
+    """
+    Revoke the session token the request was made with. Clients log in again to
+    get a new one.
+    """
+    token_cache.revoke(token)
+    return ValidSessionResponse(success=True)
+
+
 @router.post("/login", response_model=LoginResponse)
 def api_login(
     request: LoginRequest,
@@ -3,7 +3,7 @@ Client commands
 """
 from fastapi import Depends
 
-from server.constants import CommandType
+from server.constants import CommandType, Role
 from server.core.command import CommandRouter
 from server.core.dependencies import get_game_manager, get_websocket_manager
 from server.core.game import GameManager
@@ -18,13 +18,14 @@ def get_game_state_handler(
     command: DefaultCommand,
     websocket_manager: WebSocketManager = Depends(get_websocket_manager)
 ):
-    # TODO: this currently makes every client fetch an update, which is unnecessary.
-    # I think it's OK though because this endpoint is primarily for testing and will
-    # most likely not see usage in production.
-    websocket_manager.update_subscribers(command.body.game_id)
+    """
+    Clients that detect a gap in the state sequence numbers use this to request
+    a full snapshot of the game.
+    """
+    websocket_manager.resync(command.body.game_id, command.body.user_id)
 
 
-@router.command(CommandType.become_player)
+@router.command(CommandType.become_player, role=Role.SPECTATOR)
 def spectator_promote_to_player(
     command: DefaultCommand,
     game_manager: GameManager = Depends(get_game_manager),
@@ -35,63 +36,77 @@ def spectator_promote_to_player(
     request will be rejected. If there is 1 open player slot, this request will
     be accepted.
     """
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.try_promote_player(command.body.user_id)
 
 
-@router.command(CommandType.play_white_piece)
+def _play_piece(command: PlayPiece, game_manager: GameManager, player: int):
+    now = game_manager.now()
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
+        seat = game.white_player_id if player == 1 else game.black_player_id
+        if command.body.user_id != seat:
+            raise ValueError("Player does not play this color")
+        if game.turn_number % 2 != player - 1:
+            raise ValueError("Not this color's turn")
+        if command.body.current_turn != game.turn_number:
+            raise ValueError("Piece does not match current turn")
+        # a move that arrives after the clock ran out loses on time instead, which
+        # must be kept even though the move is rejected
+        flagged = game.check_flag(now)
+        if not flagged:
+            play = game.play_white if player == 1 else game.play_black
+            play(command.body.pos_x, command.body.pos_y, command.body.pos_z, now)
+    if flagged:
+        raise ValueError("Flagged on time")
+
+
+@router.command(CommandType.play_white_piece, role=Role.PLAYER)
 def play_white_piece(
     command: PlayPiece,
     game_manager: GameManager = Depends(get_game_manager),
 ):
-    with game_manager.game_context(command.body.game_id) as game:
-        if command.body.current_turn != game.turn_number:
-            raise ValueError("Piece does not match current turn")
-        game.play_white(command.body.pos_x, command.body.pos_y, command.body.pos_z)
+    _play_piece(command, game_manager, 1)
 
 
-@router.command(CommandType.play_black_piece)
+@router.command(CommandType.play_black_piece, role=Role.PLAYER)
 def play_black_piece(
     command: PlayPiece,
     game_manager: GameManager = Depends(get_game_manager),
 ):
-    with game_manager.game_context(command.body.game_id) as game:
-        if command.body.current_turn != game.turn_number:
-            raise ValueError("Piece does not match current turn")
-        game.play_black(command.body.pos_x, command.body.pos_y, command.body.pos_z)
+    _play_piece(command, game_manager, 2)
 
 
-@router.command(CommandType.leave)
+@router.command(CommandType.leave, role=Role.PLAYER)
 def player_leave(command: DefaultCommand, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.player_leave_game(command.body.user_id)
 
 
-@router.command(CommandType.forfeit)
+@router.command(CommandType.forfeit, role=Role.PLAYER)
 def player_forfeit(command: DefaultCommand, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.player_forfeit_game(command.body.user_id)
 
 
-@router.command(CommandType.start_game)
+@router.command(CommandType.start_game, role=Role.HOST)
 def start_game(command: DefaultCommand, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
-        game.start()
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
+        game.start(game_manager.now())
 
 
-@router.command(CommandType.kick_player)
+@router.command(CommandType.kick_player, role=Role.HOST)
 def kick_player(command: KickPlayer, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.remove_player(command.body.kicked_player_id)
 
 
-@router.command(CommandType.close_game)
+@router.command(CommandType.close_game, role=Role.HOST)
 def close_game(command: DefaultCommand, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.close()
 
 
-@router.command(CommandType.switch_places)
+@router.command(CommandType.switch_places, role=Role.HOST)
 def switch_places(command: DefaultCommand, game_manager: GameManager = Depends(get_game_manager)):
-    with game_manager.game_context(command.body.game_id) as game:
+    with game_manager.game_context(command.body.game_id, command.body.event_id) as game:
         game.switch_places()
@@ -28,16 +28,62 @@ def has_four_in_line(arr: list[list[list[int]]], val: int, board_size: int = 5):
         for y in range(0, board_size):
             for z in range(0, board_size):
                 if arr[x][y][z]:
-                    if (
-                        check_line(arr, val, val, x, y, z, 1, 0, 0),
-                        check_line(arr, val, val, x, y, z, 0, 1, 0),
-                        check_line(arr, val, val, x, y, z, 0, 0, 1),
-                        check_line(arr, val, val, x, y, z, 1, 1, 0),
-                        check_line(arr, val, val, x, y, z, 1, 0, 1),
-                        check_line(arr, val, val, x, y, z, -1, 0, 1),
-                        check_line(arr, val, val, x, y, z, 0, 1, 1),
-                        check_line(arr, val, val, x, y, z, 1, 1, 1),
-                        check_line(arr, val, val, x, y, z, -1, 1, 1),
-                    ):
+                    if any((
+                        check_line(arr, val, x, y, z, 1, 0, 0),
+                        check_line(arr, val, x, y, z, 0, 1, 0),
+                        check_line(arr, val, x, y, z, 0, 0, 1),
+                        check_line(arr, val, x, y, z, 1, 1, 0),
+                        check_line(arr, val, x, y, z, 1, 0, 1),
+                        check_line(arr, val, x, y, z, -1, 0, 1),
+                        check_line(arr, val, x, y, z, 0, 1, 1),
+                        check_line(arr, val, x, y, z, 1, 1, 1),
+                        check_line(arr, val, x, y, z, -1, 1, 1),
+                    )):
                         return True
     return False
+
+
+# Compact encodings for network transport.
+#
+# Boards are packed at 2 bits per cell in x, y, z order, four cells to a byte with
+# the first cell in the lowest bits. A 5x5x5 board packs into 32 bytes.
+#
+# Moves are packed into a single byte each: the high bit is the player (0 for white,
+# 1 for black) and the low 7 bits are the cell index. This requires the board to
+# have at most 128 cells.
+
+
+def cell_index(x: int, y: int, z: int, board_size: int = 5) -> int:
+    return (x * board_size + y) * board_size + z
+
+
+def pack_board(arr: list[list[list[int]]]) -> bytes:
+    cells = [val for plane in arr for row in plane for val in row]
+    packed = bytearray((len(cells) + 3) // 4)
+    for idx, val in enumerate(cells):
+        if val:
+            packed[idx >> 2] |= val << ((idx & 3) << 1)
+    return bytes(packed)
+
+
+# the four cell values packed into each possible byte
+_UNPACKED_BYTES = [tuple((byte >> shift) & 3 for shift in (0, 2, 4, 6)) for byte in range(256)]
+
+
+def unpack_board(data: bytes, board_size: int = 5) -> list[list[list[int]]]:
+    cells = [val for byte in data for val in _UNPACKED_BYTES[byte]]
+    rows = [cells[i:i + board_size] for i in range(0, board_size ** 3, board_size)]
+    return [rows[i:i + board_size] for i in range(0, board_size ** 2, board_size)]
+
+
+def pack_moves(moves: list[tuple[int, int, int, int]], board_size: int = 5) -> bytes:
+    return bytes(((player - 1) << 7) | cell_index(x, y, z, board_size) for player, x, y, z in moves)
+
+
+def unpack_moves(data: bytes, board_size: int = 5) -> list[tuple[int, int, int, int]]:
+    moves = []
+    for byte in data:
+        x, rem = divmod(byte & 0x7F, board_size * board_size)
+        y, z = divmod(rem, board_size)
+        moves.append(((byte >> 7) + 1, x, y, z))
+    return moves
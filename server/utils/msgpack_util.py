@@ -0,0 +1,72 @@
+"""
+MessagePack encoding for the `elo-msgpack` websocket subprotocol
+
+Messages have the same shape as their json counterparts, `{"type": ..., "body": ...}`,
+with these differences:
+
+* command and message types are the integer codes in `COMMAND_TYPE_CODES` and
+  `MESSAGE_TYPE_CODES`
+* UUIDs are their 16 raw bytes
+* datetimes are msgpack timestamps (extension type -1), in UTC
+* the board and move history of a game state are packed like the compact
+  subprotocol, but sent as raw bytes rather than base64
+"""
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Any
+from uuid import UUID
+
+import msgpack
+from pydantic import BaseModel
+
+from server.constants import COMMAND_TYPE_CODES, MESSAGE_TYPE_CODES, CommandType, MessageType
+
+COMMAND_TYPES_BY_CODE: dict[int, CommandType] = {code: t for t, code in COMMAND_TYPE_CODES.items()}
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, UUID):
+        return obj.bytes
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            # naive datetimes in the server are utc
+            obj = obj.replace(tzinfo=timezone.utc)
+        return msgpack.Timestamp.from_datetime(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Cannot encode {type(obj).__name__} as msgpack")
+
+
+def packb(obj: Any) -> bytes:
+    return msgpack.packb(obj, default=_default)
+
+
+def unpackb(data: bytes) -> Any:
+    """
+    Raises ValueError for anything that is not a single msgpack object.
+    """
+    return msgpack.unpackb(data, timestamp=3)
+
+
+def frame(message_type: MessageType, body: Any) -> bytes:
+    return packb({"type": MESSAGE_TYPE_CODES[message_type], "body": body})
+
+
+def _map_command_type(command: Any) -> Any:
+    if isinstance(command, dict) and isinstance(command.get("type"), int):
+        command["type"] = COMMAND_TYPES_BY_CODE.get(command["type"])
+    return command
+
+
+def parse_command(data: bytes) -> Any:
+    """
+    Turn a msgpack command, or an array of commands for a batch, into the same form
+    as a json one, ready for the command router. Command types are mapped back from
+    their codes. UUIDs stay as bytes, which pydantic accepts.
+    """
+    message = unpackb(data)
+    if isinstance(message, list):
+        return [_map_command_type(command) for command in message]
+    return _map_command_type(message)
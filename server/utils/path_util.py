@@ -13,6 +13,14 @@ PROJECT_ROOT = Path(os.getcwd())
 RESOURCES = PROJECT_ROOT("resources")
 DATABASE = RESOURCES("primary.db")
 TEST_DATABASE = RESOURCES("test.db")
+GAME_LOG = RESOURCES("games.log")
+SHARD_COORDINATOR = RESOURCES("shards.db")
+SESSION_STORE = RESOURCES("sessions.db")
+RATINGS_SNAPSHOT = RESOURCES("ratings.snapshot")
+
+
+def shard_game_log(index: int) -> Path:
+    return RESOURCES(f"games-{index}.log")
 
 
 def path_to_sqlalchemy_uri(path: Path) -> str:
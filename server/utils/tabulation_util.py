@@ -1,39 +1,307 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
 from collections import defaultdict
+from datetime import datetime
 from typing import Any
+from uuid import UUID
 
+import msgpack
+
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.session import Session
 
 from server.core import env
-from server.models.dto.summary import Summary
+from server.models.dto.summary import MatchRecord, PlayerRank, Summary
 from server.models.orm.match import Match
 from server.models.orm.player import Player
 from server.utils import elo_util
 
+logger = logging.getLogger(__name__)
+
+# K value used for every match
+K_ELO = 128
+
+# rating snapshots start with the magic, the format version and the length of a json
+# header, followed by the header, the packed rating state and the summary json
+SNAPSHOT_MAGIC = b"ELOSNAP\0"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_PREFIX = struct.Struct("<8sHI")
+
+# held while the rating state in the cache is rebuilt or changed, so that a rebuild
+# and an incremental update never interleave
+CACHE_LOCK = threading.RLock()
+
+
+class RatingState:
+    """
+    Running Elo ratings, win and loss counts and match history. Matches must be
+    applied in the order they were played, after which applying one more match does
+    not depend on how many came before it.
+    """
+
+    elo: dict[str, float]
+    wins: dict[str, int]
+    loss: dict[str, int]
+    # oldest first
+    match_history: list[MatchRecord]
+    # the last match applied, None if it was not recorded
+    latest_match_id: UUID | None
+
+    def __init__(self, player_names: list[str] | None = None):
+        self.elo = dict()
+        self.wins = defaultdict(lambda: 0)
+        self.loss = defaultdict(lambda: 0)
+        self.match_history = list()
+        self.latest_match_id = None
+        for name in player_names or []:
+            self.add_player(name)
+
+    @property
+    def match_count(self) -> int:
+        return len(self.match_history)
+
+    def add_player(self, name: str) -> None:
+        self.elo.setdefault(name, env.STARTING_ELO)
+
+    def apply(self, winner: str, loser: str, created_at: datetime, match_id: UUID | None = None) -> None:
+        self.latest_match_id = match_id
+        self.add_player(winner)
+        self.add_player(loser)
+        self.wins[winner] += 1
+        self.loss[loser] += 1
+        self.elo[winner], self.elo[loser] = elo_util.calculate_elo(self.elo[winner], self.elo[loser], K_ELO)
+        self.match_history.append(MatchRecord(winner=winner, loser=loser, date=created_at.isoformat()))
+
+    def pack(self) -> bytes:
+        return msgpack.packb(dict(
+            elo=self.elo,
+            wins=dict(self.wins),
+            loss=dict(self.loss),
+            match_history=[(m.winner, m.loser, m.date) for m in self.match_history],
+            latest_match_id=self.latest_match_id.bytes if self.latest_match_id is not None else None,
+        ))
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "RatingState":
+        fields = msgpack.unpackb(data)
+        state = cls()
+        state.elo = fields["elo"]
+        state.wins.update(fields["wins"])
+        state.loss.update(fields["loss"])
+        state.match_history = [
+            MatchRecord.construct(winner=winner, loser=loser, date=date)
+            for winner, loser, date in fields["match_history"]
+        ]
+        if fields["latest_match_id"] is not None:
+            state.latest_match_id = UUID(bytes=fields["latest_match_id"])
+        return state
+
+    def summary(self) -> Summary:
+        ordered_players = [
+            PlayerRank(name=name, elo=score, win=self.wins.get(name, 0), loss=self.loss.get(name, 0))
+            for name, score in self.elo.items()
+        ]
+        ordered_players.sort(key=lambda x: x.elo, reverse=True)
+        return Summary(
+            last_hydrated=datetime.utcnow().isoformat(),
+            ordered_players=ordered_players,
+            match_history=list(reversed(self.match_history)),
+        )
+
+
+def _publish(cache: dict[Any, Any], state: RatingState) -> None:
+    cache["ratings"] = state
+    cache["summary_json_str"] = state.summary().json()
+    # current rating of each player by name, read by matchmaking
+    cache["elo"] = state.elo
+    # bumped on every change, so the snapshot is only rewritten when there is news
+    cache["ratings_version"] = cache.get("ratings_version", 0) + 1
+
+
+def write_snapshot(path: str, state: RatingState, summary_json: str) -> None:
+    """
+    Write the rating state and its rendered summary to a snapshot file. The file is
+    replaced in one step, so readers see either the old snapshot or the new one.
+    Workers may write the snapshot at the same time, so each writes its own
+    temporary file.
+    """
+    _write_snapshot_data(path, _pack_snapshot(state, summary_json))
+
+
+def save_snapshot(cache: dict[Any, Any], path: str, written_version: int | None = None) -> int | None:
+    """
+    Write the rating state in the cache to a snapshot file, unless it has not
+    changed since `written_version`. Returns the version of the state now on disk.
+    The state is packed under the cache lock, and written to disk outside it, so
+    rating updates never wait on the disk.
+    """
+    with CACHE_LOCK:
+        version = cache.get("ratings_version")
+        if version is None or version == written_version:
+            return written_version
+        data = _pack_snapshot(cache["ratings"], cache["summary_json_str"])
+    _write_snapshot_data(path, data)
+    return version
+
+
+def _pack_snapshot(state: RatingState, summary_json: str) -> bytes:
+    packed_state = state.pack()
+    summary = summary_json.encode()
+    header = json.dumps(dict(
+        match_count=state.match_count,
+        latest_match_id=state.latest_match_id.hex if state.latest_match_id is not None else None,
+        state_length=len(packed_state),
+        summary_length=len(summary),
+    )).encode()
+    return b"".join((
+        _SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)),
+        header,
+        packed_state,
+        summary,
+    ))
+
+
+def _write_snapshot_data(path: str, data: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            # the rename must not reach the disk before the contents
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_snapshot(cache: dict[Any, Any], path: str) -> bool:
+    """
+    Publish the rating state and summary from a snapshot file without touching the
+    database. Returns False if there is no usable snapshot. The snapshot may be
+    behind the database, so follow up with `catch_up`.
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, header_length = _SNAPSHOT_PREFIX.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                logger.info(f"Ignoring ratings snapshot with version {version}")
+                return False
+            offset = _SNAPSHOT_PREFIX.size
+            header = json.loads(data[offset:offset + header_length])
+            offset += header_length
+            state = RatingState.unpack(data[offset:offset + header["state_length"]])
+            offset += header["state_length"]
+            summary_json = data[offset:offset + header["summary_length"]].decode()
+    except (OSError, ValueError, KeyError, struct.error, msgpack.UnpackException):
+        logger.exception("Could not load the ratings snapshot")
+        return False
+    with CACHE_LOCK:
+        cache["ratings"] = state
+        cache["summary_json_str"] = summary_json
+        cache["elo"] = state.elo
+    return True
+
+
+def catch_up(cache: dict[Any, Any], db: Session) -> None:
+    """
+    Bring rating state loaded from a snapshot up to date with the database. If the
+    snapshot's last match is still where it was, only the matches recorded after it
+    are applied. If the snapshot does not line up with the database, for example
+    after a match was undone, the state is rebuilt. Also used to pick up matches and
+    players recorded by other worker processes, so it returns early when nothing
+    changed.
+    """
+    with CACHE_LOCK:
+        state = cache.get("ratings")
+        count = db.query(Match).count()
+        # players may share a name, and are rated by it
+        player_count = db.query(Player.name).distinct().count()
+        ordered = db.query(Match).order_by(Match.created_at.asc(), Match.uuid.asc())
+        if state is not None and count == state.match_count and player_count == len(state.elo):
+            newest = db.query(Match.uuid).order_by(Match.created_at.desc(), Match.uuid.desc()).first()
+            if (newest[0] if newest is not None else None) == state.latest_match_id:
+                return
+        last = ordered.offset(state.match_count - 1).first() if state is not None and state.match_count else None
+        if (
+            state is None
+            or count <= state.match_count
+            or (state.match_count and (last is None or last.uuid != state.latest_match_id))
+        ):
+            logger.info("Cached ratings do not match the recorded matches, rebuilding")
+            update_cache(cache, db)
+            return
+        newer = ordered.options(joinedload(Match.winner), joinedload(Match.loser)).offset(state.match_count).all()
+        logger.info(f"Applying {len(newer)} matches recorded since the ratings snapshot")
+        for match in newer:
+            state.apply(match.winner.name, match.loser.name, match.created_at, match.uuid)
+        if player_count != len(state.elo):
+            # players added without playing yet
+            for (name,) in db.query(Player.name).distinct():
+                state.add_player(name)
+        _publish(cache, state)
+
 
 def update_cache(cache: dict[Any, Any], db: Session) -> None:
-    # TODO: this currently updates the cache from scratch each time.
-    # This is not necessary though as we should be able to perform an incremental update
-    # to the elo scores at each point.
-    # compute new win-loss and elo scores
-    players = {p.name: p for p in db.query(Player).all()}
-    matches = db.query(Match).order_by(Match.created_at.asc()).all()
-    elo = {p: env.STARTING_ELO for p in players}
-    wins = defaultdict(lambda: 0)
-    loss = defaultdict(lambda: 0)
-    for match in matches:
-        winner: Player = match.winner
-        loser: Player = match.loser
-        wins[winner.name] += 1
-        loss[loser.name] += 1
-        # no farming noobs
-        decay_factor = (wins[winner.name] + wins[loser.name] + loss[winner.name] + loss[loser.name]) // 2
-        #k_elo = max(16, env.ELO_K_VALUE_CEILING // decay_factor)
-        k_elo = 128
-        print(k_elo)
-        new_winner_elo, new_loser_elo = elo_util.calculate_elo(elo[winner.name], elo[loser.name], k_elo)
-        elo[winner.name] = new_winner_elo
-        elo[loser.name] = new_loser_elo
-        print(elo)
-
-    summary = Summary.create_from_cache(elo, wins, loss, matches)
-    cache["summary_json_str"] = summary.json()
+    """
+    Rebuild the rating state from every match in the database.
+    """
+    with CACHE_LOCK:
+        state = RatingState([p.name for p in db.query(Player).all()])
+        matches = (
+            db.query(Match)
+            .options(joinedload(Match.winner), joinedload(Match.loser))
+            .order_by(Match.created_at.asc(), Match.uuid.asc())
+            .all()
+        )
+        for match in matches:
+            state.apply(match.winner.name, match.loser.name, match.created_at, match.uuid)
+        _publish(cache, state)
+
+
+def apply_matches(
+    cache: dict[Any, Any],
+    db: Session,
+    results: list[tuple[str, str, datetime]],
+) -> list[tuple[str, str, datetime]]:
+    """
+    Record `(winner, loser, played_at)` results as matches between the players with
+    those names, and apply them to the cached rating state. The matches are
+    committed in one transaction and the summary is rendered once for all of them.
+
+    Players are only created through the player api. Results naming a player that
+    does not exist are not recorded, and are returned so the caller can keep them.
+
+    Results should be newer than every match already recorded, otherwise the
+    cached ratings drift from a full rebuild until the next one.
+    """
+    with CACHE_LOCK:
+        names = {name for winner, loser, _ in results for name in (winner, loser)}
+        players = {p.name: p for p in db.query(Player).filter(Player.name.in_(names)).all()}
+        unknown = [result for result in results if result[0] not in players or result[1] not in players]
+        results = [result for result in results if result[0] in players and result[1] in players]
+        if not results:
+            return unknown
+        matches = [
+            Match(winner_id=players[winner].uuid, loser_id=players[loser].uuid, created_at=played_at)
+            for winner, loser, played_at in results
+        ]
+        db.add_all(matches)
+        db.flush()
+        match_ids = [match.uuid for match in matches]
+        db.commit()
+
+        state = cache.get("ratings")
+        if state is None:
+            # nothing cached yet, so there is nothing to update incrementally
+            update_cache(cache, db)
+            return unknown
+        for (winner, loser, played_at), match_id in zip(results, match_ids):
+            state.apply(winner, loser, played_at, match_id)
+        _publish(cache, state)
+        return unknown
@@ -1,17 +1,40 @@
+import asyncio
+import base64
+import datetime
+import json
 import os
-import threading
-import time
+import tempfile
 import unittest
+import uuid
 
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 
+from server.core import env
 from server.core.app import create_app
-from server.core.database import init_db, get_sessionlocal
-from server.core.dependencies import get_game_manager
-from server.models.dto.game import CreateGameRequest, CreateGameResponse
-from server.models.orm.game import GameState
-from server.utils import path_util
+from server.core.archiver import GameArchiver
+from server.core.command_results import CommandResultCache
+from server.core.database import Base, init_db, get_sessionlocal
+from server.core.dependencies import get_game_manager, get_load_monitor, get_rate_limiter, get_websocket_manager
+from server.models.dto.game import CreateGameRequest, CreateGameResponse, ListLobbiesResponse
+from server.constants import CommandType, Role, Subprotocol
+from server.core.game import GameManager
+from server.core.game_log import GameLog
+from server.core.game_queue import GameQueueFull
+from server.core.rate_limit import Budget, LoadMonitor, RateLimiter
+from server.core.result_sink import ResultSink
+from server.core.timer_wheel import TimerWheel
+from server.core.websocket_manager import WebSocketManager
+from server.models.orm.archived_game import ArchivedGame
+from server.models.orm.match import Match
+from server.models.orm.player import Player
+from server.core.game_code import CODE_ALLOCATOR, GameCodeAllocator
+from server.models.dto.command import PlayPiece
+from server.models.orm.game import EndOfGameTrigger, GameState, Phase, TimeControl
+from server.routers.command import client
+from server.utils import board_util, msgpack_util, path_util, tabulation_util
 
 
 class TestWebSocket(unittest.TestCase):
@@ -70,6 +93,1056 @@ class TestWebSocket(unittest.TestCase):
         self.assertEqual(game.white_is_connected, game_by_code.white_is_connected)
         self.assertEqual(game.black_is_connected, game_by_code.black_is_connected)
 
+    def receive_ack(self, ws) -> dict:
+        while True:
+            message = ws.receive_json()
+            if isinstance(message, str):
+                message = json.loads(message)
+            if message["type"] == "acknowledge":
+                return message["body"]
+
+    def command(self, command_type: str, game_id, user_id, **fields) -> dict:
+        body = dict(timestamp=datetime.datetime.utcnow().isoformat(), game_id=str(game_id), user_id=str(user_id))
+        body.update(fields)
+        return dict(type=command_type, body=body)
+
+    def test_commands_are_dispatched_and_acknowledged(self):
+        game = self.create_game()
+        host_token = self.token
+        with self.client.websocket_connect(f"/api/game/{game.uuid}/ws?token={host_token}") as ws:
+            command = self.command("start_game", game.uuid, game.host_player_id)
+            ws.send_json(command)
+            ack = self.receive_ack(ws)
+            self.assertTrue(ack["success"], ack)
+            ws.send_json(self.command(
+                "play_white_piece", game.uuid, game.host_player_id, current_turn=0, pos_x=1, pos_y=2, pos_z=3
+            ))
+            ack = self.receive_ack(ws)
+            self.assertTrue(ack["success"], ack)
+            ws.send_json({"garbage": True})
+            self.assertFalse(self.receive_ack(ws)["success"])
+        self.assertEqual(self.game_manager.get_game_by_id(game.uuid).move_history, [(1, 1, 2, 3)])
+
+        # spectators cannot use host or player commands
+        self.login()
+        with self.client.websocket_connect(f"/api/game/{game.uuid}/ws?token={self.token}") as ws:
+            ws.send_json(self.command("close_game", game.uuid, game.host_player_id))
+            ack = self.receive_ack(ws)
+            self.assertFalse(ack["success"])
+        self.assertEqual(self.game_manager.get_game_by_id(game.uuid).phase, Phase.RUNNING)
+
+    def test_batched_commands_are_acknowledged_together(self):
+        game = self.create_game()
+        with self.client.websocket_connect(f"/api/game/{game.uuid}/ws?token={self.token}") as ws:
+            batch = [
+                self.command("start_game", game.uuid, game.host_player_id),
+                self.command(
+                    "play_white_piece", game.uuid, game.host_player_id,
+                    event_id=uuid.uuid4().hex, current_turn=0, pos_x=0, pos_y=0, pos_z=0,
+                ),
+                # occupied
+                self.command(
+                    "play_white_piece", game.uuid, game.host_player_id, current_turn=1, pos_x=0, pos_y=0, pos_z=0
+                ),
+                self.command("close_game", game.uuid, game.host_player_id),
+            ]
+            ws.send_json(batch)
+            while True:
+                message = ws.receive_json()
+                if isinstance(message, str):
+                    message = json.loads(message)
+                if message["type"] == "acknowledge_batch":
+                    break
+        results = message["body"]["results"]
+        self.assertEqual([r["success"] for r in results], [True, True, False, True])
+        self.assertEqual(results[1]["event_id"], uuid.UUID(batch[1]["body"]["event_id"]).hex)
+        game = self.game_manager.get_game_by_id(game.uuid)
+        self.assertEqual(game.move_history, [(1, 0, 0, 0)])
+        self.assertEqual(game.end_of_game_trigger, EndOfGameTrigger.LOBBY_CLOSE)
+
+    def test_retried_commands_are_not_run_again(self):
+        game = self.create_game()
+        with self.client.websocket_connect(f"/api/game/{game.uuid}/ws?token={self.token}") as ws:
+            ws.send_json(self.command("start_game", game.uuid, game.host_player_id))
+            self.assertTrue(self.receive_ack(ws)["success"])
+            move = self.command(
+                "play_white_piece", game.uuid, game.host_player_id,
+                event_id=uuid.uuid4().hex, current_turn=0, pos_x=0, pos_y=0, pos_z=0,
+            )
+            occupied = self.command(
+                "play_white_piece", game.uuid, game.host_player_id,
+                event_id=uuid.uuid4().hex, current_turn=1, pos_x=0, pos_y=0, pos_z=0,
+            )
+            ws.send_json(move)
+            self.assertTrue(self.receive_ack(ws)["success"])
+            ws.send_json(occupied)
+            error = self.receive_ack(ws)["error"]
+            self.assertIsNotNone(error)
+            # the retries would now fail on the turn number if they ran again
+            ws.send_json(move)
+            ack = self.receive_ack(ws)
+            self.assertTrue(ack["success"], ack)
+            self.assertEqual(ack["event_id"], move["body"]["event_id"])
+            ws.send_json([occupied, move])
+            while True:
+                message = ws.receive_json()
+                if isinstance(message, str):
+                    message = json.loads(message)
+                if message["type"] == "acknowledge_batch":
+                    break
+        self.assertEqual([(r["success"], r["error"]) for r in message["body"]["results"]], [(False, error), (True, None)])
+        self.assertEqual(self.game_manager.get_game_by_id(game.uuid).move_history, [(1, 0, 0, 0)])
+
+    def test_revoked_session_tokens_are_rejected(self):
+        self.client.get("/api/session").raise_for_status()
+        self.client.delete("/api/session").raise_for_status()
+        self.assertEqual(self.client.get("/api/session").status_code, 401)
+        self.assertEqual(self.client.post("/api/game", json=CreateGameRequest().dict()).status_code, 401)
+
+    def test_requests_past_the_budget_or_while_overloaded_are_turned_away(self):
+        limiter = RateLimiter({"game": Budget(1, 2), "summary": Budget(1, 2)})
+        monitor = LoadMonitor(self.game_manager)
+        self.app.dependency_overrides[get_rate_limiter] = lambda: limiter
+        self.app.dependency_overrides[get_load_monitor] = lambda: monitor
+        try:
+            for _ in range(2):
+                self.client.get("/api/game").raise_for_status()
+            resp = self.client.get("/api/game")
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+            # budgets are per user
+            self.login()
+            self.client.get("/api/game").raise_for_status()
+            # except on routes that do not need a session, where a new token is no way around them
+            for _ in range(2):
+                self.client.get("/api/summary").raise_for_status()
+            self.login()
+            self.assertEqual(self.client.get("/api/summary").status_code, 429)
+
+            monitor.overloaded = True
+            self.assertEqual(self.client.get("/api/game").status_code, 503)
+            self.assertEqual((limiter.limited, monitor.shed), (2, 1))
+        finally:
+            del self.app.dependency_overrides[get_rate_limiter]
+            del self.app.dependency_overrides[get_load_monitor]
+
+    def test_metrics_need_the_admin_token(self):
+        self.assertEqual(self.client.get("/api/metrics").status_code, 401)
+        form = {"grant_type": "password", "username": env.AUTH_USERNAME, "password": env.AUTH_PASSWORD}
+        resp = self.client.post("/api/token", data=form)
+        resp.raise_for_status()
+        headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+        self.assertIn("rate_limits", self.client.get("/api/metrics", headers=headers).json())
+
+    def test_msgpack_subprotocol(self):
+        game = self.create_game()
+        url = f"/api/game/{game.uuid}/ws?token={self.token}"
+        with self.client.websocket_connect(url, subprotocols=["elo-msgpack"]) as ws:
+            self.assertEqual(ws.accepted_subprotocol, "elo-msgpack")
+            self.assertEqual(msgpack_util.unpackb(ws.receive_bytes())["type"], 1)
+            event_id = uuid.uuid4()
+            ws.send_bytes(msgpack_util.packb(dict(type=6, body=dict(
+                timestamp=datetime.datetime.utcnow(),
+                event_id=event_id,
+                game_id=game.uuid,
+                user_id=game.host_player_id,
+            ))))
+            while True:
+                message = msgpack_util.unpackb(ws.receive_bytes())
+                if message["type"] == 0:
+                    break
+            self.assertTrue(message["body"]["success"], message)
+            self.assertEqual(message["body"]["event_id"], event_id.bytes)
+        self.assertEqual(self.game_manager.get_game_by_id(game.uuid).phase, Phase.RUNNING)
+
+    def test_list_open_lobbies_hosted_by_user(self):
+        games = [self.create_game() for _ in range(3)]
+        resp = self.client.get(f"/api/game/list?open_slot=true&host_player_id={games[0].host_player_id}&limit=2")
+        resp.raise_for_status()
+        page = ListLobbiesResponse.parse_raw(resp.content)
+        self.assertEqual([lobby.game_id for lobby in page.lobbies], [games[2].uuid, games[1].uuid])
+        resp = self.client.get(
+            f"/api/game/list?open_slot=true&host_player_id={games[0].host_player_id}&cursor={page.next_cursor}"
+        )
+        resp.raise_for_status()
+        page = ListLobbiesResponse.parse_raw(resp.content)
+        self.assertEqual([lobby.game_id for lobby in page.lobbies], [games[0].uuid])
+        self.assertIsNone(page.next_cursor)
+
+
+class TestGameIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.game_manager = GameManager()
+        self.hosts = [uuid.uuid4() for _ in range(3)]
+        self.games = []
+        for idx in range(9):
+            host = self.hosts[idx % 3]
+            game = GameState(host_player_id=host, white_player_id=host, black_player_id=None)
+            self.game_manager.set_game(game)
+            self.games.append(game)
+
+    def list_ids(self, **filters) -> list[uuid.UUID]:
+        games, _ = self.game_manager.list_games(**filters)
+        return [game.uuid for game in games]
+
+    def test_indexes_follow_game_changes(self):
+        joiner = uuid.uuid4()
+        with self.game_manager.game_context(self.games[4].uuid) as game:
+            game.black_player_id = joiner
+        with self.game_manager.game_context(self.games[4].uuid) as game:
+            game.start()
+        with self.game_manager.game_context(self.games[7].uuid) as game:
+            game.close()
+
+        self.assertEqual(self.list_ids(player_id=joiner), [self.games[4].uuid])
+        self.assertEqual(self.list_ids(phase=Phase.RUNNING), [self.games[4].uuid])
+        self.assertEqual(self.list_ids(phase=Phase.FINISHED), [self.games[7].uuid])
+        self.assertEqual(
+            self.list_ids(open_slot=True, host_player_id=self.hosts[1]),
+            [self.games[1].uuid],
+        )
+        self.assertEqual(
+            self.list_ids(open_slot=False, host_player_id=self.hosts[1]),
+            [self.games[7].uuid, self.games[4].uuid],
+        )
+
+        self.game_manager.evict_game(self.games[4].uuid)
+        self.assertEqual(self.list_ids(player_id=joiner), [])
+        self.assertEqual(self.list_ids(phase=Phase.RUNNING), [])
+
+    def test_cursor_pages_through_every_game_once(self):
+        seen = []
+        cursor = None
+        while True:
+            games, cursor = self.game_manager.list_games(phase=Phase.INITIALIZED, cursor=cursor, limit=4)
+            seen.extend(game.uuid for game in games)
+            if cursor is None:
+                break
+        # the test game is listed too
+        self.assertEqual(seen[:9], [game.uuid for game in reversed(self.games)])
+        self.assertEqual(len(seen), 10)
+
+    def test_replaced_games_are_listed_as_they_are_now(self):
+        replacement = self.games[2].copy(deep=True)
+        replacement.start()
+        self.game_manager.set_game(replacement)
+        games, _ = self.game_manager.list_games(phase=Phase.RUNNING)
+        self.assertEqual(len(games), 1)
+        self.assertIs(games[0], replacement)
+
+
+class TestGameContext(unittest.TestCase):
+
+    def setUp(self):
+        self.game_manager = GameManager()
+        self.game = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        self.game.phase = Phase.RUNNING
+        self.game_manager.set_game(self.game)
+
+    def test_commit_keeps_changes(self):
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_white(0, 0, 0)
+        self.assertEqual(self.game.board[0][0][0], 1)
+        self.assertEqual(self.game.turn_number, 1)
+        self.assertEqual(self.game.move_history, [(1, 0, 0, 0)])
+        self.assertFalse(self.game.in_transaction)
+
+    def test_rollback_restores_fields_cells_and_moves(self):
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_white(0, 0, 0)
+        with self.assertRaises(ValueError):
+            with self.game_manager.game_context(self.game.uuid) as game:
+                game.play_black(1, 1, 1)
+                game.play_white(2, 2, 2)
+                game.play_black(1, 1, 1)  # occupied
+        self.assertIs(self.game_manager.get_game_by_id(self.game.uuid), self.game)
+        self.assertEqual(self.game.board[1][1][1], 0)
+        self.assertEqual(self.game.board[2][2][2], 0)
+        self.assertEqual(self.game.turn_number, 1)
+        self.assertEqual(self.game.move_history, [(1, 0, 0, 0)])
+        self.assertEqual(self.game.phase, Phase.RUNNING)
+        self.assertFalse(self.game.in_transaction)
+
+    def test_five_in_line_finishes_game(self):
+        for z in range(5):
+            with self.game_manager.game_context(self.game.uuid) as game:
+                game.play_white(0, 0, z)
+            if z < 4:
+                with self.game_manager.game_context(self.game.uuid) as game:
+                    game.play_black(1, 0, z)
+        self.assertEqual(self.game.phase, Phase.FINISHED)
+        self.assertEqual(self.game.winner, 1)
+
+    def test_frames_since_returns_deltas(self):
+        seq = self.game.seq
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_white(1, 2, 3)
+        frames = [json.loads(f) for f in self.game_manager.frames_since(self.game.uuid, seq)]
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]["type"], "game_state_delta")
+        delta = frames[0]["body"]
+        self.assertEqual(delta["seq"], seq + 1)
+        self.assertEqual(delta["cells"], [[1, 2, 3, 1]])
+        self.assertEqual(delta["fields"]["turn_number"], 1)
+        self.assertNotIn("board", delta["fields"])
+        self.assertEqual(self.game_manager.frames_since(self.game.uuid, seq + 1), [])
+
+    def test_changes_do_not_serialize_the_whole_game(self):
+        def network_json(game):
+            raise AssertionError("snapshot built for a change")
+
+        seq = self.game.seq
+        original, GameState.network_json = GameState.network_json, network_json
+        try:
+            with self.game_manager.game_context(self.game.uuid) as game:
+                game.play_white(0, 0, 0)
+            self.assertEqual(len(self.game_manager.frames_since(self.game.uuid, seq)), 1)
+        finally:
+            GameState.network_json = original
+
+    def test_frames_since_falls_back_to_snapshot(self):
+        seq = self.game.seq
+        with self.assertRaises(ValueError):
+            with self.game_manager.game_context(self.game.uuid) as game:
+                game.start()
+        # failed transactions do not publish a version
+        self.assertEqual(self.game.seq, seq)
+        frames = self.game_manager.frames_since(self.game.uuid, None)
+        self.assertEqual(len(frames), 1)
+        snapshot = json.loads(frames[0])
+        self.assertEqual(snapshot["type"], "game_state")
+        self.assertEqual(snapshot["body"]["seq"], seq)
+        self.assertEqual(len(snapshot["body"]["board"]), 5)
+
+    def test_compact_snapshot(self):
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_white(4, 3, 2)
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_black(0, 1, 2)
+        frame = self.game_manager.snapshot_frame(self.game.uuid, Subprotocol.compact)
+        body = json.loads(frame)["body"]
+        self.assertEqual(body["seq"], self.game.seq)
+        board = board_util.unpack_board(base64.b64decode(body["board"]))
+        self.assertEqual(board, self.game.board)
+        moves = board_util.unpack_moves(base64.b64decode(body["move_history"]))
+        self.assertEqual(moves, [(1, 4, 3, 2), (2, 0, 1, 2)])
+        self.assertLess(len(frame), len(self.game_manager.snapshot_frame(self.game.uuid)))
+
+
+    def test_msgpack_frames(self):
+        seq = self.game.seq
+        with self.game_manager.game_context(self.game.uuid) as game:
+            game.play_white(4, 3, 2)
+        snapshot = msgpack_util.unpackb(self.game_manager.snapshot_frame(self.game.uuid, Subprotocol.msgpack))
+        self.assertEqual(snapshot["type"], 1)
+        self.assertEqual(uuid.UUID(bytes=snapshot["body"]["uuid"]), self.game.uuid)
+        self.assertEqual(board_util.unpack_board(snapshot["body"]["board"]), self.game.board)
+        self.assertEqual(snapshot["body"]["modified_at"].replace(tzinfo=None), self.game.modified_at)
+        (frame,) = self.game_manager.frames_since(self.game.uuid, seq, Subprotocol.msgpack)
+        delta = msgpack_util.unpackb(frame)
+        self.assertEqual(delta["type"], 2)
+        self.assertEqual(delta["body"]["cells"], [[4, 3, 2, 1]])
+        self.assertLess(len(frame), len(self.game_manager.frames_since(self.game.uuid, seq)[0]))
+
+
+class TestGameCodeAllocator(unittest.TestCase):
+
+    def test_allocates_every_code_once_then_recycles(self):
+        allocator = GameCodeAllocator(alphabet="ABC", length=2)
+        codes = [allocator.allocate() for _ in range(9)]
+        self.assertEqual(len(set(codes)), 9)
+        self.assertEqual(allocator.metrics()["pressure"], 1.0)
+        with self.assertRaises(RuntimeError):
+            allocator.allocate()
+        allocator.release(codes[3])
+        allocator.release(codes[5])
+        self.assertEqual(allocator.allocate(), codes[3])
+        self.assertEqual(allocator.allocate(), codes[5])
+
+    def test_code_order_depends_only_on_the_key(self):
+        def codes(key: bytes) -> list[str]:
+            allocator = GameCodeAllocator(key=key)
+            return [allocator.allocate() for _ in range(50)]
+
+        self.assertEqual(codes(b"first"), codes(b"first"))
+        self.assertNotEqual(codes(b"first"), codes(b"second"))
+        # consecutive codes are not a fixed step apart in the code space
+        allocator = GameCodeAllocator(alphabet="ABCDEFGH", length=3, key=b"first")
+        values = [allocator._permute(index) for index in range(50)]
+        self.assertGreater(len({(b - a) % 512 for a, b in zip(values, values[1:])}), 1)
+
+    def test_skips_reserved_codes(self):
+        allocator = GameCodeAllocator(alphabet="AB", length=2)
+        allocator.reserve("AA")
+        allocator.reserve("BB")
+        codes = {allocator.allocate(), allocator.allocate()}
+        self.assertEqual(codes, {"AB", "BA"})
+        self.assertEqual(allocator.metrics()["live"], 4)
+        with self.assertRaises(RuntimeError):
+            allocator.allocate()
+
+
+class TestGameLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "games.log")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_recover_from_snapshots_and_deltas(self):
+        game_log = GameLog(self.path, snapshot_interval=4)
+        game_manager = GameManager(game_log)
+        game = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        game_manager.set_game(game)
+        with game_manager.game_context(game.uuid) as g:
+            g.start()
+        for i in range(4):
+            with game_manager.game_context(game.uuid) as g:
+                g.play_white(i, 0, 0)
+            with game_manager.game_context(game.uuid) as g:
+                g.play_black(i, 1, 0)
+        game_log.close()
+
+        # records that cannot be applied, then a crash in the middle of writing one
+        with open(self.path, "a") as f:
+            f.write('{"op": "delta", "seq": 100}\n[]\n')
+            f.write(f'{{"op": "snapshot", "game_id": "{game.uuid}", "seq"')
+
+        recovered = GameManager(GameLog(self.path)).get_game_by_id(game.uuid)
+        self.assertIsNotNone(recovered)
+        self.assertEqual(recovered.seq, game.seq)
+        self.assertEqual(recovered.board, game.board)
+        self.assertEqual(recovered.move_history, game.move_history)
+        self.assertEqual(recovered.turn_number, 8)
+        self.assertEqual(recovered.phase, Phase.RUNNING)
+        self.assertEqual(GameManager(GameLog(self.path)).get_game_by_code(game.code).uuid, game.uuid)
+
+    def test_compaction_runs_in_the_background_and_keeps_later_records(self):
+        game_log = GameLog(self.path, snapshot_interval=100, compact_after=4)
+        game_manager = GameManager(game_log)
+        game = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        game_manager.set_game(game)
+
+        async def play():
+            with game_manager.game_context(game.uuid) as g:
+                g.start()
+            for i in range(3):
+                with game_manager.game_context(game.uuid) as g:
+                    g.play_white(i, 0, 0)
+            # the compaction has started, these moves are recorded while it runs
+            await asyncio.sleep(0)
+            for i in range(3):
+                with game_manager.game_context(game.uuid) as g:
+                    g.play_black(i, 1, 0)
+            while game_manager._compaction is not None:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(play())
+        game_log.close()
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        # one snapshot per game, then the moves recorded during the compaction
+        self.assertEqual([r["op"] for r in records], ["snapshot"] * 2 + ["delta"] * 3)
+        recovered = GameManager(GameLog(self.path)).get_game_by_id(game.uuid)
+        self.assertEqual(recovered.seq, game.seq)
+        self.assertEqual(recovered.board, game.board)
+        self.assertEqual(recovered.move_history, game.move_history)
+
+    def test_recovered_lobbies_close_unless_host_reconnects(self):
+        game_log = GameLog(self.path)
+        game = GameManager(game_log).create_game(uuid.uuid4())
+        game_log.close()
+
+        clock = FakeClock()
+        timers = TimerWheel(clock=clock)
+        game_manager = GameManager(GameLog(self.path), timers=timers)
+
+        async def run():
+            clock.now += 61.0
+            timers.advance()
+            for _ in range(5):
+                await asyncio.sleep(0)
+
+        asyncio.run(run())
+        recovered = game_manager.get_game_by_id(game.uuid)
+        self.assertEqual(recovered.end_of_game_trigger, EndOfGameTrigger.LOBBY_CLOSE)
+
+
+class TestGameQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.game_manager = GameManager(max_queue_depth=2)
+        self.game = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        self.game.phase = Phase.RUNNING
+        self.game_manager.set_game(self.game)
+
+    def test_commands_for_a_game_do_not_interleave(self):
+        async def play(x: int, wait: float):
+            turn = self.game.turn_number
+            # no other command for the game runs while this one waits
+            await asyncio.sleep(wait)
+            with self.game_manager.game_context(self.game.uuid) as game:
+                self.assertEqual(game.turn_number, turn)
+                game.play_white(x, 0, 0)
+            return turn
+
+        async def run():
+            return await asyncio.gather(
+                self.game_manager.submit(self.game.uuid, lambda: play(0, 0.02)),
+                self.game_manager.submit(self.game.uuid, lambda: play(1, 0.0)),
+            )
+
+        self.assertEqual(asyncio.run(run()), [0, 1])
+        self.assertEqual(self.game.move_history, [(1, 0, 0, 0), (1, 1, 0, 0)])
+        self.assertEqual(self.game_manager.queue_metrics()["latency_ms"]["count"], 2)
+
+    def test_errors_are_returned_to_the_submitter(self):
+        def bad_move():
+            with self.game_manager.game_context(self.game.uuid) as game:
+                game.play_white(0, 0, 0)
+                game.play_black(0, 0, 0)
+
+        async def run():
+            with self.assertRaises(ValueError):
+                await self.game_manager.submit(self.game.uuid, bad_move)
+            # the queue keeps serving after a failed command
+            return await self.game_manager.submit(self.game.uuid, lambda: self.game.turn_number)
+
+        self.assertEqual(asyncio.run(run()), 0)
+
+    def test_handlers_cancelled_on_their_own_do_not_stop_the_queue(self):
+        async def waits_on_cancelled_work():
+            work = asyncio.ensure_future(asyncio.sleep(1))
+            work.cancel()
+            await work
+
+        async def run():
+            with self.assertRaises(asyncio.CancelledError):
+                await self.game_manager.submit(self.game.uuid, waits_on_cancelled_work)
+            return await self.game_manager.submit(self.game.uuid, lambda: self.game.turn_number)
+
+        self.assertEqual(asyncio.run(run()), 0)
+
+    def test_full_queue_sheds_commands(self):
+        async def run():
+            release = asyncio.Event()
+            pending = []
+            for _ in range(3):
+                pending.append(asyncio.create_task(self.game_manager.submit(self.game.uuid, release.wait)))
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+            # one command is running and two are queued
+            with self.assertRaises(GameQueueFull):
+                await self.game_manager.submit(self.game.uuid, release.wait)
+            self.assertEqual(self.game_manager.queue_metrics()["depth_total"], 2)
+            release.set()
+            await asyncio.gather(*pending)
+
+        asyncio.run(run())
+        self.assertEqual(self.game_manager.queue_metrics()["shed"], 1)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCommandResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.results = CommandResultCache(max_results=2, ttl=10.0, clock=self.clock)
+        self.game_id = uuid.uuid4()
+        self.user_id = uuid.uuid4()
+
+    def test_results_are_kept_least_recently_used_and_expire(self):
+        first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        self.results.put(self.game_id, self.user_id, first)
+        self.results.put(self.game_id, self.user_id, second, "Failed")
+        self.assertIsNone(self.results.get(self.game_id, uuid.uuid4(), first))
+        self.assertIsNone(self.results.get(self.game_id, self.user_id, first).error)
+        self.results.put(self.game_id, self.user_id, third)
+        self.assertIsNone(self.results.get(self.game_id, self.user_id, second))
+        self.assertEqual(self.results.duplicates, 1)
+
+        self.clock.now += 10.0
+        self.assertIsNone(self.results.get(self.game_id, self.user_id, first))
+        self.results.put(self.game_id, self.user_id, second)
+        self.assertEqual(len(self.results), 1)
+        self.results.drop_game(self.game_id)
+        self.assertEqual(len(self.results), 0)
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=0.1, slot_bits=2, levels=3, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now: float):
+        # step one tick at a time to check timers fire on the right tick
+        while self.clock.now < now:
+            self.clock.now = round(self.clock.now + 0.1, 6)
+            self.wheel.advance()
+
+    def test_timers_fire_in_deadline_order_across_levels(self):
+        delays = [0.1, 0.35, 1.7, 6.3, 0.35, 12.0, 2.5]
+        for idx, delay in enumerate(delays):
+            self.wheel.schedule(delay, lambda idx=idx: self.fired.append((idx, self.clock.now)))
+        self.assertEqual(len(self.wheel), len(delays))
+        self.advance_to(1020.0)
+        self.assertEqual([idx for idx, _ in self.fired], [0, 1, 4, 2, 6, 3, 5])
+        for idx, fired_at in self.fired:
+            # a timer fires on the first tick at or after its deadline
+            self.assertGreaterEqual(fired_at + 1e-6, 1000.0 + delays[idx])
+            self.assertLess(fired_at, 1000.0 + delays[idx] + 0.1 + 1e-6)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancelled_timers_do_not_fire(self):
+        timers = [self.wheel.schedule(delay, self.fired.append, delay) for delay in (0.5, 3.0, 50.0)]
+        timers[1].cancel()
+        timers[2].cancel()
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.now += 100.0
+        self.assertEqual(self.wheel.advance(), 1)
+        self.assertEqual(self.fired, [0.5])
+        self.assertFalse(timers[0].active)
+
+    def test_async_callbacks_are_kept_until_done_and_failures_logged(self):
+        async def record(delay: float):
+            await asyncio.sleep(0)
+            self.fired.append(delay)
+
+        async def fail():
+            raise ValueError("boom")
+
+        async def run():
+            self.wheel.schedule(0.1, record, 0.1)
+            self.wheel.schedule(0.1, fail)
+            self.clock.now += 0.1
+            self.wheel.advance()
+            self.assertEqual(len(self.wheel._callbacks), 2)
+            with self.assertLogs("server.core.timer_wheel", "ERROR"):
+                for _ in range(3):
+                    await asyncio.sleep(0)
+            self.wheel.stop()
+
+        asyncio.run(run())
+        self.assertEqual(self.fired, [0.1])
+        self.assertEqual(len(self.wheel._callbacks), 0)
+
+
+class TestGameTimers(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timers = TimerWheel(clock=self.clock)
+        self.game_manager = GameManager(timers=self.timers, idle_timeout=600.0)
+
+    def run_timers(self, seconds: float):
+        async def run():
+            self.clock.now += seconds
+            self.timers.advance()
+            # let the timeout commands run on the game queues
+            for _ in range(5):
+                await asyncio.sleep(0)
+        asyncio.run(run())
+
+    def test_lobby_closes_unless_host_connects(self):
+        host = uuid.uuid4()
+        waiting = self.game_manager.create_game(host)
+        connected = self.game_manager.create_game(host)
+        self.game_manager.host_connected(connected.uuid)
+        self.run_timers(61.0)
+        self.assertEqual(waiting.end_of_game_trigger, EndOfGameTrigger.LOBBY_CLOSE)
+        self.assertEqual(connected.phase, Phase.INITIALIZED)
+        self.run_timers(600.0)
+        self.assertEqual(connected.end_of_game_trigger, EndOfGameTrigger.IDLE)
+        # timers of finished games are dropped
+        self.assertEqual(len(self.timers), 0)
+
+    def play(self, game: GameState, player_id: uuid.UUID, x: int, command_type: CommandType = CommandType.play_white_piece):
+        command = PlayPiece(type=command_type, body=dict(
+            timestamp=datetime.datetime.utcnow(),
+            game_id=game.uuid,
+            user_id=player_id,
+            current_turn=game.turn_number,
+            pos_x=x,
+            pos_y=0,
+            pos_z=0,
+        ))
+        handler = client.play_white_piece if command_type == CommandType.play_white_piece else client.play_black_piece
+        handler(command, self.game_manager)
+
+    def test_player_to_move_loses_on_time(self):
+        host_id = uuid.uuid4()
+        game = self.game_manager.create_game(host_id, TimeControl(initial=5.0, increment=2.0))
+        self.game_manager.host_connected(game.uuid)
+        with self.game_manager.game_context(game.uuid) as g:
+            g.start(self.game_manager.now())
+        self.play(game, host_id, 0)
+        self.assertGreater(game.white_clock, 6.0)
+        # the game clock and the timers run on the same clock
+        self.run_timers(4.0)
+        self.assertEqual(game.phase, Phase.RUNNING)
+        self.run_timers(1.5)
+        self.assertEqual(game.phase, Phase.FINISHED)
+        self.assertEqual(game.end_of_game_trigger, EndOfGameTrigger.TIMEOUT)
+        self.assertEqual(game.winner, 1)
+
+    def test_late_moves_are_rejected_and_lose_on_time(self):
+        host_id, opponent_id = uuid.uuid4(), uuid.uuid4()
+        game = self.game_manager.create_game(host_id, TimeControl(initial=5.0), opponent_id=opponent_id)
+        self.game_manager.host_connected(game.uuid)
+        with self.game_manager.game_context(game.uuid) as g:
+            g.start(self.game_manager.now())
+        # out of time before the clock timer got to run
+        self.clock.now += 6.0
+        with self.assertRaisesRegex(ValueError, "Flagged on time"):
+            self.play(game, host_id, 0)
+        self.assertEqual(game.move_history, [])
+        self.assertEqual(game.phase, Phase.FINISHED)
+        self.assertEqual(game.end_of_game_trigger, EndOfGameTrigger.TIMEOUT)
+        self.assertEqual(game.winner, 2)
+
+
+class TestPlayCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.game_manager = GameManager()
+        self.websocket_manager = WebSocketManager(self.game_manager, client.router)
+        self.dependencies = self.websocket_manager.resolve_command_dependencies({
+            get_game_manager: lambda: self.game_manager,
+            get_websocket_manager: lambda: self.websocket_manager,
+        })
+        self.white_id, self.black_id = uuid.uuid4(), uuid.uuid4()
+        self.game = self.game_manager.create_game(self.white_id, opponent_id=self.black_id)
+        with self.game_manager.game_context(self.game.uuid) as g:
+            g.start()
+
+    async def play(self, command_type: CommandType, user_id: uuid.UUID, x: int) -> dict:
+        data = dict(type=command_type, body=dict(
+            timestamp=datetime.datetime.utcnow().isoformat(),
+            game_id=str(self.game.uuid),
+            user_id=str(user_id),
+            current_turn=self.game.turn_number,
+            pos_x=x,
+            pos_y=0,
+            pos_z=0,
+        ))
+        ack = await self.websocket_manager.dispatch(data, self.game.uuid, user_id, self.dependencies)
+        return json.loads(ack)["body"]
+
+    def test_players_only_play_their_own_color_on_its_turn(self):
+        async def run():
+            # black plays a white piece
+            ack = await self.play(CommandType.play_white_piece, self.black_id, 0)
+            self.assertFalse(ack["success"])
+            self.assertIsNotNone(ack["error"])
+            # black plays out of turn
+            self.assertFalse((await self.play(CommandType.play_black_piece, self.black_id, 0))["success"])
+            self.assertTrue((await self.play(CommandType.play_white_piece, self.white_id, 0))["success"])
+            # white plays twice
+            self.assertFalse((await self.play(CommandType.play_white_piece, self.white_id, 1))["success"])
+            self.assertTrue((await self.play(CommandType.play_black_piece, self.black_id, 1))["success"])
+
+        asyncio.run(run())
+        self.assertEqual(self.game.move_history, [(1, 0, 0, 0), (2, 1, 0, 0)])
+
+
+class FakeWebSocket:
+
+    def __init__(self, blocked: bool = False):
+        self.sent = []
+        self.close_code = None
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_text(self, text: str):
+        await self.unblocked.wait()
+        self.sent.append(text)
+
+    async def close(self, code: int = 1000, reason: str | None = None):
+        self.close_code = code
+
+
+class TestFanout(unittest.TestCase):
+
+    def setUp(self):
+        self.game_manager = GameManager()
+        self.websocket_manager = WebSocketManager(self.game_manager, send_timeout=0.05, spectator_hz=0)
+        self.game = self.game_manager.create_game(uuid.uuid4())
+
+    def play(self, x: int):
+        with self.game_manager.game_context(self.game.uuid) as g:
+            g.play_white(x, 0, 0) if g.turn_number % 2 == 0 else g.play_black(x, 1, 0)
+
+    def test_frames_are_sent_once_serialized_to_every_subscriber(self):
+        async def run():
+            with self.game_manager.game_context(self.game.uuid) as g:
+                g.start()
+            sockets = [FakeWebSocket() for _ in range(20)]
+            for ws in sockets:
+                self.websocket_manager.subscribe(ws, self.game.uuid)
+            self.play(0)
+            await asyncio.sleep(0)
+            return sockets
+        sockets = asyncio.run(run())
+        for ws in sockets:
+            self.assertEqual(len(ws.sent), 2)
+            self.assertIs(ws.sent[1], sockets[0].sent[1])
+        snapshot, delta = (json.loads(frame) for frame in sockets[0].sent)
+        self.assertEqual(snapshot["type"], "game_state")
+        self.assertEqual(delta["type"], "game_state_delta")
+        self.assertEqual(self.websocket_manager.fanout_latency.count, 1)
+
+    def test_sends_run_in_a_task(self):
+        class TimedWebSocket(FakeWebSocket):
+            async def send_text(self, text: str):
+                async with asyncio.timeout(1.0):
+                    await super().send_text(text)
+
+        async def run():
+            ws = TimedWebSocket()
+            self.websocket_manager.subscribe(ws, self.game.uuid)
+            await asyncio.sleep(0)
+            return ws
+        ws = asyncio.run(run())
+        self.assertEqual(len(ws.sent), 1)
+        self.assertEqual(self.websocket_manager.dropped, 0)
+
+    def test_slow_subscribers_catch_up_or_are_dropped(self):
+        async def run():
+            with self.game_manager.game_context(self.game.uuid) as g:
+                g.start()
+            fast, lagging, stalled = FakeWebSocket(), FakeWebSocket(blocked=True), FakeWebSocket(blocked=True)
+            for ws in (fast, lagging, stalled):
+                self.websocket_manager.subscribe(ws, self.game.uuid)
+            for x in range(3):
+                self.play(x)
+                # a broadcast, then the sends it started
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+            self.assertEqual(len(fast.sent), 4)
+            # the lagging client is caught up to the latest version in one go once it is unblocked
+            lagging.unblocked.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.game.seq, json.loads(lagging.sent[-1])["body"]["seq"])
+            self.assertEqual(self.websocket_manager.slow_sends, 2)
+            await asyncio.sleep(0.1)
+            return stalled
+        stalled = asyncio.run(run())
+        self.assertEqual(stalled.close_code, 1013)
+        self.assertEqual(self.websocket_manager.dropped, 1)
+        self.assertEqual(self.websocket_manager.metrics()["subscriptions"], 2)
+
+    def test_spectators_are_sent_updates_on_a_tick(self):
+        websocket_manager = WebSocketManager(self.game_manager, spectator_hz=5)
+        spectator_id = uuid.uuid4()
+
+        async def run():
+            host, spectator = FakeWebSocket(), FakeWebSocket()
+            websocket_manager.subscribe(host, self.game.uuid, self.game.host_player_id, role=Role.HOST)
+            spectator_sub = websocket_manager.subscribe(spectator, self.game.uuid, spectator_id)
+            # the spectator takes the open seat and is sent every change from then on
+            with self.game_manager.game_context(self.game.uuid) as g:
+                g.try_promote_player(spectator_id)
+            await asyncio.sleep(0.01)
+            self.assertEqual(websocket_manager._subscriptions[spectator_sub].role, Role.PLAYER)
+            watcher = FakeWebSocket()
+            websocket_manager.subscribe(watcher, self.game.uuid, uuid.uuid4())
+            with self.game_manager.game_context(self.game.uuid) as g:
+                g.start()
+            for x in range(3):
+                self.play(x)
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+            self.assertEqual(len(host.sent), len(spectator.sent))
+            self.assertEqual(json.loads(host.sent[-1])["body"]["seq"], self.game.seq)
+            watched = len(watcher.sent)
+            # later changes wait for the next tick, and then go out together
+            self.assertLess(watched, len(host.sent))
+            await asyncio.sleep(0.25)
+            self.assertGreater(len(watcher.sent), watched)
+            self.assertEqual(json.loads(watcher.sent[-1])["body"]["seq"], self.game.seq)
+            self.assertEqual(websocket_manager.metrics()["spectators"], 1)
+            self.assertEqual(websocket_manager.spectator_count(self.game.uuid), 1)
+        asyncio.run(run())
+
+    def test_heartbeat_pings_quiet_clients_and_closes_idle_ones(self):
+        clock = FakeClock()
+        websocket_manager = WebSocketManager(self.game_manager, heartbeat_interval=20.0, idle_timeout=60.0, clock=clock)
+
+        async def run():
+            seq = self.game.seq
+            quiet, chatty = FakeWebSocket(), FakeWebSocket()
+            quiet_sub = websocket_manager.subscribe(quiet, self.game.uuid, uuid.uuid4())
+            chatty_sub = websocket_manager.subscribe(chatty, self.game.uuid, uuid.uuid4())
+            await asyncio.sleep(0.01)
+            self.assertEqual(websocket_manager.spectator_count(self.game.uuid), 2)
+            clock.now += 30.0
+            websocket_manager.touch(chatty_sub)
+            self.assertEqual(websocket_manager.heartbeat(), 0)
+            await asyncio.sleep(0)
+            self.assertEqual(json.loads(quiet.sent[-1])["type"], "ping")
+            self.assertNotEqual(json.loads(chatty.sent[-1])["type"], "ping")
+            clock.now += 30.0
+            self.assertEqual(websocket_manager.heartbeat(), 1)
+            await asyncio.sleep(0.01)
+            self.assertEqual(quiet.close_code, 1001)
+            # every index forgets the closed subscription
+            self.assertNotIn(quiet_sub, websocket_manager._subscriptions)
+            self.assertEqual(websocket_manager.subscriber_count(self.game.uuid), 1)
+            self.assertEqual(websocket_manager.spectator_count(self.game.uuid), 1)
+            websocket_manager.unsubscribe(chatty_sub, self.game.uuid)
+            await asyncio.sleep(0.01)
+            self.assertNotIn(self.game.uuid, websocket_manager._game_to_subs)
+            self.assertEqual(websocket_manager.spectator_count(self.game.uuid), 0)
+            # spectators coming and going leave the game as it was, so it can still go idle
+            self.assertEqual(self.game.seq, seq)
+        asyncio.run(run())
+
+
+class TestGameArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(path_util.path_to_sqlalchemy_uri(os.path.join(self.tmpdir.name, "archive.db")))
+        Base.metadata.create_all(self.engine)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+        self.game_log = GameLog(os.path.join(self.tmpdir.name, "games.log"))
+        self.game_manager = GameManager(self.game_log)
+
+    def tearDown(self):
+        self.game_log.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_archive_and_evict_finished_games(self):
+        evicted = []
+        self.game_manager.register_evict_subscriber(evicted.append)
+        running = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        finished = GameState(host_player_id=None, white_player_id=None, black_player_id=None)
+        for game in (running, finished):
+            self.game_manager.set_game(game)
+        with self.game_manager.game_context(finished.uuid) as game:
+            game.start()
+        with self.game_manager.game_context(finished.uuid) as game:
+            game.play_white(0, 0, 0)
+        with self.game_manager.game_context(finished.uuid) as game:
+            game.close()
+
+        archiver = GameArchiver(self.game_manager, self.sessionmaker, grace_period=3600)
+        self.assertEqual(asyncio.run(archiver.archive_expired()), 0)
+        archiver = GameArchiver(self.game_manager, self.sessionmaker, grace_period=0)
+        self.assertEqual(asyncio.run(archiver.archive_expired()), 1)
+
+        self.assertEqual(evicted, [finished.uuid])
+        self.assertIsNone(self.game_manager.get_game_by_id(finished.uuid))
+        self.assertIsNone(self.game_manager.get_game_by_code(finished.code))
+        self.assertFalse(CODE_ALLOCATOR.is_live(finished.code))
+        self.assertIsNotNone(self.game_manager.get_game_by_id(running.uuid))
+
+        db = self.sessionmaker()
+        archived = db.query(ArchivedGame).one()
+        self.assertEqual(archived.uuid, finished.uuid)
+        self.assertEqual(archived.phase, Phase.FINISHED)
+        self.assertIsNotNone(archived.finished_at)
+        self.assertEqual(board_util.unpack_moves(archived.move_history), [(1, 0, 0, 0)])
+        db.close()
+
+        # evicted games are not recovered
+        recovered = GameManager(GameLog(os.path.join(self.tmpdir.name, "games.log")))
+        self.assertIsNone(recovered.get_game_by_id(finished.uuid))
+        self.assertIsNotNone(recovered.get_game_by_id(running.uuid))
+
+
+
+class TestResultSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(path_util.path_to_sqlalchemy_uri(os.path.join(self.tmpdir.name, "ledger.db")))
+        Base.metadata.create_all(self.engine)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+        self.cache = dict()
+        db = self.sessionmaker()
+        db.add_all([Player(name=name) for name in ("alice", "bob", "carol")])
+        db.commit()
+        tabulation_util.update_cache(self.cache, db)
+        db.close()
+        self.names = dict()
+        self.game_manager = GameManager()
+        self.sink = ResultSink(self.game_manager, self.sessionmaker, self.cache, self.names.get)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def play(self, white: str | None, black: str | None, winner: int) -> tuple[uuid.UUID, uuid.UUID]:
+        white_id, black_id = uuid.uuid4(), uuid.uuid4()
+        self.names[white_id] = white
+        self.names[black_id] = black
+        game = self.game_manager.create_game(white_id, opponent_id=black_id)
+        with self.game_manager.game_context(game.uuid) as g:
+            g.start()
+        with self.game_manager.game_context(game.uuid) as g:
+            g.player_forfeit_game(black_id if winner == 1 else white_id)
+        # later updates of a finished game are not recorded again
+        with self.game_manager.game_context(game.uuid) as g:
+            g.spectator_count += 1
+        return white_id, black_id
+
+    def test_finished_games_are_recorded_in_one_batch(self):
+        self.play("alice", "bob", 1)
+        self.play("carol", "alice", 2)
+        self.play("bob", "carol", 1)
+        self.assertEqual(self.sink.pending, 3)
+        self.assertEqual(asyncio.run(self.sink.flush()), 3)
+        self.assertEqual(self.sink.pending, 0)
+
+        db = self.sessionmaker()
+        self.assertEqual(db.query(Match).count(), 3)
+        incremental = json.loads(self.cache["summary_json_str"])
+        tabulation_util.update_cache(self.cache, db)
+        rebuilt = json.loads(self.cache["summary_json_str"])
+        db.close()
+        self.assertEqual(incremental["ordered_players"], rebuilt["ordered_players"])
+        self.assertEqual(incremental["match_history"], rebuilt["match_history"])
+        self.assertEqual(incremental["ordered_players"][0]["name"], "alice")
+
+    def test_results_are_kept_until_their_players_are_known(self):
+        # names are taken when the game ends, the session may be gone by the flush
+        white_id, _ = self.play("alice", "bob", 1)
+        del self.names[white_id]
+        # no player of this name, and a user without a session
+        self.play("alice", "dave", 1)
+        _, black_id = self.play("carol", None, 1)
+        self.assertEqual(asyncio.run(self.sink.flush()), 3)
+        self.assertEqual(self.sink.recorded, 1)
+        self.assertEqual(self.sink.unresolved, 2)
+
+        db = self.sessionmaker()
+        self.assertEqual(db.query(Player).filter(Player.name == "dave").count(), 0)
+        db.add(Player(name="dave"))
+        db.commit()
+        db.close()
+        self.names[black_id] = "bob"
+        self.sink.retry_unresolved()
+        self.assertEqual(asyncio.run(self.sink.flush()), 2)
+        self.assertEqual(self.sink.recorded, 3)
+        self.assertEqual(self.sink.unresolved, 0)
+        self.assertEqual(self.cache["ratings"].match_count, 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,90 @@
+import random
+import unittest
+from uuid import UUID, uuid4
+
+from server.core.game import GameManager
+from server.core.matchmaking import Matchmaker
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestMatchmaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ratings: dict[UUID, float] = dict()
+        self.game_manager = GameManager()
+        self.matchmaker = Matchmaker(
+            self.game_manager,
+            self.ratings.__getitem__,
+            initial_window=50.0,
+            window_growth=10.0,
+            max_window=400.0,
+            clock=self.clock,
+        )
+
+    def queue(self, rating: float) -> UUID:
+        user_id = uuid4()
+        self.ratings[user_id] = rating
+        self.matchmaker.join(user_id)
+        return user_id
+
+    def test_close_ratings_are_paired_immediately(self):
+        first = self.queue(1200)
+        far = self.queue(1400)
+        second = self.queue(1230)
+        self.assertFalse(self.matchmaker.status(first).queued)
+        self.assertTrue(self.matchmaker.status(far).queued)
+
+        game = self.game_manager.get_game_by_id(self.matchmaker.status(second).game_id)
+        self.assertEqual(game.host_player_id, first)
+        self.assertEqual((game.white_player_id, game.black_player_id), (first, second))
+        self.assertEqual(self.matchmaker.wait_times.count, 2)
+
+    def test_window_widens_with_waiting_time(self):
+        low = self.queue(1200)
+        high = self.queue(1300)
+        self.assertEqual(self.matchmaker.match(), 0)
+        self.clock.now = 4.0
+        self.assertEqual(self.matchmaker.match(), 0)
+        self.clock.now = 5.0
+        self.assertEqual(self.matchmaker.match(), 1)
+        self.assertEqual(self.matchmaker.status(low).game_id, self.matchmaker.status(high).game_id)
+
+    def test_leaving_removes_player(self):
+        user_id = self.queue(1200)
+        self.assertTrue(self.matchmaker.leave(user_id))
+        self.queue(1200)
+        self.assertEqual(len(self.matchmaker), 1)
+
+    def test_thousands_of_players(self):
+        rng = random.Random(7)
+        users = [self.queue(rng.gauss(1200, 300)) for _ in range(5000)]
+        paired_on_join = 5000 - len(self.matchmaker)
+        self.clock.now = 60.0
+        created = self.matchmaker.match()
+        # the window is 400 wide by now, so only outliers are left waiting
+        self.assertLess(len(self.matchmaker), 20)
+
+        games: dict[UUID, list[UUID]] = dict()
+        for user_id in users:
+            status = self.matchmaker.status(user_id)
+            if not status.queued:
+                games.setdefault(status.game_id, []).append(user_id)
+        self.assertEqual(2 * len(games) + len(self.matchmaker), len(users))
+        self.assertEqual(2 * (len(games) - created), paired_on_join)
+        for game_id, (first, second) in games.items():
+            game = self.game_manager.get_game_by_id(game_id)
+            self.assertEqual({game.white_player_id, game.black_player_id}, {first, second})
+            self.assertLessEqual(abs(self.ratings[first] - self.ratings[second]), 400.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from server.core.rate_limit import Budget, RateLimiter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_buckets_refill_at_their_rate_and_are_bounded(self):
+        clock = FakeClock()
+        limiter = RateLimiter({"match": Budget(0.5, 2)}, max_buckets=2, clock=clock)
+        self.assertEqual([limiter.acquire("match", "a") for _ in range(3)], [0.0, 0.0, 2.0])
+        clock.now += 1.0
+        self.assertEqual(limiter.acquire("match", "a"), 1.0)
+        clock.now += 1.0
+        self.assertEqual(limiter.acquire("match", "a"), 0.0)
+        # unknown route groups get the default budget
+        self.assertEqual(limiter.acquire("other", "a"), 0.0)
+        limiter.acquire("match", "b")
+        self.assertEqual(len(limiter), 2)
+        # "a" was dropped, so it starts over with a full bucket
+        self.assertEqual(limiter.acquire("match", "a"), 0.0)
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+
+from server.core.session_store import SessionStore
+from server.core.user_session import UserSessionManager
+from server.models.orm.user_session import UserSession
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sessions.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sessions_survive_a_restart_and_load_on_first_lookup(self):
+        store = SessionStore(self.path)
+        sessions = UserSessionManager(store=store)
+        user_ids = [uuid.uuid4() for _ in range(3)]
+        for user_id in user_ids:
+            sessions.login(user_id, f"player-{user_id.hex[:6]}")
+        # replaced before it was written
+        latest, _ = sessions.login(user_ids[0], "renamed")
+        self.assertEqual(store.load_user(user_ids[0]), latest)
+        self.assertEqual(asyncio.run(store.flush()), 3)
+        store.close()
+
+        store = SessionStore(self.path)
+        restarted = UserSessionManager(store=store)
+        self.assertEqual(len(restarted), 0)
+        self.assertEqual(restarted.get_session_for_user_id(user_ids[0]).name, "renamed")
+        self.assertEqual(restarted.get_session_by_id(sessions.get_session_for_user_id(user_ids[1]).uuid).user_id, user_ids[1])
+        self.assertIsNone(restarted.get_session_for_user_id(uuid.uuid4()))
+        self.assertEqual(len(restarted), 2)
+        store.close()
+
+    def test_logins_during_a_write_are_written_by_the_next_flush(self):
+        store = SessionStore(self.path)
+        sessions = UserSessionManager(store=store)
+        user_id = uuid.uuid4()
+        first, _ = sessions.login(user_id, "first")
+        write = store._write
+        during = []
+
+        def login_while_writing(batch):
+            # a login on the request thread pool lands while the batch is written
+            during.append(sessions.login(user_id, "second")[0])
+            write(batch)
+
+        store._write = login_while_writing
+        self.assertEqual(asyncio.run(store.flush()), 1)
+        store._write = write
+        self.assertEqual(store.pending, 1)
+        self.assertEqual(store.load_user(user_id), during[0])
+        self.assertEqual(asyncio.run(store.flush()), 1)
+        self.assertEqual(store.load_user(user_id).uuid, during[0].uuid)
+        self.assertIsNone(store.load_session(first.uuid))
+        store.close()
+
+    def test_sessions_queued_during_a_flush_are_kept(self):
+        store = SessionStore(self.path)
+        user_ids = [uuid.uuid4() for _ in range(50)]
+        latest = dict()
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        def log_in():
+            for idx in range(2000):
+                user_session = UserSession(user_id=user_ids[idx % len(user_ids)], name=f"player-{idx}", expires_at=expires_at)
+                latest[user_session.user_id] = user_session
+                store.put(user_session)
+
+        async def run():
+            thread = threading.Thread(target=log_in)
+            thread.start()
+            while thread.is_alive():
+                await store.flush()
+            thread.join()
+            await store.flush()
+
+        asyncio.run(run())
+        store.close()
+        store = SessionStore(self.path)
+        for user_id, user_session in latest.items():
+            self.assertEqual(store.load_user(user_id).uuid, user_session.uuid)
+        store.close()
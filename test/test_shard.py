@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from uuid import UUID, uuid4
+
+from fastapi.testclient import TestClient
+from starlette.testclient import WebSocketDenialResponse
+
+from server.core.app import create_app
+from server.core.dependencies import get_game_manager, get_websocket_manager
+from server.core.game import GameManager
+from server.core.shard import HashRing, ShardCoordinator, ShardRouter
+from server.core.websocket_manager import WebSocketManager
+
+WORKERS = ["worker-0", "worker-1"]
+
+
+def provide(value):
+    return lambda: value
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_every_key_has_one_owner_and_load_is_spread(self):
+        ring = HashRing(WORKERS + ["worker-2"])
+        owners = [ring.owner(uuid4()) for _ in range(3000)]
+        for worker in WORKERS + ["worker-2"]:
+            self.assertGreater(owners.count(worker), 600)
+
+    def test_adding_a_worker_only_moves_its_share(self):
+        before = HashRing(WORKERS)
+        after = HashRing(WORKERS + ["worker-2"])
+        keys = [uuid4() for _ in range(3000)]
+        moved = [k for k in keys if before.owner(k) != after.owner(k)]
+        self.assertTrue(all(after.owner(k) == "worker-2" for k in moved))
+
+
+class TestShardedGameServer(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESTING'] = '1'
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "shards.db")
+        self.clients = []
+        self.managers = []
+        for idx, worker_id in enumerate(WORKERS):
+            coordinator = ShardCoordinator(path)
+            coordinator.register_worker(worker_id, f"http://worker{idx}")
+            game_manager = GameManager(shard=ShardRouter(worker_id, WORKERS, coordinator))
+            websocket_manager = WebSocketManager(game_manager)
+            app = create_app()
+            app.dependency_overrides[get_game_manager] = provide(game_manager)
+            app.dependency_overrides[get_websocket_manager] = provide(websocket_manager)
+            client = TestClient(app, follow_redirects=False)
+            token = client.post("/api/login", json={"name": f"user-{idx}"}).json()["token"]
+            client.headers = {'Authorization': f'Bearer {token}'}
+            client.token = token
+            self.clients.append(client)
+            self.managers.append(game_manager)
+
+    def tearDown(self):
+        for game_manager in self.managers:
+            game_manager.shard.coordinator.close()
+        self.tmpdir.cleanup()
+
+    def create_game(self, idx: int) -> UUID:
+        resp = self.clients[idx].post("/api/game", json={})
+        resp.raise_for_status()
+        return UUID(resp.json()["game_id"])
+
+    def test_games_are_created_on_the_receiving_worker(self):
+        for idx, worker_id in enumerate(WORKERS):
+            for _ in range(5):
+                game_id = self.create_game(idx)
+                self.assertEqual(self.managers[idx].shard.owner(game_id), worker_id)
+                self.assertIsNotNone(self.managers[idx].get_game_by_id(game_id))
+
+    def test_requests_for_other_workers_games_are_redirected(self):
+        game_id = self.create_game(1)
+        resp = self.clients[0].get(f"/api/game/{game_id}")
+        self.assertEqual(resp.status_code, 307)
+        self.assertEqual(resp.headers["location"], f"http://worker1/api/game/{game_id}")
+        self.assertEqual(self.clients[1].get(f"/api/game/{game_id}").status_code, 200)
+
+        client = self.clients[0]
+        with self.assertRaises(WebSocketDenialResponse) as ctx:
+            with client.websocket_connect(f"/api/game/{game_id}/ws?token={client.token}"):
+                pass
+        self.assertEqual(ctx.exception.status_code, 307)
+        self.assertEqual(
+            ctx.exception.headers["location"],
+            f"ws://worker1/api/game/{game_id}/ws?token={client.token}"
+        )
+
+    def test_codes_are_unique_and_resolve_on_any_worker(self):
+        game_id = self.create_game(1)
+        code = self.managers[1].get_game_by_id(game_id).code
+        resp = self.clients[0].get(f"/api/game/code?code={code}")
+        resp.raise_for_status()
+        self.assertEqual(UUID(resp.json()["game_id"]), game_id)
+        coordinator = self.managers[0].shard.coordinator
+        self.assertFalse(coordinator.claim_code(code, uuid4(), "worker-0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.core import env
+from server.core.database import Base
+from server.core.rating_sync import RatingSync
+from server.models.orm.match import Match
+from server.models.orm.player import Player
+from server.utils import path_util, tabulation_util
+
+
+class TestRatingsSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(path_util.path_to_sqlalchemy_uri(os.path.join(self.tmpdir.name, "ledger.db")))
+        Base.metadata.create_all(self.engine)
+        self.db = sessionmaker(bind=self.engine)()
+        self.path = os.path.join(self.tmpdir.name, "ratings.snapshot")
+        self.db.add_all([Player(name=name) for name in ("alice", "bob", "carol")])
+        self.db.commit()
+        self.cache = dict()
+        tabulation_util.update_cache(self.cache, self.db)
+        self.played_at = datetime.datetime(2024, 1, 1)
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def record(self, *results: tuple[str, str]):
+        for winner, loser in results:
+            self.played_at += datetime.timedelta(minutes=1)
+            tabulation_util.apply_matches(self.cache, self.db, [(winner, loser, self.played_at)])
+
+    def restart(self) -> dict:
+        cache = dict()
+        self.assertTrue(tabulation_util.load_snapshot(cache, self.path))
+        return cache
+
+    def test_snapshot_is_served_then_caught_up(self):
+        self.record(("alice", "bob"), ("bob", "carol"))
+        state = self.cache["ratings"]
+        tabulation_util.write_snapshot(self.path, state, self.cache["summary_json_str"])
+        # the temporary file is renamed into place
+        snapshots = [name for name in os.listdir(self.tmpdir.name) if name.startswith("ratings.snapshot")]
+        self.assertEqual(snapshots, ["ratings.snapshot"])
+        cache = self.restart()
+        self.assertEqual(cache["summary_json_str"], self.cache["summary_json_str"])
+        self.assertEqual(cache["elo"], state.elo)
+
+        # matches recorded after the snapshot are applied on top of it
+        self.record(("carol", "alice"))
+        tabulation_util.catch_up(cache, self.db)
+        self.assertEqual(cache["ratings"].match_count, 3)
+        self.assertEqual(cache["elo"], self.cache["elo"])
+
+        # a match in the snapshot is gone, so it no longer lines up and is rebuilt
+        cache = self.restart()
+        self.db.delete(self.db.query(Match).order_by(Match.created_at.asc()).offset(1).first())
+        self.db.commit()
+        tabulation_util.catch_up(cache, self.db)
+        tabulation_util.update_cache(self.cache, self.db)
+        self.assertEqual(cache["ratings"].match_count, 2)
+        self.assertEqual(cache["elo"], self.cache["elo"])
+
+    def test_snapshots_of_other_versions_are_ignored(self):
+        tabulation_util.write_snapshot(self.path, self.cache["ratings"], self.cache["summary_json_str"])
+        with open(self.path, "r+b") as f:
+            f.seek(8)
+            f.write((tabulation_util.SNAPSHOT_VERSION + 1).to_bytes(2, "little"))
+        self.assertFalse(tabulation_util.load_snapshot(dict(), self.path))
+        self.assertFalse(tabulation_util.load_snapshot(dict(), os.path.join(self.tmpdir.name, "missing")))
+
+    def test_other_workers_catch_up_with_recorded_ratings(self):
+        other = dict()
+        tabulation_util.update_cache(other, self.db)
+        sync = RatingSync(sessionmaker(bind=self.engine), other)
+
+        # recorded through this worker only
+        self.record(("alice", "bob"), ("bob", "carol"))
+        self.assertNotEqual(other["elo"], self.cache["elo"])
+        asyncio.run(sync.sync())
+        self.assertEqual(other["ratings"].match_count, 2)
+        self.assertEqual(other["elo"], self.cache["elo"])
+        self.assertEqual(
+            json.loads(other["summary_json_str"])["ordered_players"],
+            json.loads(self.cache["summary_json_str"])["ordered_players"],
+        )
+
+        # nothing changed, so the state is left as it is
+        state = other["ratings"]
+        asyncio.run(sync.sync())
+        self.assertIs(other["ratings"], state)
+
+        # a player added without a match
+        self.db.add(Player(name="dave"))
+        self.db.commit()
+        asyncio.run(sync.sync())
+        self.assertEqual(other["elo"]["dave"], env.STARTING_ELO)
+
+    def test_snapshot_is_written_in_the_background_when_ratings_change(self):
+        sync = RatingSync(sessionmaker(bind=self.engine), self.cache, shared=False, snapshot_path=self.path)
+        # recording a match does not touch the disk
+        self.record(("alice", "bob"))
+        self.assertFalse(os.path.exists(self.path))
+
+        asyncio.run(sync.save_snapshot())
+        self.assertEqual(self.restart()["elo"], self.cache["elo"])
+
+        # nothing changed, so the snapshot is not rewritten
+        os.remove(self.path)
+        asyncio.run(sync.save_snapshot())
+        self.assertFalse(os.path.exists(self.path))
+
+        self.record(("bob", "carol"), ("carol", "alice"))
+        asyncio.run(sync.save_snapshot())
+        cache = self.restart()
+        self.assertEqual(cache["ratings"].match_count, 3)
+        self.assertEqual(cache["elo"], self.cache["elo"])
@@ -0,0 +1,80 @@
+import datetime
+import threading
+import time
+import unittest
+import uuid
+
+from server.core.token_cache import TokenCache, TokenRevoked
+from server.utils import jwt_util
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def test_tokens_are_decoded_once_until_they_expire(self):
+        clock = FakeClock()
+        clock.now = time.time()
+        tokens = TokenCache(max_tokens=1, clock=clock)
+        user_id = uuid.uuid4()
+        token = jwt_util.create_access_token(
+            {"user_id": user_id.hex}, expires_delta=datetime.timedelta(minutes=1)
+        )
+        self.assertEqual(tokens.decode(token).user_id, user_id)
+        self.assertIs(tokens.decode(token), tokens.decode(token))
+        self.assertEqual((tokens.hits, tokens.misses), (2, 1))
+
+        clock.now += 60
+        # expired entries are decoded again, which rejects them once the token has expired
+        self.assertEqual(tokens.decode(token).user_id, user_id)
+        self.assertEqual(tokens.misses, 2)
+
+        clock.now -= 60
+        tokens.revoke(token)
+        with self.assertRaises(TokenRevoked):
+            tokens.decode(token)
+        self.assertEqual(len(tokens), 0)
+        # forgotten once it would have expired anyway
+        clock.now += 60
+        tokens.revoke(jwt_util.create_access_token({"user_id": user_id.hex}))
+        self.assertEqual(tokens.metrics()["revoked"], 1)
+
+    def test_tokens_are_revoked_while_other_threads_decode(self):
+        tokens = TokenCache(max_tokens=50)
+        issued = [
+            jwt_util.create_access_token({"user_id": uuid.uuid4().hex}, expires_delta=datetime.timedelta(minutes=1))
+            for _ in range(100)
+        ]
+        errors = []
+
+        def decode():
+            try:
+                for _ in range(5):
+                    for token in issued:
+                        try:
+                            tokens.decode(token)
+                        except TokenRevoked:
+                            pass
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=decode) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for token in issued[::2]:
+            tokens.revoke(token)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for token in issued[::2]:
+            with self.assertRaises(TokenRevoked):
+                tokens.decode(token)
+        self.assertLessEqual(len(tokens), 50)
+        self.assertEqual(tokens.metrics()["revoked"], 50)
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+
+from server.core.session_store import SessionStore
+from server.core.user_session import UserSessionManager
+
+
+class TestUserSessionManager(unittest.TestCase):
+
+    def test_sessions_are_replaced_expired_and_capped(self):
+        now = [datetime.datetime(2024, 1, 1)]
+        sessions = UserSessionManager(datetime.timedelta(hours=1), max_sessions=2, clock=lambda: now[0])
+        first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        replaced, _ = sessions.login(first, "first")
+        latest, _ = sessions.login(first, "first")
+        self.assertIsNone(sessions.get_session_by_id(replaced.uuid))
+        self.assertEqual(sessions.get_session_for_user_id(first), latest)
+
+        now[0] += datetime.timedelta(minutes=30)
+        sessions.login(second, "second")
+        # first was used last, so second is dropped for third
+        sessions.get_session_for_user_id(first)
+        sessions.login(third, "third")
+        self.assertIsNone(sessions.get_session_for_user_id(second))
+
+        now[0] += datetime.timedelta(minutes=30)
+        self.assertIsNone(sessions.get_session_for_user_id(first))
+        self.assertEqual(sessions.metrics(), dict(active=1, expired=1, replaced=1, evicted=1))
+
+    def test_logins_racing_with_lookups_keep_one_session_per_user(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SessionStore(os.path.join(tmpdir, "sessions.db"))
+            sessions = UserSessionManager(max_sessions=4, store=store)
+            user_ids = [uuid.uuid4() for _ in range(8)]
+            errors = []
+
+            def run(work):
+                try:
+                    for _ in range(200):
+                        for user_id in user_ids:
+                            work(user_id)
+                except Exception as e:
+                    errors.append(e)
+
+            def look_up(user_id: uuid.UUID):
+                user_session = sessions.get_session_for_user_id(user_id)
+                if user_session is not None:
+                    sessions.get_session_by_id(user_session.uuid)
+
+            threads = [
+                threading.Thread(target=run, args=(lambda user_id: sessions.login(user_id, "player"),)),
+                threading.Thread(target=run, args=(lambda user_id: sessions.login(user_id, "player"),)),
+                threading.Thread(target=run, args=(look_up,)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            store.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(sessions), 4)
+        self.assertEqual(len(sessions._user_id_to_session), 4)
+        for user_session in sessions._user_sessions.values():
+            self.assertIs(sessions._user_id_to_session[user_session.user_id], user_session)
+
+    def test_sessions_read_from_the_store_do_not_replace_newer_logins(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SessionStore(os.path.join(tmpdir, "sessions.db"))
+            user_id = uuid.uuid4()
+            stored, _ = UserSessionManager(store=store).login(user_id, "player")
+            asyncio.run(store.flush())
+            sessions = UserSessionManager(store=store)
+            load_session = store.load_session
+
+            def login_while_loading(session_id: uuid.UUID):
+                user_session = load_session(session_id)
+                # the user logs in again while the old session is read
+                sessions.login(user_id, "player")
+                return user_session
+
+            store.load_session = login_while_loading
+            self.assertIsNone(sessions.get_session_by_id(stored.uuid))
+            latest = sessions.get_session_for_user_id(user_id)
+            self.assertNotEqual(latest.uuid, stored.uuid)
+            self.assertEqual(len(sessions), 1)
+            store.close()